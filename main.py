@@ -12,18 +12,22 @@ import sys
 import subprocess
 import logging
 import random
-import pickle
+import heapq
 
 import regex as re
 
 sys_dir = '/home/niuyilin/OpenQA-STM'
 sys.path.append(sys_dir)
 
-from src.reader import utils, vector, config, data
+from src.reader import utils, vector, config, data, distributed
 from src.reader import DocReader
 from src import DATA_DIR as DRQA_DATA
 from src.retriever.utils import normalize
 from src.reader.data import Dictionary
+from src.reader.aggregator import SpanAggregator
+from src.reader.evidence import EvidenceLabels
+from src.reader.telemetry import TELEMETRY
+from src.reader.profiling import PROFILER
 
 
 from src import tokenizers
@@ -69,8 +73,22 @@ def add_train_args(parser):
                          help='Run on a specific GPU')
     runtime.add_argument('--data-workers', type=int, default=1,
                          help='Number of subprocesses for data loading')
+    runtime.add_argument('--compact-data', type='bool', default=True,
+                         help='Keep paragraphs as token id arrays '
+                         '(ParagraphStore) instead of lists of dicts')
+    runtime.add_argument('--stream-data', type='bool', default=False,
+                         help='Index the data files and parse questions on '
+                         'demand instead of loading them into memory')
+    runtime.add_argument('--stream-cache-size', type=int, default=256,
+                         help='Parsed questions kept per process with '
+                         '--stream-data')
     runtime.add_argument('--parallel', type='bool', default=False,
                          help='Use DataParallel on all available GPUs')
+    runtime.add_argument('--dist-backend', type=str, default='gloo',
+                         help='torch.distributed backend when started by '
+                         'a launcher (torch.distributed.launch)')
+    runtime.add_argument('--local_rank', type=int, default=0,
+                         help='GPU of this process (set by the launcher)')
     runtime.add_argument('--random-seed', type=int, default=1012,
                          help=('Random seed for all numpy/torch/cuda '
                                'operations (for reproducibility)'))
@@ -80,6 +98,13 @@ def add_train_args(parser):
                          help='Batch size for training')
     runtime.add_argument('--test-batch-size', type=int, default=64,
                          help='Batch size during validation/testing')
+    runtime.add_argument('--num-docs', type=int, default=50,
+                         help='Paragraphs read per question')
+    runtime.add_argument('--pad-docs', type='bool', default=True,
+                         help='Repeat the paragraphs of questions with fewer '
+                         'than --num-docs up to --num-docs; otherwise a batch '
+                         'has as many paragraph slots as its longest question '
+                         'and the missing ones are masked')
 
     # Co-Training
     cotraining = parser.add_argument_group('CoTraining')
@@ -89,6 +114,10 @@ def add_train_args(parser):
                          help='Path of sentence id file')
     cotraining.add_argument('--save_evidence_file', type=str, default='none',
                          help='Path of sentence id file')
+    cotraining.add_argument('--self-training-rounds', type=int, default=0,
+                         help='Run this many train + evidence labeling rounds '
+                         'in one process (0 = single run); with --checkpoint '
+                         'a restarted run resumes at the last round')
 
     # Files
     files = parser.add_argument_group('Filesystem')
@@ -108,6 +137,9 @@ def add_train_args(parser):
     save_load = parser.add_argument_group('Saving/Loading')
     save_load.add_argument('--checkpoint', type='bool', default=False,
                            help='Save model + optimizer state after each epoch')
+    save_load.add_argument('--checkpoint-steps', type=int, default=0,
+                           help='Also checkpoint every N batches (implies '
+                           '--checkpoint)')
     save_load.add_argument('--pretrained', type=str, default= None, #'models/SQuAD.ckpt.mdl',#'data/reader/multitask.mdl
                            help='Path to a pretrained model to warm-start with')
     save_load.add_argument('--expand-dictionary', type='bool', default=False,
@@ -128,8 +160,30 @@ def add_train_args(parser):
                          help='Validate with official SQuAD eval')
     general.add_argument('--valid-metric', type=str, default='exact_match',
             help='If using official evaluation: f1; else: exact_match')
+    general.add_argument('--answer-aggregation', type=str, default='sum',
+                         help='Combine span scores over paragraphs: '
+                         'sum, max or noisy_or')
     general.add_argument('--display-iter', type=int, default=25,
                          help='Log state after every <display_iter> epochs')
+    general.add_argument('--telemetry-file', type=str, default=None,
+                         help='Write per-phase timings and throughput here '
+                         'every <display_iter> batches')
+    general.add_argument('--telemetry-format', type=str, default='jsonl',
+                         help='Telemetry file format: jsonl or prometheus '
+                         '(node_exporter textfile)')
+    general.add_argument('--profile-steps', type=str, default=None,
+                         help='Profile batches <start>:<end> (end exclusive) '
+                         'of every epoch of --profile-loops')
+    general.add_argument('--profile-loops', type=str, nargs='+',
+                         default=['train'],
+                         help='Loops to profile: train, pretrain_reader, '
+                         'pretrain_selector and/or validate')
+    general.add_argument('--profilers', type=str, nargs='+',
+                         default=['autograd', 'cprofile', 'modules'],
+                         help='autograd (Chrome trace), cprofile (pstats) '
+                         'and/or modules (forward time per module)')
+    general.add_argument('--shuffle', type='bool', default=False,
+                         help='Shuffle training questions every epoch')
     general.add_argument('--sort-by-len', type='bool', default=True,
                          help='Sort batches by length for speed')
 
@@ -151,19 +205,24 @@ def set_defaults(args):
         import time
         args.model_name = time.strftime("%Y%m%d-") + str(uuid.uuid4())[:8]
 
+    if args.checkpoint_steps > 0:
+        args.checkpoint = True
+
     # Set log + model file names
     args.log_file = os.path.join(args.model_dir, args.model_name + '.txt')
     args.model_file = os.path.join(args.model_dir, args.model_name + '.mdl')
 
-    # Embeddings options
-    if args.embedding_file:
-        with open(args.embedding_file) as f:
-            dim = len(f.readline().strip().split(' ')) - 1
-        args.embedding_dim = dim
-    elif not args.embedding_dim:
+    # Embeddings options (embedding_dim is read from the file in
+    # init_from_scratch, the only place that needs it)
+    if not args.embedding_file and not args.embedding_dim:
         raise RuntimeError('Either embedding_file or embedding_dim '
                            'needs to be specified.')
 
+    # Paragraph slots per question, used by the data and model modules
+    if args.num_docs < 1:
+        raise RuntimeError('--num-docs must be at least 1')
+    vector.num_docs = args.num_docs
+
     # Make sure tune_partial and fix_embeddings are consistent.
     if args.tune_partial > 0 and args.fix_embeddings:
         logger.warning('WARN: fix_embeddings set to False as tune_partial > 0.')
@@ -200,6 +259,9 @@ def init_from_scratch(args, train_docs):
     logger.info('Num words = %d' % len(word_dict))
 
     # Initialize model
+    if args.embedding_file:
+        with open(args.embedding_file) as f:
+            args.embedding_dim = len(f.readline().strip().split(' ')) - 1
     model = DocReader(config.get_model_args(args), word_dict, feature_dict)
 
     # Load pretrained embeddings for words in dictionary
@@ -219,32 +281,24 @@ def train(args, data_loader, model, global_stats, exs_with_doc, docs_by_question
     train_loss = utils.AverageMeter()
     epoch_time = utils.Timer()
     # Run one epoch
-    update_step = 0
-    for idx, ex_with_doc in enumerate(data_loader):
+    TELEMETRY.loop('train', restart=True)
+    profiled = PROFILER.wrap(TELEMETRY.timed(data_loader), args.model_name,
+                             'train', global_stats['epoch'], model)
+    for idx, ex_with_doc in enumerate(profiled):
+        restore_rng()
+        TELEMETRY.count_batch(ex_with_doc)
         ex = ex_with_doc[0]
         batch_size, question, ex_id = ex[0].size(0), ex[3], ex[-1]
-        if (idx not in HasAnswer_Map):
-            HasAnswer_list = []
-            for idx_doc in range(0, vector.num_docs):
-                HasAnswer = []
-                for i in range(batch_size):
-                    HasAnswer.append(has_answer(args, exs_with_doc[ex_id[i]]['answer'], docs_by_question[ex_id[i]][idx_doc%len(docs_by_question[ex_id[i]])]["document"]))
-                HasAnswer_list.append(HasAnswer)
-            HasAnswer_Map[idx] = HasAnswer_list
-        else:
-            HasAnswer_list = HasAnswer_Map[idx]
+        HasAnswer_list = get_has_answer(args, ex_id, exs_with_doc, docs_by_question,
+                                        len(ex_with_doc))
 
-        if (idx not in Evidence_Label):
-            Evidence_list = [-1] * batch_size
-            Evidence_Label[idx] = Evidence_list
-        else:
-            Evidence_list = Evidence_Label[idx]
+        Evidence_list = Evidence_Label.get(ex_id)
 
         weights = []
-        for idx_doc in range(0, vector.num_docs):
+        for idx_doc in range(0, len(ex_with_doc)):
             weights.append(1)
         weights = torch.Tensor(weights)
-        idx_random = torch.multinomial(weights, int(vector.num_docs))
+        idx_random = torch.multinomial(weights, len(ex_with_doc))
         idx_doc_map = {int(idx_doc): i for i, idx_doc in enumerate(idx_random)}
         idx_doc_map[-1] = -1
 
@@ -255,7 +309,7 @@ def train(args, data_loader, model, global_stats, exs_with_doc, docs_by_question
             HasAnswer_list_sample.append(HasAnswer_list[idx_doc])
             ex_with_doc_sample.append(ex_with_doc[idx_doc])
         for i in range(batch_size):
-            Evidence_list_sample.append(idx_doc_map[Evidence_list[i]])
+            Evidence_list_sample.append(idx_doc_map.get(Evidence_list[i], -1))
 
         l_list_doc = []
         r_list_doc = []
@@ -272,47 +326,48 @@ def train(args, data_loader, model, global_stats, exs_with_doc, docs_by_question
         pred_s_list_doc = []
         pred_e_list_doc = []
         tmp_top_n = 1
-        for idx_doc in idx_random:
-            ex = ex_with_doc[idx_doc]
-            pred_s, pred_e, pred_score = model.predict(ex,top_n = tmp_top_n)
+        for pred_s, pred_e, pred_score in model.predict_docs(ex_with_doc_sample,
+                                                            top_n=tmp_top_n):
             pred_s_list = []
             pred_e_list = []
             for i in range(batch_size):
-                pred_s_list.append(pred_s[i].tolist())
-                pred_e_list.append(pred_e[i].tolist())
+                # Absent paragraphs (without --pad-docs) have no prediction
+                pred_s_list.append(pred_s[i].tolist() or [-1] * tmp_top_n)
+                pred_e_list.append(pred_e[i].tolist() or [-1] * tmp_top_n)
             pred_s_list_doc.append(torch.LongTensor(pred_s_list))
             pred_e_list_doc.append(torch.LongTensor(pred_e_list))
 
-        _loss = model.update_with_doc(update_step, ex_with_doc_sample, \
+        _loss = model.update_with_doc(ex_with_doc_sample, \
                             pred_s_list_doc, pred_e_list_doc, tmp_top_n, \
                             l_list_doc, r_list_doc, HasAnswer_list_sample, \
                             evidence_label=Evidence_list_sample)
         train_loss.update(*_loss)
-        update_step = (update_step + 1) % 4
         if idx % args.display_iter == 0:
             logger.info('train: Epoch = %d | iter = %d/%d | ' %
                         (global_stats['epoch'], idx, len(data_loader)) +
                         'loss = %.2f | elapsed time = %.2f (s)' %
-                        (train_loss.avg, global_stats['timer'].time()))
+                        (reduce_meter(train_loss), global_stats['timer'].time()))
+            TELEMETRY.flush(epoch=global_stats['epoch'], step=idx,
+                            loss=train_loss.avg)
             train_loss.reset()
         if (idx%200==199):
             validate_unofficial_with_doc(args, data_loader, model, global_stats, exs_with_doc, docs_by_question, 'train')
+        checkpoint_step(args, model, global_stats, data_loader, idx)
         # break
+    TELEMETRY.flush(epoch=global_stats['epoch'], step=len(data_loader))
     logger.info('train: Epoch %d done. Time for epoch = %.2f (s)' %
                 (global_stats['epoch'], epoch_time.time()))
 
-    # Checkpoint
-    if args.checkpoint:
-        model.checkpoint(args.model_file + '.checkpoint',
-                         global_stats['epoch'] + 1)
-
 
 def update_evidence(args, data_loader, model, global_stats, exs_with_doc, docs_by_question):
     Top_k = args.top_k
     logger.info('Top k is set to %d' % (Top_k))
 
-    Probability = {}
-    Attention_Weight = {}
+    # Min-heap of the Top_k best unlabeled questions seen so far, as
+    # (attention, -seq, question id, max_index, prob). -seq breaks ties in
+    # favour of earlier examples, like a stable sort over all of them would.
+    evidence_heap = []
+    seq = 0
 
     """Run through one epoch of model training with the provided data loader."""
     # Initialize meters + timers
@@ -320,27 +375,16 @@ def update_evidence(args, data_loader, model, global_stats, exs_with_doc, docs_b
     train_attention = utils.AverageMeter()
     epoch_time = utils.Timer()
     # Run one epoch
-    update_step = 0
-    for idx, ex_with_doc in enumerate(data_loader):
+    TELEMETRY.loop('evidence', restart=True)
+    for idx, ex_with_doc in enumerate(TELEMETRY.timed(data_loader)):
+        TELEMETRY.count_batch(ex_with_doc)
         ex = ex_with_doc[0]
         batch_size, question, ex_id = ex[0].size(0), ex[3], ex[-1]
-        if (idx not in HasAnswer_Map):
-            HasAnswer_list = []
-            for idx_doc in range(0, vector.num_docs):
-                HasAnswer = []
-                for i in range(batch_size):
-                    HasAnswer.append(has_answer(args, exs_with_doc[ex_id[i]]['answer'], docs_by_question[ex_id[i]][idx_doc%len(docs_by_question[ex_id[i]])]["document"]))
-                HasAnswer_list.append(HasAnswer)
-            HasAnswer_Map[idx] = HasAnswer_list
-        else:
-            HasAnswer_list = HasAnswer_Map[idx]
-
-        if (idx not in Evidence_Label):
-            Evidence_list = [-1] * batch_size
-            Evidence_Label[idx] = Evidence_list
+        HasAnswer_list = get_has_answer(args, ex_id, exs_with_doc, docs_by_question,
+                                        len(ex_with_doc))
 
         # Don't shuffle when update evidence
-        idx_random = range(vector.num_docs)
+        idx_random = range(len(ex_with_doc))
 
         HasAnswer_list_sample = []
         ex_with_doc_sample = []
@@ -363,64 +407,123 @@ def update_evidence(args, data_loader, model, global_stats, exs_with_doc, docs_b
         pred_s_list_doc = []
         pred_e_list_doc = []
         tmp_top_n = 1
-        for idx_doc in idx_random:
-            ex = ex_with_doc[idx_doc]
-            pred_s, pred_e, pred_score = model.predict(ex,top_n = tmp_top_n)
+        for pred_s, pred_e, pred_score in model.predict_docs(ex_with_doc_sample,
+                                                            top_n=tmp_top_n):
             pred_s_list = []
             pred_e_list = []
             for i in range(batch_size):
-                pred_s_list.append(pred_s[i].tolist())
-                pred_e_list.append(pred_e[i].tolist())
+                # Absent paragraphs (without --pad-docs) have no prediction
+                pred_s_list.append(pred_s[i].tolist() or [-1] * tmp_top_n)
+                pred_e_list.append(pred_e[i].tolist() or [-1] * tmp_top_n)
             pred_s_list_doc.append(torch.LongTensor(pred_s_list))
             pred_e_list_doc.append(torch.LongTensor(pred_e_list))
 
-        probs, attentions = model.update_with_doc(update_step, ex_with_doc_sample, \
+        probs, attentions = model.update_with_doc(ex_with_doc_sample, \
                                         pred_s_list_doc, pred_e_list_doc, tmp_top_n, \
                                         l_list_doc, r_list_doc, HasAnswer_list_sample, \
                                         return_prob=True)
         train_prob.update(np.mean(probs), batch_size)
         train_attention.update(np.mean(attentions[0]), batch_size)
-        update_step = (update_step + 1) % 4
 
         if idx % args.display_iter == 0:
             logger.info('Update Evidence: Epoch = %d | iter = %d/%d | ' %
                         (global_stats['epoch'], idx, len(data_loader)) +
                         'Average prob = %f | Average attention = %f | elapsed time = %.2f (s)' %
                         (train_prob.avg, train_attention.avg, global_stats['timer'].time()))
+            TELEMETRY.flush(epoch=global_stats['epoch'], step=idx)
 
         for i in range(batch_size):
-            key = "%d|%d" % (idx, i)
-            if key in Probability or key in Attention_Weight:
-                raise ValueError("%s exists in Probability or Attention_Weight" % (key))
+            seq += 1
             # Add threshold here
-            Probability[key] = probs[i]
-            Attention_Weight[key] = (attentions[0][i], attentions[1][i]) # max_value, max_index
+            if attentions[1][i] == -1 or Evidence_Label[ex_id[i]] != -1:
+                continue
+            entry = (attentions[0][i], -seq, ex_id[i], attentions[1][i], probs[i])
+            if len(evidence_heap) < Top_k:
+                heapq.heappush(evidence_heap, entry)
+            elif Top_k > 0 and entry > evidence_heap[0]:
+                heapq.heapreplace(evidence_heap, entry)
         # break
-    evidence_scores = {key: (attention[0], attention[1]) for key, attention in Attention_Weight.items() if attention[1] != -1}
-    evidence_scores = sorted(evidence_scores.items(), key=lambda x: x[1][0], reverse=True)
-    count = 0
+    # Keep the global Top_k of all processes' candidates.
+    # Padding may give a question to two processes: keep its best entry.
+    if args.world_size > 1:
+        candidates = {}
+        for heap in distributed.all_gather_object(evidence_heap):
+            for entry in heap:
+                if entry[2] not in candidates or entry > candidates[entry[2]]:
+                    candidates[entry[2]] = entry
+        evidence_heap = heapq.nlargest(Top_k, candidates.values())
     label_prob = []
     label_attention = []
-    for key, value in evidence_scores:
-        idx, i = key.split('|')
-        idx = int(idx)
-        i = int(i)
-        if Evidence_Label[idx][i] != -1:
-            continue
-        count += 1
-        Evidence_Label[idx][i] = value[1]
-        label_prob.append(Probability[key])
-        label_attention.append(Attention_Weight[key][0])
-        if count >= Top_k:
-            break
+    for attention, _, qid, max_index, prob in sorted(evidence_heap, reverse=True):
+        Evidence_Label[qid] = max_index
+        label_prob.append(prob)
+        label_attention.append(attention)
+    count = len(evidence_heap)
 
+    TELEMETRY.flush(epoch=global_stats['epoch'], step=len(data_loader))
     logger.info('Update Evidence: Epoch %d done. Time for epoch = %.2f (s). Average prob = %f. Average attention = %f.' %
-                (global_stats['epoch'], epoch_time.time(), train_prob.avg, train_attention.avg))
+                (global_stats['epoch'], epoch_time.time(), reduce_meter(train_prob), reduce_meter(train_attention)))
     logger.info('Update Evidence: Label %d examples. Average prob = %f. Average attention = %f.' %
                 (count, np.mean(label_prob), np.mean(label_attention)))
 
+def reduce_meter(meter):
+    """Average of an AverageMeter over all processes."""
+    total, count = distributed.all_reduce_sum([meter.sum, meter.count])
+    return total / max(count, 1)
+
+
+# has_answer results per question id: HasAnswer_Map[qid][idx_doc]. With
+# distributed training each process only fills in its own questions.
 HasAnswer_Map = {}
-Evidence_Label = {}
+# EvidenceLabels of the training questions, set up in main
+Evidence_Label = None
+
+
+def get_has_answer(args, ex_id, exs_with_doc, docs_by_question, num_docs):
+    """Return HasAnswer_list[idx_doc][i] for the questions ex_id of a batch
+    with num_docs paragraph slots.
+
+    Results are cached by question id, so they do not depend on the order
+    or size of the batches. Absent slots (without --pad-docs) have no answer.
+    """
+    with TELEMETRY.phase('has_answer'):
+        for qid in ex_id:
+            if qid not in HasAnswer_Map:
+                # Padding repeats paragraphs; check each one once and share
+                # the result between its slots.
+                answers, checked = [], {}
+                for doc in docs_by_question[qid][:vector.num_docs]:
+                    key = vector.paragraph_key(doc)
+                    if key not in checked:
+                        checked[key] = has_answer(
+                            args, exs_with_doc[qid]['answer'], doc["document"])
+                    answers.append(checked[key])
+                if not args.pad_docs:
+                    answers += [(False, [])] * (vector.num_docs - len(answers))
+                HasAnswer_Map[qid] = [answers[idx_doc % len(answers)]
+                                      for idx_doc in range(vector.num_docs)]
+    return [[HasAnswer_Map[qid][idx_doc] for qid in ex_id]
+            for idx_doc in range(num_docs)]
+
+
+def evidence_file(args, name):
+    return os.path.join(args.model_dir, args.model_name + '.%s' % name)
+
+
+def load_evidence(args, num_questions):
+    """Load --load_evidence_file labels, converting legacy pickles."""
+    if args.load_evidence_file == 'none':
+        return EvidenceLabels(num_questions)
+    filename = evidence_file(args, args.load_evidence_file)
+    if os.path.isfile(filename + '.npy'):
+        logger.info('Loading evidence labels from %s.npy' % filename)
+        return EvidenceLabels.load(filename + '.npy', num_questions)
+    if os.path.isfile(filename + '.pkl'):
+        return EvidenceLabels.from_legacy(filename + '.pkl', args.batch_size,
+                                          num_questions)
+    raise IOError('No such file: %s.npy' % filename)
+
+
 def pretrain_selector(args, data_loader, model, global_stats, exs_with_doc, docs_by_question):
     """Run through one epoch of model training with the provided data loader."""
     # Initialize meters + timers
@@ -430,33 +533,29 @@ def pretrain_selector(args, data_loader, model, global_stats, exs_with_doc, docs
     tot_ans = 0
     tot_num = 0
     global HasAnswer_Map
-    for idx, ex_with_doc in enumerate(data_loader):
+    TELEMETRY.loop('train', restart=True)
+    profiled = PROFILER.wrap(TELEMETRY.timed(data_loader), args.model_name,
+                             'pretrain_selector', global_stats['epoch'], model)
+    for idx, ex_with_doc in enumerate(profiled):
         if idx > 575:
             continue
+        restore_rng()
+        TELEMETRY.count_batch(ex_with_doc)
         ex = ex_with_doc[0]
         batch_size, question, ex_id = ex[0].size(0), ex[3], ex[-1]
-        if (idx not in HasAnswer_Map):
-            HasAnswer_list = []
-            for idx_doc in range(0, vector.num_docs):
-                HasAnswer = []
-                for i in range(batch_size):
-                    has_a, a_l = has_answer(args, exs_with_doc[ex_id[i]]['answer'], docs_by_question[ex_id[i]][idx_doc%len(docs_by_question[ex_id[i]])]["document"])
-                    HasAnswer.append(has_a)
-                HasAnswer_list.append(HasAnswer)
-            #HasAnswer_list = torch.LongTensor(HasAnswer_list)
-            HasAnswer_Map[idx] = HasAnswer_list
-        else:
-            HasAnswer_list = HasAnswer_Map[idx]
-        for idx_doc in range(0, vector.num_docs):
+        HasAnswer_list = [[has_a for has_a, _ in HasAnswer] for HasAnswer in
+                          get_has_answer(args, ex_id, exs_with_doc,
+                                         docs_by_question, len(ex_with_doc))]
+        for idx_doc in range(0, len(ex_with_doc)):
             for i in range(batch_size):
                 tot_ans+=HasAnswer_list[idx_doc][i]
                 tot_num+=1
 
         weights = []
-        for idx_doc in range(0, vector.num_docs):
+        for idx_doc in range(0, len(ex_with_doc)):
             weights.append(1)
         weights = torch.Tensor(weights)
-        idx_random = torch.multinomial(weights, int(vector.num_docs))
+        idx_random = torch.multinomial(weights, len(ex_with_doc))
 
         HasAnswer_list_sample = []
         ex_with_doc_sample = []
@@ -471,10 +570,14 @@ def pretrain_selector(args, data_loader, model, global_stats, exs_with_doc, docs
             logger.info('train: Epoch = %d | iter = %d/%d | ' %
                         (global_stats['epoch'], idx, len(data_loader)) +
                         'loss = %.2f | elapsed time = %.2f (s)' %
-                        (train_loss.avg, global_stats['timer'].time()))
+                        (reduce_meter(train_loss), global_stats['timer'].time()))
             logger.info("tot_ans:\t%d\t%d\t%f", tot_ans, tot_num, tot_ans*1.0/tot_num)
+            TELEMETRY.flush(epoch=global_stats['epoch'], step=idx,
+                            loss=train_loss.avg)
             train_loss.reset()
+        checkpoint_step(args, model, global_stats, data_loader, idx)
     logger.info("tot_ans:\t%d\t%d", tot_ans, tot_num)
+    TELEMETRY.flush(epoch=global_stats['epoch'], step=len(data_loader))
     logger.info('train: Epoch %d done. Time for epoch = %.2f (s)' %
                 (global_stats['epoch'], epoch_time.time()))
 
@@ -488,45 +591,54 @@ def pretrain_reader(args, data_loader, model, global_stats, exs_with_doc, docs_b
     global HasAnswer_Map
     count_ans = 0
     count_tot = 0
-    for idx, ex_with_doc in enumerate(data_loader):
+    TELEMETRY.loop('train', restart=True)
+    profiled = PROFILER.wrap(TELEMETRY.timed(data_loader), args.model_name,
+                             'pretrain_reader', global_stats['epoch'], model)
+    for idx, ex_with_doc in enumerate(profiled):
         #logger.info(idx)
+        restore_rng()
+        TELEMETRY.count_batch(ex_with_doc)
         ex = ex_with_doc[0]
         batch_size, question, ex_id = ex[0].size(0), ex[3], ex[-1]
-        if (idx not in HasAnswer_Map):
-            HasAnswer_list = []
-            for idx_doc in range(0, vector.num_docs):
-                HasAnswer = []
-                for i in range(batch_size):
-                    HasAnswer.append(has_answer(args,exs_with_doc[ex_id[i]]['answer'], docs_by_question[ex_id[i]][idx_doc%len(docs_by_question[ex_id[i]])]["document"]))
-                HasAnswer_list.append(HasAnswer)
-            HasAnswer_Map[idx] = HasAnswer_list
-        else:
-            HasAnswer_list = HasAnswer_Map[idx]
+        HasAnswer_list = get_has_answer(args, ex_id, exs_with_doc, docs_by_question,
+                                        len(ex_with_doc))
        
-        for idx_doc in range(0, vector.num_docs):
+        # Repeated paragraphs are read and trained on once
+        first = vector.unique_paragraphs(ex_with_doc)
+        preds = model.predict_docs(ex_with_doc, top_n=1)
+        for idx_doc in range(0, len(ex_with_doc)):
+            rows = np.flatnonzero(first[:, idx_doc] == idx_doc).tolist()
+            if not rows:
+                continue
             l_list = []
             r_list = []
-            pred_s, pred_e, pred_score = model.predict(ex_with_doc[idx_doc],top_n = 1)
-            for i in range(batch_size):
+            pred_s, pred_e, pred_score = preds[idx_doc]
+            for i in rows:
                 if HasAnswer_list[idx_doc][i][0]:
                     count_ans+=len(HasAnswer_list[idx_doc][i][1])
                     count_tot+=1
                     l_list.append(HasAnswer_list[idx_doc][i][1])
                 else:
                     l_list.append([(int(pred_s[i][0]),int(pred_e[i][0]))])
-            train_loss.update(*model.update(ex_with_doc[idx_doc], l_list, r_list, HasAnswer_list[idx_doc])) 
+            train_loss.update(*model.update(
+                vector.select_rows(ex_with_doc[idx_doc], rows), l_list, r_list,
+                [HasAnswer_list[idx_doc][i] for i in rows]))
         if idx % args.display_iter == 0:
             logger.info('train: Epoch = %d | iter = %d/%d | ' %
                         (global_stats['epoch'], idx, len(data_loader)) +
                         'loss = %.2f | elapsed time = %.2f (s)' %
-                        (train_loss.avg, global_stats['timer'].time()))
+                        (reduce_meter(train_loss), global_stats['timer'].time()))
+            TELEMETRY.flush(epoch=global_stats['epoch'], step=idx,
+                            loss=train_loss.avg)
             train_loss.reset()
             logger.info("%d\t%d\t%f", count_ans, count_tot, 1.0*count_ans/(count_tot+1))
+        checkpoint_step(args, model, global_stats, data_loader, idx)
+    TELEMETRY.flush(epoch=global_stats['epoch'], step=len(data_loader))
     logger.info('train: Epoch %d done. Time for epoch = %.2f (s)' %
                 (global_stats['epoch'], epoch_time.time()))
 
 def has_answer(args, answer, t):
-    global PROCESS_TOK
+    tokenizer = PROCESS_TOK or init_tokenizer()
     text = []
     for i in range(len(t)):
         text.append(t[i].lower())
@@ -540,7 +652,7 @@ def has_answer(args, answer, t):
         answer_new = ans_regex.findall(paragraph)
         for a in answer_new:
             single_answer = normalize(a[0])
-            single_answer = PROCESS_TOK.tokenize(single_answer)
+            single_answer = tokenizer.tokenize(single_answer)
             single_answer = single_answer.words(uncased=True)
             for i in range(0, len(text) - len(single_answer) + 1):
                 if single_answer == text[i: i + len(single_answer)]:
@@ -549,7 +661,7 @@ def has_answer(args, answer, t):
         for a in answer:
             single_answer = " ".join(a).lower()
             single_answer = normalize(single_answer)
-            single_answer = PROCESS_TOK.tokenize(single_answer)
+            single_answer = tokenizer.tokenize(single_answer)
             single_answer = single_answer.words(uncased=True)
             for i in range(0, len(text) - len(single_answer) + 1):
                 if single_answer == text[i: i + len(single_answer)]:
@@ -596,40 +708,35 @@ def validate_unofficial_with_doc(args, data_loader, model, global_stats, exs_wit
     bb = [0.0 for i in range(vector.num_docs)]
     aa_sum = 0.0
     display_num = 10
-    for idx, ex_with_doc in enumerate(data_loader):
+    aggregator = SpanAggregator(args.answer_aggregation)
+    outer_loop = TELEMETRY.current
+    TELEMETRY.loop('valid_' + mode, restart=True)
+    profiled = PROFILER.wrap(TELEMETRY.timed(data_loader), args.model_name,
+                             'validate', global_stats['epoch'], model, tag=mode)
+    for idx, ex_with_doc in enumerate(profiled):
+        TELEMETRY.count_batch(ex_with_doc)
         ex = ex_with_doc[0]
         batch_size, question, ex_id = ex[0].size(0), ex[3], ex[-1]
         scores_doc_num = model.predict_with_doc(ex_with_doc)
-        scores = [{} for i in range(batch_size)]
-
-        tot_sum = [0.0 for i in range(batch_size)]
-        tot_sum1 = [0.0 for i in range(batch_size)]
-        neg_sum = [0.0 for i in range(batch_size)]
-        min_sum = [[] for i in range(batch_size)]
-        min_sum1 =[[] for i in range(batch_size)]
-        
-        for idx_doc in range(0, vector.num_docs):
-            ex = ex_with_doc[idx_doc]
-            pred_s, pred_e, pred_score = model.predict(ex,top_n = 10)
+        aggregator.reset()
+        spans = []
+
+        preds = model.predict_docs(ex_with_doc, top_n=10)
+        for idx_doc in range(0, len(ex_with_doc)):
+            pred_s, pred_e, pred_score = preds[idx_doc]
             for i in range(batch_size):
                 doc_text = docs_by_question[ex_id[i]][idx_doc%len(docs_by_question[ex_id[i]])]["document"]
-                has_answer_t = has_answer(args, exs_with_doc[ex_id[i]]['answer'], doc_text)
-
-                for k in range(10):
-                    try:
-                        prediction = []
-                        for j in range(pred_s[i][k], pred_e[i][k]+1):
-                            prediction.append(doc_text[j])
-                        prediction = " ".join(prediction).lower()
-                        if (prediction not in scores[i]):
-                            scores[i][prediction] = 0
-                        scores[i][prediction] += pred_score[i][k]*scores_doc_num[i][idx_doc]
-                    except:
-                        pass
+                aggregator.add(i, doc_text, pred_s[i], pred_e[i], pred_score[i],
+                               float(scores_doc_num[i][idx_doc]))
+                spans.extend((doc_text, s, e) for s, e in zip(pred_s[i], pred_e[i]))
+        with TELEMETRY.phase('aggregate'):
+            best = aggregator.best()
         for i in range(batch_size):
             _, indices = scores_doc_num[i].sort(0, descending = True)
-            for j in range(0, display_num):
+            for j in range(0, min(display_num, len(indices))):
                 idx_doc = indices[j]
+                if idx_doc >= len(docs_by_question[ex_id[i]]):
+                    continue  # absent paragraph (without --pad-docs)
                 doc_text = docs_by_question[ex_id[i]][idx_doc%len(docs_by_question[ex_id[i]])]["document"]
                 if (has_answer(args, exs_with_doc[ex_id[i]]['answer'], doc_text)[0]):
 
@@ -638,13 +745,11 @@ def validate_unofficial_with_doc(args, data_loader, model, global_stats, exs_wit
 
         for i in range(batch_size):
             
-            best_score = 0
             prediction = ""
-            for key in scores[i]:
-                if (scores[i][key]>best_score):
-                    best_score = scores[i][key]
-                    prediction = key
-            
+            if i in best and best[i][0][0] > 0:
+                doc_text, s, e = spans[best[i][0][1]]
+                prediction = " ".join(doc_text[s:e+1]).lower()
+
             # Compute metrics
             ground_truths = []
             answer = exs_with_doc[ex_id[i]]['answer']
@@ -659,11 +764,19 @@ def validate_unofficial_with_doc(args, data_loader, model, global_stats, exs_wit
                 utils.exact_match_score, prediction, ground_truths))
             f1.update(utils.metric_max_over_ground_truths(
                 utils.f1_score, prediction, ground_truths))
-            a = sorted(scores[i].items(), key=lambda d: d[1], reverse = True) 
 
         examples += batch_size
         if (mode=="train" and examples>=1000):
             break
+    profiled.close()  # ends profiling now if the loop stopped early
+    if args.world_size > 1:
+        totals = distributed.all_reduce_sum(
+            [exact_match.sum, f1.sum, exact_match.count, examples] + aa + bb)
+        count = max(totals[2], 1)
+        exact_match.avg, f1.avg = totals[0] / count, totals[1] / count
+        examples = int(totals[3])
+        aa = totals[4:4 + vector.num_docs].tolist()
+        bb = totals[4 + vector.num_docs:].tolist()
     try:
         for j in range(0, display_num):
             if (j>0):
@@ -676,6 +789,9 @@ def validate_unofficial_with_doc(args, data_loader, model, global_stats, exs_wit
                 (mode, global_stats['epoch'], exact_match.avg * 100) +
                 'F1 = %.2f | examples = %d | valid time = %.2f (s)' %
                 (f1.avg * 100, examples, eval_time.time()))
+    TELEMETRY.flush(epoch=global_stats['epoch'], exact_match=exact_match.avg * 100,
+                    f1=f1.avg * 100)
+    TELEMETRY.loop(outer_loop)
 
     return {'exact_match': exact_match.avg * 100, 'f1': f1.avg * 100}
 
@@ -721,9 +837,8 @@ def eval_accuracies(pred_s, target_s, pred_e, target_e):
 # ------------------------------------------------------------------------------
 
 
-def read_data(filename, keys):
-    res = []
-    step = 0
+def iter_data(filename):
+    """Tokenized questions and answers of filename, one per line."""
     for line in open(filename):
         data = json.loads(line)
         if ('squad' in filename or 'webquestions' in filename):
@@ -734,25 +849,120 @@ def read_data(filename, keys):
             else:
                 answer = [tokenize_text(a).words() for a in data['answers']]
         question = " ".join(tokenize_text(data['question']).words())
-        res.append({"answer":answer, "question":question})
-        step+=1
-    return res
+        yield {"answer":answer, "question":question}
+
+
+def read_data(filename, keys):
+    return list(iter_data(filename))
+
+
+def load_questions(args, filename, keys):
+    """Questions of filename; with --stream-data as a data.JsonlDataset.
+
+    Streamed questions are tokenized once into <filename>.tok.jsonl, so
+    later runs need neither the memory for all questions nor the tokenizer.
+    """
+    if not args.stream_data:
+        return read_data(filename, keys)
+    tokenized = filename + '.tok.jsonl'
+    if (not os.path.isfile(tokenized) or
+            os.path.getmtime(tokenized) < os.path.getmtime(filename)):
+        logger.info('Tokenizing %s' % filename)
+        tmp = '%s.tmp.%d' % (tokenized, os.getpid())
+        with open(tmp, 'w') as f:
+            for ex in iter_data(filename):
+                f.write(json.dumps(ex) + '\n')
+        os.replace(tmp, tokenized)
+    return data.JsonlDataset(tokenized, cache_size=args.stream_cache_size)
     
 
 def tokenize_text(text):
-    global PROCESS_TOK
-    return PROCESS_TOK.tokenize(text)
+    return (PROCESS_TOK or init_tokenizer()).tokenize(text)
 
-def main(args):
-    # --------------------------------------------------------------------------
-    # TOK
+# ------------------------------------------------------------------------------
+# Checkpointing.
+# ------------------------------------------------------------------------------
+
+# RNG state of a resumed checkpoint, restored at the first training batch
+# (after the data loader iterator has been created).
+RESUME_RNG = None
+
+
+def get_rng_state(args):
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state() if args.cuda else None,
+    }
+
+
+def restore_rng():
+    global RESUME_RNG
+    if RESUME_RNG is None:
+        return
+    random.setstate(RESUME_RNG['python'])
+    np.random.set_state(RESUME_RNG['numpy'])
+    torch.set_rng_state(RESUME_RNG['torch'])
+    if RESUME_RNG['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state(RESUME_RNG['cuda'])
+    RESUME_RNG = None
+
+
+def save_checkpoint(args, model, global_stats, epoch, position):
+    """Atomically checkpoint the model and all training state.
+
+    position is the number of examples of epoch already trained on. Only
+    the master process writes (replicas are identical).
+    """
+    if not distributed.is_master():
+        return
+    train_state = {
+        'position': position,
+        'best_valid': global_stats['best_valid'],
+        'evidence': np.array(Evidence_Label.labels),
+        'has_answer': HasAnswer_Map,
+        'rng': get_rng_state(args),
+    }
+    model.checkpoint(args.model_file + '.checkpoint', epoch, train_state)
+    logger.info('Checkpoint: epoch %d, example %d' % (epoch, position))
+
+
+def checkpoint_step(args, model, global_stats, data_loader, idx):
+    """Checkpoint every --checkpoint-steps batches of an epoch."""
+    if args.checkpoint_steps > 0 and (idx + 1) % args.checkpoint_steps == 0:
+        position = (data_loader.sampler.start +
+                    (idx + 1) * args.batch_size * args.world_size)
+        save_checkpoint(args, model, global_stats, global_stats['epoch'],
+                        min(position, len(data_loader.dataset)))
+
+
+def restore_train_state(train_state):
+    """Restore what save_checkpoint stored besides the model."""
+    global Evidence_Label, RESUME_RNG
+    Evidence_Label = EvidenceLabels(labels=train_state['evidence'])
+    HasAnswer_Map.update(train_state['has_answer'])
+    RESUME_RNG = train_state['rng']
+
+
+def init_tokenizer():
+    """Start the CoreNLP tokenizer used by read_data and has_answer.
+
+    Called on first use, so runs that never tokenize (e.g. cached answers,
+    evaluation of preprocessed data) do not start a JVM.
+    """
     global PROCESS_TOK
+    if PROCESS_TOK is not None:
+        return PROCESS_TOK
     tok_class = tokenizers.get_class("corenlp")
     tok_opts = {}
     PROCESS_TOK = tok_class(**tok_opts)
     Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
+    return PROCESS_TOK
+
 
-    # DATA
+def load_datasets(args):
+    """Load the paragraphs and questions of the train/dev/test splits."""
     logger.info('-' * 100)
     logger.info('Load data files')
     dataset = args.dataset#'quasart'#'searchqa'#'unftriviaqa'#'squad'#
@@ -763,31 +973,41 @@ def main(args):
     logger.info(len(train_docs))
     filename_train = sys_dir+"/data/datasets/"+dataset+"/train.txt" 
     filename_dev = sys_dir+"/data/datasets/"+dataset+"/dev.txt" 
-    train_exs_with_doc = read_data(filename_train, train_questions)
+    train_exs_with_doc = load_questions(args, filename_train, train_questions)
 
     logger.info('Num train examples = %d' % len(train_exs_with_doc))
 
     dev_docs, dev_questions = utils.load_data_with_doc(args, filename_dev_docs)
     logger.info(len(dev_docs))
-    dev_exs_with_doc = read_data(filename_dev, dev_questions)
+    dev_exs_with_doc = load_questions(args, filename_dev, dev_questions)
     logger.info('Num dev examples = %d' % len(dev_exs_with_doc))
 
     test_docs, test_questions = utils.load_data_with_doc(args, filename_test_docs)
     logger.info(len(test_docs))
-    test_exs_with_doc = read_data(sys_dir+"/data/datasets/"+dataset+"/test.txt", test_questions)
+    test_exs_with_doc = load_questions(args, sys_dir+"/data/datasets/"+dataset+"/test.txt", test_questions)
     logger.info('Num dev examples = %d' % len(test_exs_with_doc))
-  
-    # --------------------------------------------------------------------------
-    # MODEL
+    return {
+        'train': (train_exs_with_doc, train_docs),
+        'dev': (dev_exs_with_doc, dev_docs),
+        'test': (test_exs_with_doc, test_docs),
+    }
+
+
+def build_model(args, datasets):
+    """Load the checkpoint or pretrained model, or start from scratch.
+
+    Returns the model, the epoch to start from and the training state saved
+    with the checkpoint (None if starting fresh).
+    """
     logger.info('-' * 100)
+    train_docs = datasets['train'][1]
     start_epoch = 0
+    train_state = None
     if args.checkpoint and os.path.isfile(args.model_file + '.checkpoint'):
         # Just resume training, no modifications.
         logger.info('Found a checkpoint...')
         checkpoint_file = args.model_file + '.checkpoint'
-        model, start_epoch = DocReader.load_checkpoint(checkpoint_file)
-        #model = DocReader.load(checkpoint_file, args)
-        start_epoch = 0
+        model, start_epoch, train_state = DocReader.load_checkpoint(checkpoint_file)
     else:
         # Training starts fresh. But the model state is either pretrained or
         # newly (randomly) initialized.
@@ -817,16 +1037,26 @@ def main(args):
     # Use multiple GPUs?
     if args.parallel:
         model.parallelize()
+    if args.world_size > 1:
+        model.distribute()
+    return model, start_epoch, train_state
 
-    # --------------------------------------------------------------------------
-    # DATA ITERATORS
-    # Two datasets: train and dev. If we sort by length it's faster.
+
+def make_data_loaders(args, model, datasets):
+    """Build the train/dev/test data loaders."""
     logger.info('-' * 100)
     logger.info('Make data loaders')
+    train_exs_with_doc, train_docs = datasets['train']
+    dev_exs_with_doc, dev_docs = datasets['dev']
+    test_exs_with_doc, test_docs = datasets['test']
 
+    # The dictionary is fixed from here on; the loaders encode with it
+    model.word_dict.freeze()
 
-    train_dataset_with_doc = data.ReaderDataset_with_Doc(train_exs_with_doc, model, train_docs, single_answer=True)
-    train_sampler_with_doc = torch.utils.data.sampler.SequentialSampler(train_dataset_with_doc)
+    train_dataset_with_doc = data.ReaderDataset_with_Doc(train_exs_with_doc, model, train_docs, single_answer=True,
+                                                         pad_docs=args.pad_docs)
+    train_sampler_with_doc = data.ResumableSampler(train_dataset_with_doc, args.shuffle, args.random_seed,
+                                                   args.world_size, args.rank)
     train_loader_with_doc = torch.utils.data.DataLoader(
         train_dataset_with_doc,
         batch_size=args.batch_size,
@@ -836,8 +1066,9 @@ def main(args):
         pin_memory=args.cuda,
     )
 
-    dev_dataset_with_doc = data.ReaderDataset_with_Doc(dev_exs_with_doc, model, dev_docs, single_answer=False)
-    dev_sampler_with_doc = torch.utils.data.sampler.SequentialSampler(dev_dataset_with_doc)
+    dev_dataset_with_doc = data.ReaderDataset_with_Doc(dev_exs_with_doc, model, dev_docs, single_answer=False,
+                                                       pad_docs=args.pad_docs)
+    dev_sampler_with_doc = data.ShardedSampler(dev_dataset_with_doc, args.world_size, args.rank)
     dev_loader_with_doc = torch.utils.data.DataLoader(
         dev_dataset_with_doc,
         batch_size=args.test_batch_size,
@@ -847,8 +1078,9 @@ def main(args):
         pin_memory=args.cuda,
     )
 
-    test_dataset_with_doc = data.ReaderDataset_with_Doc(test_exs_with_doc, model, test_docs, single_answer=False)
-    test_sampler_with_doc = torch.utils.data.sampler.SequentialSampler(test_dataset_with_doc)
+    test_dataset_with_doc = data.ReaderDataset_with_Doc(test_exs_with_doc, model, test_docs, single_answer=False,
+                                                        pad_docs=args.pad_docs)
+    test_sampler_with_doc = data.ShardedSampler(test_dataset_with_doc, args.world_size, args.rank)
     test_loader_with_doc = torch.utils.data.DataLoader(
        test_dataset_with_doc,
        batch_size=args.test_batch_size,
@@ -857,22 +1089,39 @@ def main(args):
        collate_fn=vector.batchify_with_docs,
        pin_memory=args.cuda,
     )
+    return {
+        'train': train_loader_with_doc,
+        'dev': dev_loader_with_doc,
+        'test': test_loader_with_doc,
+    }
 
-    # -------------------------------------------------------------------------
-    # PRINT CONFIG
-    logger.info('-' * 100)
-    logger.info('CONFIG:\n%s' %
-                json.dumps(vars(args), indent=4, sort_keys=True))
 
-    # --------------------------------------------------------------------------
-    # TRAIN/VALID LOOP
+def train_model(args, model, loaders, datasets, start_epoch=0, train_state=None):
+    """Train for args.num_epochs, saving the best model to args.model_file.
+
+    train_state (from a checkpoint) resumes start_epoch at its saved batch.
+    """
+    train_exs_with_doc, train_docs = datasets['train']
+    dev_exs_with_doc, dev_docs = datasets['dev']
+    test_exs_with_doc, test_docs = datasets['test']
+    train_loader_with_doc = loaders['train']
+    dev_loader_with_doc = loaders['dev']
+    test_loader_with_doc = loaders['test']
+    dataset = args.dataset
+
     logger.info('-' * 100)
     logger.info('Starting training...')
     stats = {'timer': utils.Timer(), 'epoch': 0, 'best_valid': 0}
+    position = 0
+    if train_state is not None:
+        restore_train_state(train_state)
+        stats['best_valid'] = train_state['best_valid']
+        position = train_state['position']
+        logger.info('Resuming epoch %d at example %d' % (start_epoch, position))
 
-          
     for epoch in range(start_epoch, args.num_epochs):
         stats['epoch'] = epoch
+        train_loader_with_doc.sampler.set_epoch(epoch, position if epoch == start_epoch else 0)
 
         # Train
         if (args.mode == 'all'):
@@ -881,7 +1130,8 @@ def main(args):
             pretrain_reader(args, train_loader_with_doc, model, stats, train_exs_with_doc, train_docs)
         if (args.mode == 'selector'):
             pretrain_selector(args, train_loader_with_doc, model, stats, train_exs_with_doc, train_docs)
-        
+        train_loader_with_doc.sampler.set_epoch(epoch)
+
         result = validate_unofficial_with_doc(args, dev_loader_with_doc, model, stats, dev_exs_with_doc, dev_docs, 'dev')
         validate_unofficial_with_doc(args, train_loader_with_doc, model, stats, train_exs_with_doc, train_docs, 'train')
         if (dataset=='webquestions' or dataset=='CuratedTrec'):
@@ -892,15 +1142,146 @@ def main(args):
             logger.info('Best valid: %s = %.2f (epoch %d, %d updates)' %
                         (args.valid_metric, result[args.valid_metric],
                          stats['epoch'], model.updates))
-            model.save(args.model_file)
+            if distributed.is_master():
+                model.save(args.model_file)
 
             stats['best_valid'] = result[args.valid_metric]
 
+        # Checkpoint
+        if args.checkpoint:
+            save_checkpoint(args, model, stats, epoch + 1, 0)
+    return stats
+
+
+def snapshot_model(model):
+    """Copy of the network and selector weights, to restart rounds from."""
+    return {
+        'network': {k: v.clone() for k, v in model.network.state_dict().items()},
+        'selector': {k: v.clone() for k, v in model.selector.state_dict().items()},
+    }
+
+
+def restore_model(model, snapshot):
+    """Reset the model to a snapshot_model copy with a fresh optimizer."""
+    model.network.load_state_dict(snapshot['network'])
+    model.selector.load_state_dict(snapshot['selector'])
+    model.updates = 0
+    model.init_optimizer()
+
+
+def resume_model(model, checkpoint_file):
+    """Load a checkpoint into model in place; returns (epoch, train_state).
+
+    The data loaders hold on to model, so it is updated rather than
+    replaced by the one DocReader.load_checkpoint builds.
+    """
+    saved, epoch, train_state = DocReader.load_checkpoint(checkpoint_file)
+    network = model.network.module if model.parallel else model.network
+    network.load_state_dict(saved.network.state_dict())
+    model.selector.load_state_dict(saved.selector.state_dict())
+    model.updates = saved.updates
+    model.init_optimizer(saved.optimizer.state_dict())
+    return epoch, train_state
+
+
+def round_file(args, model_name, round_idx):
+    """Path of self-training round round_idx's files, without extension."""
+    return os.path.join(args.model_dir, '%s.round%d' % (model_name, round_idx))
+
+
+def completed_rounds(args, model_name):
+    """Number of leading self-training rounds whose labels were saved."""
+    rounds = 0
+    while (rounds < args.self_training_rounds and
+           os.path.isfile(round_file(args, model_name, rounds) + '.npy')):
+        rounds += 1
+    return rounds
+
+
+def self_training(args, model, loaders, datasets):
+    """Run args.self_training_rounds rounds of training + evidence labeling.
+
+    Everything stays in memory between rounds: data, tokenizer, the
+    has_answer cache and the evidence labels. Like separate main.py runs
+    each round restarts from the initial model, trains on all the labels
+    so far and adds args.top_k new ones. Round r writes
+    <model-name>.round<r>.mdl and <model-name>.round<r>.npy.
+
+    With --checkpoint a restarted run skips the rounds whose .npy labels
+    exist, starting from the last one's labels, and resumes an interrupted
+    round from its <model-name>.round<r>.mdl.checkpoint.
+    """
+    global Evidence_Label
+    train_exs_with_doc, train_docs = datasets['train']
+    initial = snapshot_model(model)
+    model_name = args.model_name
+    start_round = completed_rounds(args, model_name) if args.checkpoint else 0
+    if start_round > 0:
+        labels_file = round_file(args, model_name, start_round - 1) + '.npy'
+        Evidence_Label = EvidenceLabels.load(labels_file,
+                                             len(train_exs_with_doc))
+        logger.info('Skipping %d completed self-training rounds; labels '
+                    'from %s' % (start_round, labels_file))
+    for round_idx in range(start_round, args.self_training_rounds):
+        logger.info('-' * 100)
+        logger.info('Self-training round %d/%d (%d evidence labels)' %
+                    (round_idx + 1, args.self_training_rounds,
+                     Evidence_Label.num_labeled()))
+        if round_idx > 0:
+            restore_model(model, initial)
+        args.model_name = '%s.round%d' % (model_name, round_idx)
+        args.model_file = round_file(args, model_name, round_idx) + '.mdl'
+        start_epoch, train_state = 0, None
+        checkpoint_file = args.model_file + '.checkpoint'
+        if args.checkpoint and os.path.isfile(checkpoint_file):
+            logger.info('Resuming round %d from %s' %
+                        (round_idx + 1, checkpoint_file))
+            start_epoch, train_state = resume_model(model, checkpoint_file)
+        stats = train_model(args, model, loaders, datasets, start_epoch,
+                            train_state)
+        update_evidence(args, loaders['train'], model, stats, train_exs_with_doc, train_docs)
+        if distributed.is_master():
+            Evidence_Label.save(round_file(args, model_name, round_idx) + '.npy')
+    args.model_name = model_name
+
+
+def main(args):
+    # --------------------------------------------------------------------------
+    # DATA (the tokenizer is started on first use)
+    datasets = load_datasets(args)
+    global Evidence_Label
+    Evidence_Label = load_evidence(args, len(datasets['train'][0]))
+    logger.info('Num evidence labels = %d' % Evidence_Label.num_labeled())
+  
+    # --------------------------------------------------------------------------
+    # MODEL
+    model, start_epoch, train_state = build_model(args, datasets)
+
+    # --------------------------------------------------------------------------
+    # DATA ITERATORS
+    # Two datasets: train and dev. If we sort by length it's faster.
+    loaders = make_data_loaders(args, model, datasets)
+
+    # -------------------------------------------------------------------------
+    # PRINT CONFIG
+    logger.info('-' * 100)
+    logger.info('CONFIG:\n%s' %
+                json.dumps(vars(args), indent=4, sort_keys=True))
+
+    if args.self_training_rounds > 0:
+        self_training(args, model, loaders, datasets)
+        return
+
+    # --------------------------------------------------------------------------
+    # TRAIN/VALID LOOP
+    stats = train_model(args, model, loaders, datasets, start_epoch, train_state)
+
     #Update evidence label
     if args.save_evidence_file != 'none':
-        model.load(args.model_file)
-        update_evidence(args, train_loader_with_doc, model, stats, train_exs_with_doc, train_docs)
-        pickle.dump(Evidence_Label, open(os.path.join(args.model_dir, args.model_name + '.%s.pkl' % (args.save_evidence_file)), 'wb'))
+        train_exs_with_doc, train_docs = datasets['train']
+        update_evidence(args, loaders['train'], model, stats, train_exs_with_doc, train_docs)
+        if distributed.is_master():
+            Evidence_Label.save(evidence_file(args, args.save_evidence_file) + '.npy')
 
 def split_doc(doc):
     """Given a doc, split it into chunks (by paragraph)."""
@@ -922,24 +1303,32 @@ def split_doc(doc):
         yield ' '.join(curr)
 
 
-if __name__ == '__main__':
-    # Parse cmdline args and setup environment
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         'DrQA Document Reader',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     add_train_args(parser)
     config.add_model_args(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     set_defaults(args)
+    return args
 
+
+def setup(args):
+    """Set up cuda, random state and logging for a run."""
     # os.environ["CUDA_VISIBLE_DEVICES"]=str(args.gpu)
-    if args.load_evidence_file != 'none':
-        Evidence_Label = pickle.load(open(os.path.join(args.model_dir, args.model_name + '.%s.pkl' % (args.load_evidence_file)), 'rb'))
+
+    # Join the process group if started by a distributed launcher
+    args.rank, args.world_size = distributed.init(args.dist_backend)
+    if args.world_size > 1 and args.parallel:
+        raise RuntimeError('--parallel cannot be used with distributed training')
 
     # Set cuda
     args.cuda = not args.no_cuda and torch.cuda.is_available()
     if args.cuda:
+        if args.world_size > 1:
+            args.gpu = int(os.environ.get('LOCAL_RANK', args.local_rank))
         torch.cuda.set_device(args.gpu)
 
     # Set random state
@@ -948,14 +1337,14 @@ if __name__ == '__main__':
     if args.cuda:
         torch.cuda.manual_seed(args.random_seed)
 
-    # Set logging
-    logger.setLevel(logging.INFO)
+    # Set logging (only the master process logs progress)
+    logger.setLevel(logging.INFO if args.rank == 0 else logging.WARNING)
     fmt = logging.Formatter('%(asctime)s: [ %(message)s ]',
                             '%m/%d/%Y %I:%M:%S %p')
     console = logging.StreamHandler()
     console.setFormatter(fmt)
     logger.addHandler(console)
-    if args.log_file:
+    if args.log_file and args.rank == 0:
         if args.checkpoint:
             logfile = logging.FileHandler(args.log_file, 'a')
         else:
@@ -964,5 +1353,20 @@ if __name__ == '__main__':
         logger.addHandler(logfile)
     logger.info('COMMAND: %s' % ' '.join(sys.argv))
 
+    # Phase timings and throughput (master process only)
+    if args.telemetry_file and args.rank == 0:
+        TELEMETRY.open(args.telemetry_file, args.telemetry_format)
+
+    # Profiling of selected batches (master process only)
+    if args.profile_steps and args.rank == 0:
+        PROFILER.configure(args.model_dir, args.profile_steps, args.profile_loops,
+                           args.profilers, args.cuda)
+
+
+if __name__ == '__main__':
+    # Parse cmdline args and setup environment
+    args = parse_args()
+    setup(args)
+
     # Run!
     main(args)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Benchmark DocDB size and fetch throughput across storage layouts.
+
+Compresses a source db (--db, or a synthetic one) with each codec and
+reports file size, single-document and batched fetch throughput.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../..'))
+
+from src.retriever import DocDB
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compress_doc_db import compress_db
+
+logger = logging.getLogger()
+
+
+def build_synthetic_db(path, num_docs, doc_len, vocab_size=50000, seed=0):
+    """Documents of Zipf-distributed words with some repeated boilerplate."""
+    rng = np.random.RandomState(seed)
+    words = np.array(['w%d' % i for i in range(vocab_size)])
+    probs = 1.0 / np.arange(1, vocab_size + 1)
+    probs /= probs.sum()
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE documents (id PRIMARY KEY, text);")
+    for start in range(0, num_docs, 1000):
+        rows = []
+        for i in range(start, min(start + 1000, num_docs)):
+            n = max(1, rng.poisson(doc_len))
+            text = ' '.join(words[rng.choice(vocab_size, n, p=probs)])
+            rows.append(('doc%d' % i, 'Doc %d\n\n%s' % (i, text)))
+        connection.executemany("INSERT INTO documents VALUES (?,?)", rows)
+    connection.commit()
+    connection.close()
+
+
+def fetch_throughput(path, doc_ids, batch_size):
+    with DocDB(path) as db:
+        start = time.time()
+        for doc_id in doc_ids:
+            db.get_doc_text(doc_id)
+        single = len(doc_ids) / (time.time() - start)
+
+        start = time.time()
+        for i in range(0, len(doc_ids), batch_size):
+            db.get_doc_texts(doc_ids[i:i + batch_size])
+        batched = len(doc_ids) / (time.time() - start)
+    return single, batched
+
+
+def main(args):
+    tmp_dir = tempfile.mkdtemp()
+    if args.db:
+        source = args.db
+    else:
+        source = os.path.join(tmp_dir, 'none.db')
+        logger.info('Building synthetic db (%d docs)' % args.num_docs)
+        build_synthetic_db(source, args.num_docs, args.doc_len)
+
+    with DocDB(source) as db:
+        all_ids = db.get_doc_ids()
+    rng = np.random.RandomState(1)
+    doc_ids = [all_ids[i] for i in
+               rng.randint(0, len(all_ids), args.num_fetches)]
+
+    layouts = [('none', source)]
+    for codec, dict_size in [('zlib', 0), ('zlib', 32768), ('lzma', 0)]:
+        name = codec + ('+dict' if dict_size else '')
+        path = os.path.join(tmp_dir, name + '.db')
+        logger.info('Compressing with %s' % name)
+        compress_db(source, path, codec, dict_size=dict_size)
+        layouts.append((name, path))
+
+    results = []
+    for name, path in layouts:
+        single, batched = fetch_throughput(path, doc_ids, args.batch_size)
+        row = {'layout': name, 'size_mb': os.path.getsize(path) / 2 ** 20,
+               'docs_per_sec': single, 'batched_docs_per_sec': batched}
+        results.append(row)
+        logger.info('%-10s | size %8.1f MB | %9.0f docs/s | %9.0f docs/s '
+                    '(batches of %d)' % (name, row['size_mb'], single,
+                                         batched, args.batch_size))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default=None,
+                        help='Existing uncompressed docs.db')
+    parser.add_argument('--num-docs', type=int, default=50000,
+                        help='Synthetic db: number of documents')
+    parser.add_argument('--doc-len', type=int, default=300,
+                        help='Synthetic db: mean words per document')
+    parser.add_argument('--num-fetches', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]',
+                            '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    main(args)
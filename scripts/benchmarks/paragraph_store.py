@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Memory of the paragraphs as lists of dicts vs. a ParagraphStore (Linux).
+
+For each representation, a fresh process loads a train.json-style file
+with utils.load_data_with_doc and reports its RSS growth and load time.
+It then reads the document of every paragraph through a DataLoader with
+--workers forked workers, as vectorize_with_doc does, and reports the
+memory each worker had to copy from its parent (Private_Dirty).
+
+    python scripts/benchmarks/paragraph_store.py --data data/datasets/searchqa/train.json
+
+Without --data, a synthetic file of --num-questions questions is used.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../..'))
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from src.reader import utils
+
+logger = logging.getLogger()
+
+MODES = ('dicts', 'store')
+
+
+def memory_kb(field, filename):
+    """Value in kB of field in a /proc status-like file (None if absent)."""
+    try:
+        with open(filename) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def rss_kb():
+    return memory_kb('VmRSS', '/proc/self/status')
+
+
+def private_dirty_kb():
+    return memory_kb('Private_Dirty', '/proc/self/smaps_rollup')
+
+
+class TouchDataset(Dataset):
+    """Reads every paragraph of a question; returns the worker's memory."""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __getitem__(self, index):
+        tokens = sum(len(p['document']) for p in self.docs[index])
+        worker = torch.utils.data.get_worker_info()
+        return (worker.id if worker else 0), private_dirty_kb(), tokens
+
+
+def collate(batch):
+    return batch
+
+
+def measure(args):
+    """Run in a fresh process: load args.data as args.measure."""
+    load_args = argparse.Namespace(
+        uncased_question=False, uncased_doc=False, stream_data=False,
+        pad_docs=True,
+        compact_data=args.measure == 'store',
+    )
+    before = rss_kb()
+    start = time.perf_counter()
+    docs, _ = utils.load_data_with_doc(load_args, args.data)
+    load_s = time.perf_counter() - start
+    after = rss_kb()
+
+    loader = DataLoader(TouchDataset(docs), batch_size=args.batch_size,
+                        num_workers=args.workers, collate_fn=collate)
+    start = time.perf_counter()
+    worker_kb, tokens = {}, 0
+    for batch in loader:
+        for worker, kb, n in batch:
+            worker_kb[worker] = max(worker_kb.get(worker, 0), kb or 0)
+            tokens += n
+    iterate_s = time.perf_counter() - start
+    return {
+        'questions': len(docs),
+        'tokens_read': tokens,
+        'load_s': load_s,
+        'rss_mb': (after - before) / 1024.0,
+        'iterate_s': iterate_s,
+        'worker_private_dirty_mb': [worker_kb[w] / 1024.0
+                                    for w in sorted(worker_kb)],
+    }
+
+
+def write_synthetic(filename, num_questions, seed):
+    """Write synthetic questions (see reader_hotpaths) as train.json lines."""
+    from reader_hotpaths import build_synthetic_data
+    _, docs, _ = build_synthetic_data(num_questions, 50000, 60, 12, seed)
+    with open(filename, 'w') as f:
+        for paragraphs in docs:
+            f.write(json.dumps(paragraphs) + '\n')
+
+
+def main(args):
+    tmp = None
+    if not args.data:
+        tmp = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        tmp.close()
+        logger.info('Writing %d synthetic questions to %s' %
+                    (args.num_questions, tmp.name))
+        write_synthetic(tmp.name, args.num_questions, args.seed)
+        args.data = tmp.name
+    logger.info('Data: %s (%.1f MB)' %
+                (args.data, os.path.getsize(args.data) / 1e6))
+
+    results = {'data': args.data, 'workers': args.workers, 'modes': {}}
+    try:
+        for mode in MODES:
+            output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), '--data', args.data,
+                '--measure', mode, '--workers', str(args.workers),
+                '--batch-size', str(args.batch_size),
+            ])
+            stats = json.loads(output.decode('utf-8').splitlines()[-1])
+            results['modes'][mode] = stats
+            logger.info('%-6s load %7.1f s | RSS +%8.1f MB | iterate %6.1f s'
+                        ' | worker private dirty %s MB' %
+                        (mode, stats['load_s'], stats['rss_mb'],
+                         stats['iterate_s'],
+                         ', '.join('%.1f' % mb for mb in
+                                   stats['worker_private_dirty_mb'])))
+    finally:
+        if tmp is not None:
+            os.remove(tmp.name)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default=None,
+                        help='train.json-style file (one question per line)')
+    parser.add_argument('--num-questions', type=int, default=2000,
+                        help='Synthetic questions to use without --data')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='DataLoader worker processes')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write results as JSON to this file')
+    parser.add_argument('--measure', type=str, default=None, choices=MODES,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args)))
+        sys.exit(0)
+
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]',
+                            '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    main(args)
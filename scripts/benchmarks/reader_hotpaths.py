@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the reader hot paths on synthetic data (CPU).
+
+Generates Quasar-T/SearchQA shaped questions (vector.num_docs paragraphs
+each, lognormal paragraph lengths, Zipf vocabulary) and times vectorize1,
+vectorize_docs, batchify_with_docs, StackedBRNN padded vs unpadded,
+SeqAttnMatch, DocReader.decode, has_answer, f1_score and a full update_with_doc step.
+
+Results are written as JSON (--out). Given --baseline (a previous --out
+from the same machine and config), benchmarks slower than the baseline by
+more than --tolerance are reported and the script exits with status 1:
+
+    python scripts/benchmarks/reader_hotpaths.py --out baseline.json
+    python scripts/benchmarks/reader_hotpaths.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../..'))
+
+import main as openqa
+from src.reader import config, layers, utils, vector
+from src.reader import DocReader
+from src.reader.data import Dictionary
+from src.tokenizers import SimpleTokenizer
+
+logger = logging.getLogger()
+
+
+# ------------------------------------------------------------------------------
+# Synthetic data
+# ------------------------------------------------------------------------------
+
+
+def build_synthetic_data(num_questions, vocab_size, doc_len, question_len,
+                         seed=0):
+    """Questions with vector.num_docs paragraphs each.
+
+    Words are Zipf distributed, paragraph lengths lognormal with mean
+    doc_len. About half of the paragraphs contain the 1-3 word answer.
+    Returns (examples, docs, words) shaped like main.load_datasets output.
+    """
+    rng = np.random.RandomState(seed)
+    words = np.array(['w%d' % i for i in range(vocab_size)])
+    probs = 1.0 / np.arange(1, vocab_size + 1)
+    probs /= probs.sum()
+
+    def sample(n):
+        return words[rng.choice(vocab_size, n, p=probs)].tolist()
+
+    exs, docs = [], []
+    for qid in range(num_questions):
+        question = sample(max(3, rng.poisson(question_len)))
+        answer = sample(rng.randint(1, 4))
+        paragraphs = []
+        for _ in range(vector.num_docs):
+            length = int(max(5, rng.lognormal(np.log(doc_len) - 0.125, 0.5)))
+            document = sample(length)
+            if rng.rand() < 0.5 and length > len(answer):
+                start = rng.randint(0, length - len(answer))
+                document[start:start + len(answer)] = answer
+            paragraphs.append({
+                'question': question, 'qlemma': question,
+                'document': document, 'lemma': document,
+                'pos': document, 'ner': document,
+            })
+        exs.append({'question': question, 'answer': [answer]})
+        docs.append(paragraphs)
+    return exs, docs, words.tolist()
+
+
+def build_model(args, words):
+    """A randomly initialized DocReader over words."""
+    parser = argparse.ArgumentParser()
+    config.add_model_args(parser)
+    model_args = parser.parse_args([
+        '--embedding-dim', str(args.embedding_dim),
+        '--hidden-size', str(args.hidden_size),
+    ])
+    model_args.embedding_file = None
+    model_args.cuda = False
+    word_dict = Dictionary()
+    for w in words:
+        word_dict.add(w)
+    feature_dict = utils.build_feature_dict(model_args)
+    model = DocReader(model_args, word_dict, feature_dict)
+    model.init_optimizer()
+    return model
+
+
+# ------------------------------------------------------------------------------
+# Benchmarks
+# ------------------------------------------------------------------------------
+
+
+def timeit(fn, repeats, min_time=0.05):
+    """Per call milliseconds of fn over repeats samples.
+
+    Each sample runs fn enough times to take at least min_time seconds, so
+    that sub-millisecond benchmarks are not dominated by timer noise.
+    """
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    number = max(1, int(min_time / max(elapsed, 1e-9)))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {
+        'median_ms': 1000 * float(np.median(times)),
+        'min_ms': 1000 * float(np.min(times)),
+        'repeats': repeats,
+        'number': number,
+    }
+
+
+def make_benchmarks(args, model, exs, docs):
+    """{name: zero-argument function} of every benchmark."""
+    batch = [vector.vectorize_with_doc(exs[i], i, model, False, docs[i])
+             for i in range(args.batch_size)]
+    ex_with_doc = vector.batchify_with_docs(batch)
+    benchmarks = {}
+
+    benchmarks['vectorize1'] = lambda: [
+        vector.vectorize1(doc, model, ex_id=0) for doc in docs[0]
+    ]
+    benchmarks['vectorize_docs'] = lambda: vector.vectorize_docs(
+        docs[0], model, ex_ids=[0] * len(docs[0])
+    )
+    benchmarks['batchify_with_docs'] = lambda: vector.batchify_with_docs(batch)
+
+    # Encoder layers on the first paragraph slot of the batch.
+    ex = ex_with_doc[0]
+    x = torch.randn(ex[0].size(0), ex[0].size(1), args.embedding_dim)
+    x_mask = ex[2]
+    q = torch.randn(ex[3].size(0), ex[3].size(1), args.embedding_dim)
+    q_mask = ex[4]
+    brnn = layers.StackedBRNN(args.embedding_dim, args.hidden_size, 3,
+                              concat_layers=True).eval()
+    match = layers.SeqAttnMatch(args.embedding_dim).eval()
+
+    def no_grad(fn):
+        def run():
+            with torch.no_grad():
+                return fn()
+        return run
+
+    benchmarks['brnn_padded'] = no_grad(lambda: brnn._forward_padded(x, x_mask))
+    benchmarks['brnn_unpadded'] = no_grad(
+        lambda: brnn._forward_unpadded(x, x_mask)
+    )
+    benchmarks['seq_attn_match'] = no_grad(lambda: match(x, q, q_mask))
+
+    rng = np.random.RandomState(1)
+    length = ex[0].size(1)
+    score_s = torch.from_numpy(
+        rng.dirichlet(np.ones(length), args.batch_size).astype(np.float32)
+    )
+    score_e = torch.from_numpy(
+        rng.dirichlet(np.ones(length), args.batch_size).astype(np.float32)
+    )
+    benchmarks['decode'] = lambda: DocReader.decode(score_s, score_e, 1,
+                                                    model.args.max_len)
+
+    has_answer_args = argparse.Namespace(dataset='quasart')
+    benchmarks['has_answer'] = lambda: [
+        openqa.has_answer(has_answer_args, exs[0]['answer'], doc['document'])
+        for doc in docs[0]
+    ]
+
+    pairs = [(' '.join(doc['document'][:3]), ' '.join(exs[0]['answer'][0]))
+             for doc in docs[0]]
+    benchmarks['f1_score'] = lambda: [utils.f1_score(p, g) for p, g in pairs]
+
+    # One joint training step, with answers where has_answer finds them.
+    has = [[openqa.has_answer(has_answer_args, exs[i]['answer'],
+                              docs[i][idx_doc]['document'])
+            for i in range(args.batch_size)]
+           for idx_doc in range(vector.num_docs)]
+    targets = [[h[1] if h[0] else [(0, 0)] for h in row] for row in has]
+    preds = [torch.LongTensor([[0]] * args.batch_size)
+             for _ in range(vector.num_docs)]
+    benchmarks['update_with_doc'] = lambda: model.update_with_doc(
+        ex_with_doc, list(preds), list(preds), 1, targets,
+        [[] for _ in range(vector.num_docs)], has
+    )
+    return benchmarks
+
+
+# ------------------------------------------------------------------------------
+# Baseline comparison
+# ------------------------------------------------------------------------------
+
+
+def compare(results, baseline, tolerance):
+    """Return names of benchmarks slower than baseline by > tolerance."""
+    if baseline['config'] != results['config']:
+        logger.warning('Baseline was run with a different config: %s' %
+                       baseline['config'])
+    regressions = []
+    for name, stats in sorted(results['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            logger.info('%-20s %10.3f ms  (not in baseline)' %
+                        (name, stats['median_ms']))
+            continue
+        before = baseline['benchmarks'][name]['median_ms']
+        ratio = stats['median_ms'] / max(before, 1e-9)
+        status = 'ok'
+        if ratio > 1 + tolerance:
+            status = 'REGRESSION'
+            regressions.append(name)
+        logger.info('%-20s %10.3f ms  baseline %10.3f ms  x%.2f  %s' %
+                    (name, stats['median_ms'], before, ratio, status))
+    return regressions
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    openqa.PROCESS_TOK = SimpleTokenizer()
+    vector.num_docs = args.num_docs
+
+    logger.info('Building %d synthetic questions x %d paragraphs' %
+                (args.num_questions, vector.num_docs))
+    exs, docs, words = build_synthetic_data(
+        args.num_questions, args.vocab_size, args.doc_len, args.question_len,
+        args.seed
+    )
+    model = build_model(args, words)
+    benchmarks = make_benchmarks(args, model, exs, docs)
+
+    results = {
+        'config': {k: getattr(args, k) for k in (
+            'num_questions', 'batch_size', 'vocab_size', 'doc_len',
+            'question_len', 'embedding_dim', 'hidden_size', 'threads', 'seed',
+            'num_docs'
+        )},
+        'torch': torch.__version__,
+        'benchmarks': {},
+    }
+    for name, fn in sorted(benchmarks.items()):
+        if args.only and name not in args.only:
+            continue
+        results['benchmarks'][name] = timeit(fn, args.repeats)
+        logger.info('%-20s median %10.3f ms | min %10.3f ms' %
+                    (name, results['benchmarks'][name]['median_ms'],
+                     results['benchmarks'][name]['min_ms']))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            logger.error('%d benchmark(s) regressed by more than %d%%: %s' %
+                         (len(regressions), 100 * args.tolerance,
+                          ', '.join(regressions)))
+            sys.exit(1)
+        logger.info('No regressions against %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-questions', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='Questions per batch (each with num_docs '
+                        'paragraphs)')
+    parser.add_argument('--num-docs', type=int, default=50,
+                        help='Paragraphs per question (vector.num_docs)')
+    parser.add_argument('--vocab-size', type=int, default=20000)
+    parser.add_argument('--doc-len', type=int, default=40,
+                        help='Mean paragraph length')
+    parser.add_argument('--question-len', type=int, default=12,
+                        help='Mean question length')
+    parser.add_argument('--embedding-dim', type=int, default=300)
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='torch intra-op threads')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                        help='Only run these benchmarks')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Compare against this --out file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown over the baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]',
+                            '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    main(args)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Benchmark top-k latency of the TF-IDF ranker scorers (dot vs maxscore).
+
+Runs against an existing index (--tfidf-path, .npz or mmap directory, with a
+file of queries) or against a synthetic Zipf-distributed index. Synthetic
+runs time two query sets: 'zipf' queries sampled like the documents, and
+'high_df' queries made only of frequent terms with long postings (the worst
+case for maxscore, which can rarely skip any of them).
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../..'))
+
+from src.retriever import utils
+from src.retriever import TfidfDocRanker
+
+logger = logging.getLogger()
+
+
+def build_synthetic_index(dirname, num_docs, vocab_size, doc_len, hash_size,
+                          seed=0):
+    """Write a unigram tfidf index with Zipf term frequencies to dirname."""
+    rng = np.random.RandomState(seed)
+    words = ['w%d' % i for i in range(vocab_size)]
+    word_hash = np.array([utils.hash(w, hash_size) for w in words])
+    probs = 1.0 / np.arange(1, vocab_size + 1)
+    probs /= probs.sum()
+
+    lengths = np.maximum(1, rng.poisson(doc_len, num_docs))
+    doc_of = np.repeat(np.arange(num_docs), lengths)
+    term_of = word_hash[rng.choice(vocab_size, lengths.sum(), p=probs)]
+    counts = sp.csr_matrix(
+        (np.ones(len(doc_of)), (term_of, doc_of)), shape=(hash_size, num_docs)
+    )
+    counts.sum_duplicates()
+
+    doc_freqs = np.diff(counts.indptr)
+    idfs = np.log((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+    idfs[idfs < 0] = 0
+    tfidf = counts.copy()
+    tfidf.data = np.log1p(tfidf.data) * np.repeat(idfs, doc_freqs)
+
+    doc_ids = ['doc%d' % i for i in range(num_docs)]
+    metadata = {
+        'doc_freqs': doc_freqs,
+        'tokenizer': 'simple',
+        'hash_size': hash_size,
+        'ngram': 1,
+        'doc_dict': ({d: i for i, d in enumerate(doc_ids)}, doc_ids),
+    }
+    utils.save_sparse_csr_mmap(dirname, tfidf, metadata)
+    return words, probs
+
+
+def percentile_ms(times, q):
+    return 1000 * float(np.percentile(times, q))
+
+
+def main(args):
+    if args.tfidf_path:
+        if not args.queries:
+            raise RuntimeError('--queries is required with --tfidf-path')
+        tfidf_path = args.tfidf_path
+    else:
+        tfidf_path = os.path.join(tempfile.mkdtemp(), 'tfidf')
+        logger.info('Building synthetic index (%d docs) in %s' %
+                    (args.num_docs, tfidf_path))
+        words, probs = build_synthetic_index(
+            tfidf_path, args.num_docs, args.vocab_size, args.doc_len,
+            args.hash_size
+        )
+
+    if args.queries:
+        with open(args.queries) as f:
+            query_sets = {'queries': [l.strip() for l in f
+                                      if l.strip()][:args.num_queries]}
+    else:
+        rng = np.random.RandomState(1)
+        # Terms this frequent are in most documents and get a zero idf;
+        # the next ones have the longest postings that still score.
+        frequent = words[args.high_df_skip:
+                         args.high_df_skip + args.high_df_terms]
+        query_sets = {
+            'zipf': [' '.join(rng.choice(words, rng.randint(2, 10), p=probs))
+                     for _ in range(args.num_queries)],
+            'high_df': [' '.join(rng.choice(frequent, rng.randint(2, 10)))
+                        for _ in range(args.num_queries)],
+        }
+
+    rankers = {scorer: TfidfDocRanker(tfidf_path, scorer=scorer)
+               for scorer in ('dot', 'maxscore')}
+
+    results = []
+    for name, queries in query_sets.items():
+        for k in args.k:
+            row = {'queries': name, 'k': k}
+            answers = {}
+            for scorer, ranker in rankers.items():
+                times = []
+                answers[scorer] = []
+                for query in queries:
+                    start = time.time()
+                    answers[scorer].append(ranker.closest_docs(query, k)[1])
+                    times.append(time.time() - start)
+                row[scorer] = {
+                    'mean_ms': 1000 * float(np.mean(times)),
+                    'p50_ms': percentile_ms(times, 50),
+                    'p99_ms': percentile_ms(times, 99),
+                }
+            row['same_scores'] = all(
+                len(a) == len(b) and np.allclose(a, b)
+                for a, b in zip(answers['dot'], answers['maxscore'])
+            )
+            results.append(row)
+            logger.info('%-7s k = %3d | dot p50 %.2f ms p99 %.2f ms | '
+                        'maxscore p50 %.2f ms p99 %.2f ms | same scores: %s' %
+                        (name, k, row['dot']['p50_ms'], row['dot']['p99_ms'],
+                         row['maxscore']['p50_ms'], row['maxscore']['p99_ms'],
+                         row['same_scores']))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tfidf-path', type=str, default=None,
+                        help='Existing index (.npz or mmap directory)')
+    parser.add_argument('--queries', type=str, default=None,
+                        help='File with one query per line')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--num-docs', type=int, default=500000,
+                        help='Synthetic index: number of documents')
+    parser.add_argument('--vocab-size', type=int, default=200000,
+                        help='Synthetic index: vocabulary size')
+    parser.add_argument('--doc-len', type=int, default=100,
+                        help='Synthetic index: mean document length')
+    parser.add_argument('--hash-size', type=int, default=int(2**24),
+                        help='Synthetic index: number of hash buckets')
+    parser.add_argument('--high-df-skip', type=int, default=20,
+                        help='Synthetic high_df queries: skip this many most '
+                        'frequent terms')
+    parser.add_argument('--high-df-terms', type=int, default=200,
+                        help='Synthetic high_df queries: draw from this many '
+                        'next most frequent terms')
+    parser.add_argument('--k', type=int, nargs='+',
+                        default=[5, 10, 20, 50, 100])
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]',
+                            '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    main(args)
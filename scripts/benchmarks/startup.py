@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Time the imports of the package entry points in fresh interpreters.
+
+Each entry point is imported --repeats times in a new python process; the
+median wall time is reported with the heavy dependencies it pulled in
+(torch, scipy, sklearn, pexpect, spacy), which should only appear where the
+entry point needs them:
+
+    python scripts/benchmarks/startup.py --out startup.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..')
+
+logger = logging.getLogger()
+
+ENTRY_POINTS = {
+    'src': 'import src',
+    'tokenizers': 'from src.tokenizers import SimpleTokenizer',
+    'retriever.DocDB': 'from src.retriever import DocDB',
+    'retriever.TfidfDocRanker': 'from src.retriever import TfidfDocRanker',
+    'reader.config': 'from src.reader import config',
+    'reader.Predictor': 'from src.reader.predictor import Predictor',
+    'pipeline.OpenQA': 'from src.pipeline import OpenQA',
+    'main': 'import main',
+}
+
+HEAVY = ('torch', 'scipy', 'sklearn', 'pexpect', 'spacy')
+
+REPORT = ('import json, sys; print(json.dumps([m for m in %r '
+          'if m in sys.modules]))' % (HEAVY,))
+
+
+def time_import(statement, repeats):
+    """Median seconds of a fresh python running statement, and the heavy
+    modules it imported."""
+    command = [sys.executable, '-c', '%s\n%s' % (statement, REPORT)]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.check_output(command, cwd=ROOT,
+                                         stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return {
+        'median_s': float(np.median(times)),
+        'min_s': float(np.min(times)),
+        'heavy_modules': json.loads(output.decode('utf-8').splitlines()[-1]),
+    }
+
+
+def main(args):
+    baseline = time_import('pass', args.repeats)
+    logger.info('%-26s median %7.3f s' % ('python', baseline['median_s']))
+    results = {'python': baseline, 'entry_points': {}}
+    for name, statement in ENTRY_POINTS.items():
+        if args.only and name not in args.only:
+            continue
+        try:
+            stats = time_import(statement, args.repeats)
+        except subprocess.CalledProcessError:
+            logger.warning('%-26s failed to import' % name)
+            continue
+        results['entry_points'][name] = stats
+        logger.info('%-26s median %7.3f s | %s' %
+                    (name, stats['median_s'],
+                     ', '.join(stats['heavy_modules']) or '-'))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                        help='Only time these entry points')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]',
+                            '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    main(args)
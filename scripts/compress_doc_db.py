@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Migrate a DocDB sqlite database to (or between) compressed layouts."""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.retriever import DocDB
+from src.retriever.compression import Codec, train_zlib_dict
+
+logger = logging.getLogger()
+
+
+def compress_db(in_path, out_path, codec_name, level=None, dict_size=32768,
+                dict_samples=2000, batch_size=1000):
+    """Copy the documents of in_path into a new db at out_path with codec."""
+    if os.path.isfile(out_path):
+        raise RuntimeError('%s already exists! Not overwriting.' % out_path)
+
+    with DocDB(in_path) as src:
+        zdict = None
+        if codec_name == 'zlib' and dict_size > 0:
+            logger.info('Training zlib dictionary on %d documents' %
+                        dict_samples)
+            cursor = src.connection.cursor()
+            cursor.execute("SELECT id FROM documents ORDER BY RANDOM() "
+                           "LIMIT ?", (dict_samples,))
+            sample_ids = [r[0] for r in cursor.fetchall()]
+            cursor.close()
+            zdict = train_zlib_dict(src.get_doc_texts(sample_ids), dict_size)
+            logger.info('Dictionary size = %d bytes' % len(zdict))
+        codec = Codec(codec_name, zdict, level)
+
+        dst = sqlite3.connect(out_path)
+        dst.execute("CREATE TABLE documents (id PRIMARY KEY, text);")
+        codec.save(dst)
+
+        count = 0
+        doc_ids = []
+        for doc_id in src.iter_doc_ids():
+            doc_ids.append(doc_id)
+            if len(doc_ids) == batch_size:
+                count += _copy(src, dst, codec, doc_ids)
+                doc_ids = []
+                if count % (100 * batch_size) == 0:
+                    logger.info('Copied %d documents' % count)
+        count += _copy(src, dst, codec, doc_ids)
+        dst.commit()
+        dst.execute("VACUUM")
+        dst.close()
+    logger.info('Copied %d documents to %s' % (count, out_path))
+
+
+def _copy(src, dst, codec, doc_ids):
+    texts = src.get_doc_texts(doc_ids)
+    dst.executemany("INSERT INTO documents VALUES (?,?)",
+                    [(d, codec.compress(t)) for d, t in zip(doc_ids, texts)])
+    return len(doc_ids)
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]',
+                            '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_path', type=str, help='/path/to/docs.db')
+    parser.add_argument('out_path', type=str, help='/path/to/new/docs.db')
+    parser.add_argument('--codec', type=str, default='zlib',
+                        help='Compression: zlib, lzma or none. zlib with a '
+                        'trained dictionary is the fastest and, on short '
+                        'documents, the smallest; lzma has no preset '
+                        'dictionaries and is several times slower to write '
+                        'and read')
+    parser.add_argument('--level', type=int, default=None,
+                        help='Compression level (zlib 0-9, default 6; lzma '
+                        'preset 0-9, default 0). Documents are compressed '
+                        'one by one, so higher levels are slower (lzma 6 is '
+                        'about 6x slower than 0) for little or no size gain')
+    parser.add_argument('--dict-size', type=int, default=32768,
+                        help='Bytes of trained zlib dictionary (0 = none)')
+    parser.add_argument('--dict-samples', type=int, default=2000,
+                        help='Documents sampled to train the dictionary')
+    args = parser.parse_args()
+
+    compress_db(args.in_path, args.out_path, args.codec, args.level,
+                args.dict_size, args.dict_samples)
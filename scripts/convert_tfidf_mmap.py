@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""Convert a .npz TF-IDF index into the memory-mapped directory format."""
+
+import argparse
+import logging
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.retriever import utils
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter('%(asctime)s: [ %(message)s ]',
+                                       '%m/%d/%Y %I:%M:%S %p'))
+logger.addHandler(console)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tfidf_path', type=str, help='/path/to/tfidf.npz')
+    parser.add_argument('out_dir', type=str, help='/path/to/output/dir')
+    args = parser.parse_args()
+
+    logger.info('Loading %s' % args.tfidf_path)
+    matrix, metadata = utils.load_sparse_csr(args.tfidf_path)
+    logger.info('Writing %s' % args.out_dir)
+    utils.save_sparse_csr_mmap(args.out_dir, matrix, metadata)
+    logger.info('Done.')
@@ -1,49 +1,44 @@
-import logging
 import os
+import sys
 
 import argparse
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
-                    datefmt='%m/%d/%Y %H:%M:%S',
-                    level=logging.INFO)
-logger = logging.getLogger(__name__)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main as openqa
+
 # model
 parser = argparse.ArgumentParser(description='CoTraining')
 parser.add_argument('--top_k', type=int,
                     help='Number of labeling samples in Co-Training')
 parser.add_argument('--gpu', type=int,
                     help='gpu id')
+parser.add_argument('--rounds', type=int, default=20,
+                    help='Number of self-training rounds')
 args = parser.parse_args()
 
 top_k = args.top_k
-recurrent_times = 20
-
-load_evidence_file = 'none'
-
-for i in range(recurrent_times):
-    logger.info("Running at the %dth times..." % (i))
-    save_evidence_file = "recurrent%d" % (i)
-    output_dir = "models/selftraining-SingleEvidence/top%d/recurrent%d" % (top_k, i)
+output_dir = "models/selftraining-SingleEvidence/top%d" % (top_k)
+if not os.path.isdir(output_dir):
     os.makedirs(output_dir)
 
-    if i > 0:
-        previous_output_dir = "models/selftraining-SingleEvidence/top%d/recurrent%d" % (top_k, i - 1)
-        os.system("cp %s/quasart_all.%s.pkl %s/quasart_all.%s.pkl" % (previous_output_dir, load_evidence_file, output_dir, load_evidence_file))
-
-    cmd = "env CUDA_VISIBLE_DEVICES=%d \
-            python main.py \
-            --gpu %d \
-            --batch-size 32 \
-            --model-name quasart_all \
-            --num-epochs 5 \
-            --dataset quasart \
-            --mode all \
-            --pretrained models/quasart_selector.mdl \
-            --model-dir %s \
-            --top_k %d \
-            --load_evidence_file %s \
-            --save_evidence_file %s" % (args.gpu, 0, output_dir, top_k, load_evidence_file, save_evidence_file)
-
-    os.system(cmd)
-
-    load_evidence_file = save_evidence_file
+# All rounds run in this process; data, tokenizer, has-answer cache and
+# evidence labels stay in memory. Round r saves quasart_all.round<r>.mdl
+# and quasart_all.round<r>.npy in output_dir. With --checkpoint, rerunning
+# after an interruption resumes at the last unfinished round.
+os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu)
+main_args = openqa.parse_args([
+    '--gpu', '0',
+    '--batch-size', '32',
+    '--model-name', 'quasart_all',
+    '--num-epochs', '5',
+    '--dataset', 'quasart',
+    '--mode', 'all',
+    '--pretrained', 'models/quasart_selector.mdl',
+    '--model-dir', output_dir,
+    '--top_k', str(top_k),
+    '--checkpoint', 'true',
+    '--self-training-rounds', str(args.rounds),
+])
+openqa.setup(main_args)
+openqa.main(main_args)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Serve a DocReader model over HTTP with dynamic micro-batching.
+
+POST /predict {"document": ..., "question": ..., "candidates": [...],
+"top_n": 1} returns [[span, score], ...]; GET /metrics reports queue depth,
+batch sizes and p50/p99 latency.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.reader.predictor import Predictor
+from src.reader.server import BatchingServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default=None,
+                    help='Path to model to use')
+parser.add_argument('--tokenizer', type=str, default=None,
+                    help=("String option specifying tokenizer type to use "
+                          "(e.g. 'corenlp')"))
+parser.add_argument('--num-workers', type=int, default=None,
+                    help='Number of CPU processes (for tokenizing, etc)')
+parser.add_argument('--no-cuda', action='store_true',
+                    help='Use CPU only')
+parser.add_argument('--gpu', type=int, default=-1,
+                    help='Specify GPU device id to use')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--max-batch-size', type=int, default=32,
+                    help='Maximum number of requests merged in one batch')
+parser.add_argument('--max-latency-ms', type=float, default=10,
+                    help='Time the first request of a batch waits for more')
+args = parser.parse_args()
+
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+if args.cuda:
+    torch.cuda.set_device(args.gpu)
+    logger.info('CUDA enabled (GPU %d)' % args.gpu)
+else:
+    logger.info('Running on CPU only.')
+
+predictor = Predictor(args.model, args.tokenizer, num_workers=args.num_workers)
+if args.cuda:
+    predictor.cuda()
+
+loop = asyncio.get_event_loop()
+server = BatchingServer(predictor, args.max_batch_size,
+                        args.max_latency_ms / 1000, loop=loop)
+http = loop.run_until_complete(server.serve(args.host, args.port))
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    http.close()
+    loop.run_until_complete(http.wait_closed())
+    loop.run_until_complete(server.stop())
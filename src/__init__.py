@@ -7,17 +7,41 @@
 
 import os
 import sys
+import importlib
 from pathlib import PosixPath
 
-if sys.version_info < (3, 5):
-    raise RuntimeError('Only supports Python 3.5 or higher.')
+if sys.version_info < (3, 7):
+    raise RuntimeError('Only supports Python 3.7 or higher.')
 
 DATA_DIR = (
     os.getenv('DRQA_DATA') or
     os.path.join(PosixPath(__file__).absolute().parents[1].as_posix(), 'data')
 )
 
-from . import tokenizers
-from . import reader
-from . import retriever
-#from . import pipeline
+
+def lazy_getattr(package, attributes):
+    """Build a module __getattr__ (PEP 562) that imports attributes on use.
+
+    attributes maps a name to (submodule, attribute); attribute None means
+    the submodule itself. Importing a package then costs nothing until one
+    of its classes is used, so entry points only pay for what they need.
+    """
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError('module %r has no attribute %r' %
+                                 (package, name))
+        module_name, attribute = attributes[name]
+        value = importlib.import_module(module_name, package)
+        if attribute is not None:
+            value = getattr(value, attribute)
+        setattr(sys.modules[package], name, value)
+        return value
+    return __getattr__
+
+
+__getattr__ = lazy_getattr(__name__, {
+    'tokenizers': ('.tokenizers', None),
+    'reader': ('.reader', None),
+    'retriever': ('.retriever', None),
+    'pipeline': ('.pipeline', None),
+})
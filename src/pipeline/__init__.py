@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+from .. import DATA_DIR, lazy_getattr
+
+# Classes or, so that they are only imported when used, their names for
+# tokenizers.get_class and retriever.get_class.
+DEFAULTS = {
+    'tokenizer': 'corenlp',
+    'ranker': 'tfidf',
+    'db': 'sqlite',
+    'reader_model': os.path.join(DATA_DIR, 'models/quasart_all.mdl'),
+}
+
+
+def set_default(key, value):
+    global DEFAULTS
+    DEFAULTS[key] = value
+
+
+# Imported on first use (torch, scipy, pexpect)
+__getattr__ = lazy_getattr(__name__, {
+    'OpenQA': ('.openqa', 'OpenQA'),
+})
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""Full OpenQA pipeline: retriever -> paragraph selector -> paragraph reader."""
+
+import regex
+import logging
+
+from multiprocessing import Pool as ProcessPool
+from multiprocessing.util import Finalize
+
+from ..reader.aggregator import SpanAggregator
+from .. import reader
+from .. import retriever
+from .. import tokenizers
+from . import DEFAULTS
+
+# The reader's vectorizer (torch) is imported by the methods that use it, so
+# that importing the pipeline does not wait for torch.
+
+logger = logging.getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+# Multiprocessing functions to tokenize text
+# ------------------------------------------------------------------------------
+
+PROCESS_TOK = None
+PROCESS_CANDS = None
+
+
+def init(tokenizer_class, tokenizer_opts, candidates=None):
+    global PROCESS_TOK, PROCESS_CANDS
+    PROCESS_TOK = tokenizer_class(**tokenizer_opts)
+    Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
+    PROCESS_CANDS = candidates
+
+
+def tokenize_text(text):
+    global PROCESS_TOK
+    return PROCESS_TOK.tokenize(text)
+
+
+# ------------------------------------------------------------------------------
+# Main OpenQA pipeline
+# ------------------------------------------------------------------------------
+
+STAGES = ('retrieve', 'fetch', 'tokenize', 'vectorize', 'select', 'read',
+          'aggregate')
+
+
+class OpenQA(object):
+    # Target size for squashing short paragraphs together.
+    # 0 = read every paragraph independently
+    # infty = read all paragraphs together
+    GROUP_LENGTH = 0
+
+    # Spans decoded per paragraph before aggregating over paragraphs.
+    READ_TOP_N = 10
+
+    def __init__(
+            self,
+            reader_model=None,
+            tokenizer=None,
+            fixed_candidates=None,
+            batch_size=32,
+            cuda=True,
+            num_workers=None,
+            db_config=None,
+            ranker_config=None,
+            aggregation='sum'
+    ):
+        """Initialize the pipeline.
+
+        Args:
+            reader_model: model file from which to load the DocReader (reader
+              and selector).
+            tokenizer: string option to specify tokenizer used on docs.
+            fixed_candidates: if given, all predictions will be constrated to
+              this set of candidate answer strings.
+            batch_size: number of questions to process at once.
+            cuda: whether to use the gpu.
+            num_workers: number of CPU processes to use to tokenize.
+            db_config: config for doc db.
+            ranker_config: config for ranker.
+            aggregation: how span scores are combined over paragraphs
+              (sum, max or noisy_or).
+        """
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.fixed_candidates = fixed_candidates
+        self.aggregation = aggregation
+
+        logger.info('Initializing document ranker...')
+        ranker_config = ranker_config or {}
+        ranker_class = ranker_config.get('class', DEFAULTS['ranker'])
+        if isinstance(ranker_class, str):
+            ranker_class = retriever.get_class(ranker_class)
+        ranker_opts = ranker_config.get('options', {})
+        self.ranker = ranker_class(strict=False, **ranker_opts)
+
+        logger.info('Initializing document db...')
+        db_config = db_config or {}
+        db_class = db_config.get('class', DEFAULTS['db'])
+        if isinstance(db_class, str):
+            db_class = retriever.get_class(db_class)
+        db_opts = db_config.get('options', {})
+        self.db = db_class(**db_opts)
+
+        logger.info('Initializing model...')
+        reader_model = reader_model or DEFAULTS['reader_model']
+        self.reader = reader.DocReader.load(reader_model)
+        self.reader.word_dict.freeze()
+        if cuda:
+            self.reader.cuda()
+
+        if not tokenizer:
+            tok_class = DEFAULTS['tokenizer']
+            if isinstance(tok_class, str):
+                tok_class = tokenizers.get_class(tok_class)
+        else:
+            tok_class = tokenizers.get_class(tokenizer)
+        annotators = tokenizers.get_annotators_for_model(self.reader)
+        tok_opts = {'annotators': annotators}
+
+        logger.info('Initializing tokenizers...')
+        if num_workers is None or num_workers > 0:
+            self.processes = ProcessPool(
+                num_workers,
+                initializer=init,
+                initargs=(tok_class, tok_opts, fixed_candidates)
+            )
+        else:
+            self.processes = None
+            init(tok_class, tok_opts, fixed_candidates)
+
+    def _split_doc(self, doc):
+        """Given a doc, split it into chunks (by paragraph)."""
+        curr = []
+        curr_len = 0
+        for split in regex.split(r'\n+', doc):
+            split = split.strip()
+            if len(split) == 0:
+                continue
+            # Maybe group paragraphs together until we hit a length limit
+            if len(curr) > 0 and curr_len + len(split) > self.GROUP_LENGTH:
+                yield ' '.join(curr)
+                curr = []
+                curr_len = 0
+            curr.append(split)
+            curr_len += len(split)
+        if len(curr) > 0:
+            yield ' '.join(curr)
+
+    def _tokenize(self, texts):
+        if self.processes:
+            return self.processes.map(tokenize_text, texts, chunksize=16)
+        return [tokenize_text(t) for t in texts]
+
+    def process(self, query, candidates=None, top_n=1, n_docs=5,
+                n_read=None, return_context=False):
+        """Run a single query."""
+        predictions = self.process_batch(
+            [query], [candidates] if candidates else None,
+            top_n, n_docs, n_read, return_context
+        )
+        return predictions[0]
+
+    def process_batch(self, queries, candidates=None, top_n=1, n_docs=5,
+                      n_read=None, return_context=False,
+                      return_timings=False):
+        """Run a batch of queries (more efficient).
+
+        Up to vector.num_docs paragraphs of the top n_docs documents are
+        scored by the selector; the n_read paragraphs it scores highest (all
+        of them if None) are read, and answer scores weighted by the
+        selector are combined over paragraphs.
+        """
+        from ..reader import vector, utils as reader_utils
+
+        timers = {stage: reader_utils.Timer().stop() for stage in STAGES}
+
+        # Rank documents for queries.
+        timers['retrieve'].resume()
+        if len(queries) == 1:
+            ranked = [self.ranker.closest_docs(queries[0], k=n_docs)]
+        else:
+            ranked = self.ranker.batch_closest_docs(
+                queries, k=n_docs, num_workers=self.num_workers
+            )
+        all_docids, all_doc_scores = zip(*ranked)
+        timers['retrieve'].stop()
+
+        # Fetch all unique documents with one batched query.
+        timers['fetch'].resume()
+        flat_docids = list({d for docids in all_docids for d in docids})
+        doc_texts = dict(zip(flat_docids, self.db.get_doc_texts(flat_docids)))
+        timers['fetch'].stop()
+
+        # Split into paragraphs, keeping at most num_docs per question.
+        paragraphs = []
+        for qidx in range(len(queries)):
+            question_paragraphs = []
+            for rel_didx, did in enumerate(all_docids[qidx]):
+                for text in self._split_doc(doc_texts[did] or ''):
+                    if len(question_paragraphs) < vector.num_docs:
+                        question_paragraphs.append((rel_didx, text))
+            paragraphs.append(question_paragraphs)
+
+        # Tokenize questions and paragraphs in the worker pool.
+        timers['tokenize'].resume()
+        flat_paragraphs = [t for ps in paragraphs for _, t in ps]
+        tokens = self._tokenize(list(queries) + flat_paragraphs)
+        q_tokens = tokens[:len(queries)]
+        p_tokens = []
+        offset = len(queries)
+        for ps in paragraphs:
+            p_tokens.append(tokens[offset:offset + len(ps)])
+            offset += len(ps)
+        timers['tokenize'].stop()
+
+        results = []
+        for start in range(0, len(queries), self.batch_size):
+            qidxs = [qidx for qidx in
+                     range(start, min(start + self.batch_size, len(queries)))]
+            results.extend(self._read_batch(
+                qidxs, queries, candidates, q_tokens, p_tokens, paragraphs,
+                all_docids, all_doc_scores, top_n, n_read, return_context,
+                timers
+            ))
+
+        timings = {stage: timer.time() for stage, timer in timers.items()}
+        logger.info('Processed %d queries | %s' % (len(queries), ' | '.join(
+            '%s = %.2f (s)' % (stage, timings[stage]) for stage in STAGES
+        )))
+        if return_timings:
+            return results, timings
+        return results
+
+    def _read_batch(self, qidxs, queries, candidates, q_tokens, p_tokens,
+                    paragraphs, all_docids, all_doc_scores, top_n, n_read,
+                    return_context, timers):
+        """Select and read the paragraphs of a batch of questions."""
+        from ..reader import vector
+
+        results = [[] for _ in qidxs]
+        active = [i for i, qidx in enumerate(qidxs) if p_tokens[qidx]]
+        if not active:
+            return results
+
+        # Vectorize every paragraph once; questions with fewer paragraphs
+        # than the longest have their last slots masked.
+        timers['vectorize'].resume()
+        vectors = []
+        for i in active:
+            qidx = qidxs[i]
+            question = q_tokens[qidx]
+            vectors.append(vector.vectorize_docs([{
+                'id': (i, pidx),
+                'question': question.words(),
+                'qlemma': question.lemmas(),
+                'document': paragraph.words(),
+                'lemma': paragraph.lemmas(),
+                'pos': paragraph.pos(),
+                'ner': paragraph.entities(),
+            } for pidx, paragraph in enumerate(p_tokens[qidx])], self.reader))
+        ex_with_doc = vector.batchify_with_docs([
+            {'docs': v, 'sources': list(range(len(v)))} for v in vectors
+        ])
+        timers['vectorize'].stop()
+
+        # Score all paragraphs with the selector.
+        timers['select'].resume()
+        doc_probs = self.reader.predict_with_doc(ex_with_doc)
+        timers['select'].stop()
+
+        # Keep the best scored paragraphs of every question.
+        survivors = []
+        for row, i in enumerate(active):
+            n = len(vectors[row])
+            mass = doc_probs[row].tolist()
+            order = sorted(range(n), key=lambda pidx: -mass[pidx])
+            for pidx in order[:n_read or n]:
+                survivors.append((i, pidx, mass[pidx], vectors[row][pidx]))
+
+        # Read survivors in batches of similar length.
+        timers['read'].resume()
+        survivors.sort(key=lambda s: s[3][0].size(0))
+        batch_size = self.batch_size * max(1, n_read or vector.num_docs)
+        predictions = []
+        for start in range(0, len(survivors), batch_size):
+            batch = survivors[start:start + batch_size]
+            batch_exs = vector.batchify([s[3] for s in batch])
+            batch_cands = None
+            if candidates or self.fixed_candidates:
+                batch_cands = [{
+                    'input': p_tokens[qidxs[i]][pidx],
+                    'cands': (candidates[qidxs[i]] if candidates
+                              else self.fixed_candidates)
+                } for i, pidx, _, _ in batch]
+            s, e, score = self.reader.predict(
+                batch_exs, batch_cands, top_n=max(self.READ_TOP_N, top_n)
+            )
+            predictions.extend(zip(batch, s, e, score))
+        timers['read'].stop()
+
+        # Combine span scores over paragraphs, weighted by the selector.
+        timers['aggregate'].resume()
+        aggregator = SpanAggregator(self.aggregation)
+        spans = []
+        for (i, pidx, prob, _), pred_s, pred_e, pred_score in predictions:
+            aggregator.add(i, p_tokens[qidxs[i]][pidx].words(), pred_s,
+                           pred_e, pred_score, prob)
+            spans.extend((pidx, int(s), int(e), prob)
+                         for s, e in zip(pred_s, pred_e))
+        best = aggregator.best(top_n)
+
+        for i in active:
+            qidx = qidxs[i]
+            for span_score, index in best.get(i, []):
+                pidx, s, e, prob = spans[index]
+                rel_didx, text = paragraphs[qidx][pidx]
+                paragraph = p_tokens[qidx][pidx]
+                prediction = {
+                    'doc_id': all_docids[qidx][rel_didx],
+                    'span': paragraph.slice(s, e + 1).untokenize(),
+                    'doc_score': float(all_doc_scores[qidx][rel_didx]),
+                    'selector_score': prob,
+                    'span_score': span_score,
+                }
+                if return_context:
+                    offsets = paragraph.offsets()
+                    prediction['context'] = {
+                        'text': text,
+                        'start': offsets[s][0],
+                        'end': offsets[e][1],
+                    }
+                results[i].append(prediction)
+        timers['aggregate'].stop()
+        return results
@@ -7,7 +7,7 @@
 
 import os
 from ..tokenizers import SimpleTokenizer
-from .. import DATA_DIR
+from .. import DATA_DIR, lazy_getattr
 
 
 DEFAULTS = {
@@ -19,8 +19,11 @@ def set_default(key, value):
     global DEFAULTS
     DEFAULTS[key] = value
 
-from .model import DocReader
-from . import config
-from . import vector
-from . import data
-from . import utils
+# Imported on first use (torch)
+__getattr__ = lazy_getattr(__name__, {
+    'DocReader': ('.model', 'DocReader'),
+    'config': ('.config', None),
+    'vector': ('.vector', None),
+    'data': ('.data', None),
+    'utils': ('.utils', None),
+})
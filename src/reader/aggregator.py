@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Aggregate answer span scores over the paragraphs of a question.
+
+Candidate spans are keyed by a 64 bit polynomial hash of their lower-cased,
+interned token ids, so identical answers read from different paragraphs
+collapse to one key without building strings. Scores are then reduced per
+(question, key) segment with numpy.
+"""
+
+import numpy as np
+
+MODES = {'sum', 'max', 'noisy_or'}
+
+# Odd base, so that it is invertible modulo 2 ** 64.
+HASH_BASE = np.uint64(1000003)
+
+
+def _inverse(base):
+    """Multiplicative inverse of an odd number modulo 2 ** 64."""
+    base = int(base)
+    inv = base
+    for _ in range(6):
+        inv = (inv * (2 - base * inv)) % (1 << 64)
+    return np.uint64(inv)
+
+
+class SpanAggregator(object):
+    """Collect (question, span, score) triples and pick the best answers.
+
+    Usage:
+        agg = SpanAggregator('sum')
+        agg.add(question, words, starts, ends, scores, weight)  # repeatedly
+        best = agg.best(top_n)  # {question: [(score, index), ...]}
+
+    index counts every span passed to add in order; the first occurrence of
+    a key is reported, so ties are broken like a scan over insertion order.
+    """
+
+    def __init__(self, mode='sum'):
+        if mode not in MODES:
+            raise RuntimeError('Unsupported aggregation mode: %s' % mode)
+        self.mode = mode
+        self.vocab = {}
+        self._powers = np.ones(1, dtype=np.uint64)
+        self._inv_powers = np.ones(1, dtype=np.uint64)
+        self.reset()
+
+    def reset(self):
+        self._groups = []
+        self._lengths = []
+        self._scores = []
+        self._token_ids = []
+
+    def __len__(self):
+        return len(self._groups)
+
+    # --------------------------------------------------------------------------
+    # Keys
+    # --------------------------------------------------------------------------
+
+    def _grow_powers(self, length):
+        if length <= len(self._powers):
+            return
+        length = max(length, 2 * len(self._powers))
+        with np.errstate(over='ignore'):
+            self._powers = np.cumprod(np.concatenate([
+                [np.uint64(1)], np.full(length - 1, HASH_BASE, dtype=np.uint64)
+            ]), dtype=np.uint64)
+            self._inv_powers = np.cumprod(np.concatenate([
+                [np.uint64(1)],
+                np.full(length - 1, _inverse(HASH_BASE), dtype=np.uint64)
+            ]), dtype=np.uint64)
+
+    def span_keys(self, token_ids, starts, ends):
+        """Hash the inclusive spans [starts, ends] of a token id sequence.
+
+        Uses prefix sums of id * base ** position, so all spans cost one
+        pass over token_ids regardless of their number and length.
+        """
+        token_ids = np.asarray(token_ids, dtype=np.uint64)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self._grow_powers(len(token_ids) + 1)
+        with np.errstate(over='ignore'):
+            prefix = np.zeros(len(token_ids) + 1, dtype=np.uint64)
+            np.cumsum(token_ids * self._powers[:len(token_ids)],
+                      out=prefix[1:])
+            keys = (prefix[ends + 1] - prefix[starts]) * self._inv_powers[starts]
+            # Mix in the span length as well.
+            keys += (ends - starts + 1).astype(np.uint64) << np.uint64(56)
+        return keys
+
+    # --------------------------------------------------------------------------
+    # Accumulation
+    # --------------------------------------------------------------------------
+
+    def add(self, group, words, starts, ends, scores, weight=1.0):
+        """Add spans [starts[k], ends[k]] of words for question group.
+
+        Span scores are multiplied by weight (e.g. the paragraph's selector
+        probability). Spans running past the end of words are ignored
+        (their index is still consumed). Only the span tokens are interned
+        here; hashing and reduction happen at once in best().
+        """
+        num_words = len(words)
+        vocab = self.vocab
+        token_ids = self._token_ids
+        for s, e in zip(starts, ends):
+            s, e = int(s), int(e)
+            if s <= e < num_words:
+                for w in words[s:e + 1]:
+                    w = w.lower()
+                    idx = vocab.get(w)
+                    if idx is None:
+                        idx = vocab[w] = len(vocab) + 1
+                    token_ids.append(idx)
+                self._groups.append(group)
+                self._lengths.append(e - s + 1)
+            else:
+                self._groups.append(-1)
+                self._lengths.append(0)
+        self._scores.extend(float(score) * weight for score in scores)
+
+    def best(self, top_n=1):
+        """Return {group: [(score, first index), ...]} best first."""
+        if not self._groups:
+            return {}
+        lengths = np.array(self._lengths, dtype=np.int64)
+        ends = np.cumsum(lengths) - 1
+        keys = self.span_keys(self._token_ids, ends - lengths + 1, ends)
+        return aggregate(self._groups, keys, self._scores, self.mode, top_n)
+
+
+def aggregate(groups, keys, scores, mode='sum', top_n=1):
+    """Reduce scores per (group, key) segment and rank keys in each group.
+
+    Args:
+        groups: int array, question of every entry (negative = ignored)
+        keys: uint64 array, span key of every entry
+        scores: float array, score of every entry
+        mode: 'sum', 'max' or 'noisy_or' (1 - prod(1 - score))
+        top_n: number of keys to return per group
+    Output:
+        {group: [(score, index of the key's first entry), ...]} best first
+    """
+    if mode not in MODES:
+        raise RuntimeError('Unsupported aggregation mode: %s' % mode)
+    groups = np.asarray(groups).reshape(-1)
+    keys = np.asarray(keys).reshape(-1)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+
+    entries = np.flatnonzero(groups >= 0)
+    if len(entries) == 0:
+        return {}
+    # Sort by (group, key, position): segments are contiguous and their
+    # first element is the first occurrence.
+    order = entries[np.lexsort((entries, keys[entries], groups[entries]))]
+    g, k = groups[order], keys[order]
+    starts = np.flatnonzero(np.concatenate([
+        [True], (g[1:] != g[:-1]) | (k[1:] != k[:-1])
+    ]))
+
+    s = scores[order]
+    if mode == 'sum':
+        totals = np.add.reduceat(s, starts)
+    elif mode == 'max':
+        totals = np.maximum.reduceat(s, starts)
+    else:
+        totals = -np.expm1(np.add.reduceat(np.log1p(-np.minimum(s, 1)),
+                                           starts))
+    first = order[starts]
+    seg_groups = g[starts]
+
+    # Rank segments: group asc, score desc, first occurrence asc.
+    ranked = np.lexsort((first, -totals, seg_groups))
+    results = {}
+    group_starts = np.flatnonzero(np.concatenate([
+        [True], seg_groups[ranked][1:] != seg_groups[ranked][:-1]
+    ]))
+    for i, start in enumerate(group_starts):
+        end = group_starts[i + 1] if i + 1 < len(group_starts) else len(ranked)
+        top = ranked[start:min(end, start + top_n)]
+        results[int(seg_groups[top[0]])] = [
+            (float(totals[j]), int(first[j])) for j in top
+        ]
+    return results
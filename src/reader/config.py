@@ -22,7 +22,8 @@ MODEL_ARCHITECTURE = {
 MODEL_OPTIMIZER = {
     'fix_embeddings', 'optimizer', 'learning_rate', 'momentum', 'weight_decay',
     'rnn_padding', 'dropout_rnn', 'dropout_rnn_output', 'dropout_emb',
-    'max_len', 'grad_clipping', 'tune_partial'
+    'max_len', 'grad_clipping', 'tune_partial', 'micro_batch_tokens',
+    'num_train_docs'
 }
 
 
@@ -93,6 +94,13 @@ def add_model_args(parser):
                        help='Explicitly account for padding in RNN encoding')
     optim.add_argument('--max-len', type=int, default=15,
                        help='The max span allowed during decoding')
+    optim.add_argument('--micro-batch-tokens', type=int, default=0,
+                       help='Split training batches into micro-batches of at '
+                       'most this many paragraph tokens (0 = off)')
+    optim.add_argument('--num-train-docs', type=int, default=0,
+                       help='Paragraphs per question of the (shuffled) slots '
+                       'the joint selector + reader loss is trained on '
+                       '(0 = a third of --num-docs)')
 
 
 def get_model_args(args):
@@ -125,4 +133,8 @@ def override_model_args(old_args, new_args):
                 old_args[k] = new_args[k]
             else:
                 logger.info('Keeping saved %s: %s' % (k, old_args[k]))
+    # Optimization options added after the model was saved
+    for k in MODEL_OPTIMIZER:
+        if k not in old_args and k in new_args:
+            old_args[k] = new_args[k]
     return argparse.Namespace(**old_args)
@@ -6,6 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 """Edit from DrQA"""
 
+import os
 import numpy as np
 import logging
 import unicodedata
@@ -13,9 +14,9 @@ import unicodedata
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import Sampler
 from .vector import vectorize, vectorize_with_doc
-from .vector import num_docs
 
 import json
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +27,14 @@ logger = logging.getLogger(__name__)
 
 
 class Dictionary(object):
+    """Token <-> index mapping; tokens are NFD normalized.
+
+    After freeze() the dictionary cannot change, and string lookups and
+    encode() take a fast path: ASCII tokens (already normalized) are looked
+    up directly and the normalized forms of other tokens are memoized. A
+    frozen dictionary pickles as its list of tokens, which is what is sent
+    to DataLoader and tokenizer workers.
+    """
     NULL = '<NULL>'
     UNK = '<UNK>'
     START = 2
@@ -37,6 +46,8 @@ class Dictionary(object):
     def __init__(self):
         self.tok2ind = {self.NULL: 0, self.UNK: 1}
         self.ind2tok = {0: self.NULL, 1: self.UNK}
+        self.frozen = False
+        self._ids = None
 
     def __len__(self):
         return len(self.tok2ind)
@@ -54,10 +65,15 @@ class Dictionary(object):
         if type(key) == int:
             return self.ind2tok.get(key, self.UNK)
         if type(key) == str:
+            if self.frozen:
+                index = self._ids.get(key)
+                return self._lookup(key) if index is None else index
             return self.tok2ind.get(self.normalize(key),
                                     self.tok2ind.get(self.UNK))
 
     def __setitem__(self, key, item):
+        if self.frozen:
+            raise RuntimeError('Dictionary is frozen.')
         if type(key) == int and type(item) == str:
             self.ind2tok[key] = item
         elif type(key) == str and type(item) == int:
@@ -66,6 +82,8 @@ class Dictionary(object):
             raise RuntimeError('Invalid (key, item) types.')
 
     def add(self, token):
+        if self.frozen:
+            raise RuntimeError('Dictionary is frozen.')
         token = self.normalize(token)
         if token not in self.tok2ind:
             index = len(self.tok2ind)
@@ -82,6 +100,61 @@ class Dictionary(object):
                   if k not in {'<NULL>', '<UNK>'}]
         return tokens
 
+    # --------------------------------------------------------------------------
+    # Frozen mode
+    # --------------------------------------------------------------------------
+
+    def freeze(self):
+        """Disallow changes and enable the fast lookup path."""
+        if not self.frozen:
+            # Keys are normalized, so a raw token that is a key is its own
+            # normal form; misses go through _lookup.
+            self._ids = dict(self.tok2ind)
+            self.frozen = True
+        return self
+
+    def unfreeze(self):
+        self.frozen = False
+        self._ids = None
+        return self
+
+    def _lookup(self, token):
+        """Index of a token missing from the fast path table."""
+        if token.isascii():
+            return self.tok2ind[self.UNK]
+        index = self.tok2ind.get(self.normalize(token), self.tok2ind[self.UNK])
+        self._ids[token] = index
+        return index
+
+    def encode(self, tokens):
+        """Indices of a list of tokens (UNK if unknown) as an int64 array."""
+        if not self.frozen:
+            return np.array([self[t] for t in tokens], dtype=np.int64)
+        get = self._ids.get
+        ids = np.fromiter((get(t, -1) for t in tokens), dtype=np.int64,
+                          count=len(tokens))
+        for i in np.flatnonzero(ids < 0):
+            ids[i] = self._lookup(tokens[i])
+        return ids
+
+    def __getstate__(self):
+        if not self.frozen:
+            return {'tok2ind': self.tok2ind, 'ind2tok': self.ind2tok}
+        return {'tokens': [self.ind2tok[i] for i in range(len(self))]}
+
+    def __setstate__(self, state):
+        # Dictionaries pickled before freeze() existed hold tok2ind/ind2tok
+        if 'tokens' in state:
+            self.tok2ind = {t: i for i, t in enumerate(state['tokens'])}
+            self.ind2tok = dict(enumerate(state['tokens']))
+        else:
+            self.tok2ind = state['tok2ind']
+            self.ind2tok = state['ind2tok']
+        self.frozen = False
+        self._ids = None
+        if 'tokens' in state:
+            self.freeze()
+
 
 # ------------------------------------------------------------------------------
 # PyTorch dataset class for SQuAD (and SQuAD-like) data.
@@ -118,11 +191,13 @@ def has_answer(answer, text):
 
 class ReaderDataset_with_Doc(Dataset):
 
-    def __init__(self, examples, model, docs, single_answer=False):
+    def __init__(self, examples, model, docs, single_answer=False,
+                 pad_docs=True):
         self.model = model
         self.examples = examples
         self.single_answer = single_answer
         self.docs = docs
+        self.pad_docs = pad_docs
         #for i in range(len(self.examples)):
         #    for j in range(0, len(self.docs_by_question[i])):
         #        self.docs_by_question[i]['has_answer'] = has_answer(self.examples[i]['answer'], self.docs_by_question[i][document])
@@ -139,12 +214,112 @@ class ReaderDataset_with_Doc(Dataset):
         #if (question not in self.docs_by_question):
         #    logger.info("No find question:%s", question)
         #    return []
-        return vectorize_with_doc(self.examples[index], index, self.model, self.single_answer, self.docs[index])
+        return vectorize_with_doc(self.examples[index], index, self.model, self.single_answer, self.docs[index], self.pad_docs)
 
     def lengths(self):
         #return [(len(ex['document']), len(ex['question']))
         #        for ex in self.examples]
-        return [(len(doc[num_docs-1]['document']), len(doc[num_docs-1]['question'])) for doc in self.docs]
+        return [(len(doc[-1]['document']), len(doc[-1]['question'])) for doc in self.docs]
+
+
+# ------------------------------------------------------------------------------
+# Random-access JSON lines files, parsed on demand.
+# ------------------------------------------------------------------------------
+
+
+def line_offsets(filename):
+    """[start, end) byte offsets of the non-empty lines of filename.
+
+    The index is cached next to the file as <filename>.offsets.npy and
+    rebuilt when it is older than the file or does not cover all of it.
+    """
+    index_file = filename + '.offsets.npy'
+    size = os.path.getsize(filename)
+    if (os.path.isfile(index_file) and
+            os.path.getmtime(index_file) >= os.path.getmtime(filename)):
+        offsets = np.load(index_file)
+        if len(offsets) == 0 or offsets[-1, 1] <= size:
+            return offsets
+
+    logger.info('Indexing lines of %s' % filename)
+    offsets = []
+    position = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line.strip():
+                offsets.append((position, position + len(line)))
+            position += len(line)
+    offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+    try:
+        tmp = '%s.tmp.%d.npy' % (filename, os.getpid())
+        np.save(tmp, offsets)
+        os.replace(tmp, index_file)
+    except OSError as e:
+        logger.warning('Could not cache the line index of %s: %s' %
+                       (filename, e))
+    return offsets
+
+
+class JsonlDataset(Dataset):
+    """Random access to the lines of a JSON lines file, parsed on demand.
+
+    Only the line offsets are kept in memory; a line is read with os.pread
+    (safe in forked DataLoader workers) and decoded when accessed, and the
+    last cache_size decoded lines are kept in an LRU. parse, if given, is
+    applied to every decoded line and must be picklable to be used in
+    DataLoader workers.
+    """
+
+    def __init__(self, filename, parse=None, cache_size=256):
+        self.filename = filename
+        self.parse = parse
+        self.cache_size = cache_size
+        self.offsets = line_offsets(filename)
+        self._fd = None
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Line %d out of range' % index)
+        cache = self._cache
+        if index in cache:
+            cache.move_to_end(index)
+            return cache[index]
+        if self._fd is None:
+            self._fd = os.open(self.filename, os.O_RDONLY)
+        start, end = self.offsets[index]
+        ex = self._decode(os.pread(self._fd, int(end - start), int(start)))
+        if self.cache_size > 0:
+            cache[index] = ex
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return ex
+
+    def __iter__(self):
+        """Decode every line in order, reading the file sequentially."""
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield self._decode(line)
+
+    def _decode(self, line):
+        ex = json.loads(line.decode('utf-8'))
+        return self.parse(ex) if self.parse is not None else ex
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        state['_cache'] = OrderedDict()
+        return state
+
+    def __del__(self):
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
 
 
 # ------------------------------------------------------------------------------
@@ -173,3 +348,65 @@ class SortedBatchSampler(Sampler):
 
     def __len__(self):
         return len(self.lengths)
+
+
+class ResumableSampler(Sampler):
+    """Sequential or shuffled sampler that can restart in the middle of an
+    epoch. The order of an epoch only depends on (seed, epoch).
+
+    With num_replicas > 1 every process iterates the examples
+    rank, rank + num_replicas, ... of that order. The order is padded by
+    wrapping around so all processes get the same number of batches.
+    start counts examples over all processes.
+    """
+
+    def __init__(self, data_source, shuffle=False, seed=0, num_replicas=1,
+                 rank=0):
+        self.num_examples = len(data_source)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """Iterate over epoch, skipping its first start examples."""
+        self.epoch = epoch
+        self.start = start
+
+    def order(self):
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            return rng.permutation(self.num_examples)
+        return np.arange(self.num_examples)
+
+    def __iter__(self):
+        indices = self.order()[self.start:]
+        if self.num_replicas > 1 and len(indices) > 0:
+            indices = np.resize(indices, len(self) * self.num_replicas)
+            indices = indices[self.rank::self.num_replicas]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        remaining = max(self.num_examples - self.start, 0)
+        return (remaining + self.num_replicas - 1) // self.num_replicas
+
+
+class ShardedSampler(Sampler):
+    """Examples rank, rank + num_replicas, ... in order, for evaluation.
+
+    Unlike ResumableSampler nothing is padded, so metrics summed over all
+    processes count every example exactly once.
+    """
+
+    def __init__(self, data_source, num_replicas=1, rank=0):
+        self.num_examples = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_examples, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_examples, self.num_replicas))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Helpers for multi-process data-parallel training with torch.distributed.
+
+Processes are started by a launcher that sets RANK, WORLD_SIZE,
+MASTER_ADDR and MASTER_PORT, e.g.
+
+    python -m torch.distributed.launch --nproc_per_node=4 main.py ...
+
+Everything here is a no-op when the process group is not initialized, so
+single-process training does not need to special case it.
+"""
+
+import os
+import pickle
+import logging
+import numpy as np
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+
+def init(backend='gloo'):
+    """Join the process group described by the launcher's environment.
+
+    Returns (rank, world_size); (0, 1) if not launched distributed.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+    dist.init_process_group(backend=backend, init_method='env://')
+    logger.info('Initialized %s process group: rank %d of %d' %
+                (backend, dist.get_rank(), dist.get_world_size()))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_master():
+    return get_rank() == 0
+
+
+def all_reduce_sum(values):
+    """Sum a list of numbers over all processes, as a float64 numpy array."""
+    tensor = torch.DoubleTensor([float(v) for v in values])
+    if is_initialized():
+        dist.all_reduce(tensor)
+    return tensor.numpy()
+
+
+def all_gather_object(obj):
+    """Gather a picklable object from every process, in rank order."""
+    if not is_initialized():
+        return [obj]
+    payload = torch.from_numpy(
+        np.frombuffer(pickle.dumps(obj), dtype=np.uint8).copy()
+    )
+    sizes = [torch.LongTensor([0]) for _ in range(get_world_size())]
+    dist.all_gather(sizes, torch.LongTensor([payload.numel()]))
+    max_size = max(int(size[0]) for size in sizes)
+    padded = torch.ByteTensor(max_size).zero_()
+    padded[:payload.numel()] = payload
+    gathered = [torch.ByteTensor(max_size) for _ in sizes]
+    dist.all_gather(gathered, padded)
+    return [pickle.loads(g[:int(size[0])].numpy().tobytes())
+            for g, size in zip(gathered, sizes)]
+
+
+def broadcast_parameters(module, src=0):
+    """Copy the parameters and buffers of module on rank src to all ranks."""
+    if not is_initialized():
+        return
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def average_gradients(parameters):
+    """Average the gradients of parameters over all processes.
+
+    Parameters without a gradient count as zero, so every process takes
+    part in the same collective even if it skipped backward. Gradients are
+    flattened into one buffer to make a single all_reduce call.
+    """
+    if not is_initialized():
+        return
+    parameters = list(parameters)
+    for p in parameters:
+        if p.grad is None:
+            p.grad = p.data.new(p.data.size()).zero_()
+    grads = [p.grad.data for p in parameters]
+    flat = torch.cat([g.contiguous().view(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for g in grads:
+        numel = g.numel()
+        g.copy_(flat[offset:offset + numel].view_as(g))
+        offset += numel
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Evidence labels for self-training, stored by question id."""
+
+import os
+import pickle
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NO_LABEL = -1
+
+
+class EvidenceLabels(object):
+    """Flat int32 array of evidence paragraph slots indexed by question id.
+
+    NO_LABEL (-1) marks unlabeled questions. Files are plain .npy arrays,
+    written atomically and memory-mapped copy-on-write when loaded, so
+    labels do not depend on the batch size or order used to produce them.
+    """
+
+    def __init__(self, num_questions=0, labels=None):
+        if labels is None:
+            labels = np.full(num_questions, NO_LABEL, dtype=np.int32)
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, qid):
+        return int(self.labels[qid])
+
+    def __setitem__(self, qid, label):
+        self.labels[qid] = label
+
+    def get(self, qids):
+        """Labels of a list of question ids, as python ints."""
+        return self.labels[np.asarray(qids, dtype=np.int64)].tolist()
+
+    def num_labeled(self):
+        return int(np.count_nonzero(self.labels != NO_LABEL))
+
+    def merge(self, other):
+        """Take other's labels for questions that are unlabeled here.
+
+        Returns the number of labels added.
+        """
+        if len(other) != len(self):
+            raise RuntimeError('Cannot merge %d labels into %d' %
+                               (len(other), len(self)))
+        new = (self.labels == NO_LABEL) & (other.labels != NO_LABEL)
+        self.labels[new] = other.labels[new]
+        return int(np.count_nonzero(new))
+
+    def save(self, filename):
+        """Atomically write the labels to filename (.npy)."""
+        tmp = '%s.tmp.%d' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.labels, dtype=np.int32))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename, num_questions=None):
+        """Memory-map labels saved with save (copy-on-write)."""
+        labels = np.load(filename, mmap_mode='c')
+        if num_questions is not None and len(labels) != num_questions:
+            raise RuntimeError('%s has %d labels for %d questions' %
+                               (filename, len(labels), num_questions))
+        return cls(labels=labels)
+
+    @classmethod
+    def from_legacy(cls, filename, batch_size, num_questions):
+        """Convert a pickled {batch index: [label, ...]} dict.
+
+        Those were written with a sequential sampler, so position i of
+        batch idx is question idx * batch_size + i.
+        """
+        with open(filename, 'rb') as f:
+            legacy = pickle.load(f)
+        store = cls(num_questions)
+        for idx, batch_labels in legacy.items():
+            for i, label in enumerate(batch_labels):
+                store[idx * batch_size + i] = label
+        logger.info('Converted %d legacy evidence labels from %s' %
+                    (store.num_labeled(), filename))
+        return store
@@ -110,7 +110,7 @@ class StackedBRNN(nn.Module):
         padding.
         """
         # Compute sorted sequence lengths
-        lengths = x_mask.data.eq(0).long().sum(1).squeeze()
+        lengths = x_mask.data.eq(0).long().sum(1)
         _, idx_sort = torch.sort(lengths, dim=0, descending=True)
         _, idx_unsort = torch.sort(idx_sort, dim=0)
 
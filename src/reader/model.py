@@ -9,6 +9,7 @@ import numpy as np
 import logging
 import copy
 import random
+import os
 
 import torch.nn as nn
 
@@ -18,12 +19,28 @@ from .rnn_reader import RnnDocReader
 from .rnn_selector import RnnDocSelector
 
 from src.reader import vector
+from src.reader import distributed
+from src.reader.telemetry import TELEMETRY
 
 type_max = True;
 
 logger = logging.getLogger(__name__)
 
 
+def atomic_save(obj, filename):
+    """torch.save obj to a temporary file, then rename it over filename."""
+    tmp = '%s.tmp.%d' % (filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 class DocReader(object):
     """High level model that handles intializing the underlying network
     architecture, saving, updating examples, and predicting examples.
@@ -45,6 +62,7 @@ class DocReader(object):
         self.updates = 0
         self.use_cuda = False
         self.parallel = False
+        self.distributed = False
 
         # Building network. If normalize if false, scores are not normalized
         # 0-1 per paragraph (no softmax).
@@ -82,6 +100,7 @@ class DocReader(object):
         # Add words to dictionary and expand embedding layer
         if len(to_add) > 0:
             logger.info('Adding %d new words to dictionary...' % len(to_add))
+            self.word_dict.unfreeze()
             for w in to_add:
                 self.word_dict.add(w)
             self.args.vocab_size = len(self.word_dict)
@@ -156,6 +175,7 @@ class DocReader(object):
             return
 
         # Shuffle words and vectors
+        self.word_dict.unfreeze()
         embedding = self.network.embedding.weight.data
         for idx, swap_word in enumerate(words, self.word_dict.START):
             # Get current word + embedding for this index
@@ -180,7 +200,7 @@ class DocReader(object):
         """Initialize an optimizer for the free parameters of the network.
 
         Args:
-            state_dict: network parameters
+            state_dict: optimizer state to resume from
         """
         logger.info("init_optimizer")
         if self.args.fix_embeddings:
@@ -200,10 +220,102 @@ class DocReader(object):
         else:
             raise RuntimeError('Unsupported optimizer: %s' %
                                self.args.optimizer)
+        if state_dict:
+            self.optimizer.load_state_dict(state_dict)
 
     # --------------------------------------------------------------------------
     # Learning
     # --------------------------------------------------------------------------
+    def _to_device(self, tensor):
+        return tensor.cuda(non_blocking=True) if self.use_cuda else tensor
+
+    def micro_batches(self, batch_size, tokens_per_example):
+        """Split a batch into [start, end) micro-batches.
+
+        Each micro-batch holds at most args.micro_batch_tokens (padded)
+        tokens, and at least one example. 0 keeps the whole batch.
+        """
+        budget = getattr(self.args, 'micro_batch_tokens', 0)
+        if budget > 0:
+            size = max(1, budget // max(tokens_per_example, 1))
+        else:
+            size = max(batch_size, 1)
+        return [(start, min(start + size, batch_size))
+                for start in range(0, batch_size, size)]
+
+    @staticmethod
+    def _rows(ex, start, end):
+        """Inputs (and paragraph sources) of examples [start, end) of a
+        batch (same padding)."""
+        rows = [e if e is None else e[start:end] for e in ex[:5]]
+        sources = vector.paragraph_sources(ex)
+        if sources is not None:
+            rows.append(sources[start:end])
+        return rows
+
+    def _selector_scores(self, ex_with_doc, first, volatile=False):
+        """Selector scores (batch x slots) of the unique paragraphs.
+
+        The selector only runs on the rows of each slot that hold their
+        paragraph first (see vector.unique_paragraphs). Repeated and absent
+        slots score -1e30, so a softmax over the slots counts every present
+        paragraph once. Also returns the inputs and rows of every slot (None
+        and [] when it has no unique row).
+        """
+        batch_size, num_docs = first.shape
+        scores_doc = Variable(self._to_device(
+            torch.zeros(batch_size, num_docs)), volatile=volatile)
+        repeated = torch.zeros(batch_size, num_docs)
+        inputs_list, rows_list = [], []
+        for idx_doc, ex in enumerate(ex_with_doc):
+            rows = np.flatnonzero(first[:, idx_doc] == idx_doc).tolist()
+            rows_list.append(rows)
+            if not rows:
+                inputs_list.append(None)
+                repeated[:, idx_doc] = -1e30
+                continue
+            inputs = [e if e is None else
+                      Variable(self._to_device(e), volatile=volatile)
+                      for e in vector.select_rows(ex, rows)]
+            inputs_list.append(inputs)
+            scores = self.selector(*inputs)
+            if len(rows) < batch_size:
+                index = self._to_device(torch.LongTensor(rows))
+                scores = Variable(self._to_device(torch.zeros(batch_size)),
+                                  volatile=volatile).index_copy(
+                                      0, index, scores)
+                for i in np.flatnonzero(first[:, idx_doc] != idx_doc):
+                    repeated[i, idx_doc] = -1e30
+            scores_doc[:, idx_doc] = scores
+        scores_doc = scores_doc + Variable(self._to_device(repeated))
+        return scores_doc, inputs_list, rows_list
+
+    def step(self, has_loss=True):
+        """Clip the accumulated gradients and step the optimizer.
+
+        Callers zero the gradients and run backward first (possibly once per
+        micro-batch). When distributed, gradients are averaged over all
+        processes and every process steps if any of them had a loss, which
+        keeps the replicas identical. All processes must call this in
+        lockstep.
+        """
+        if self.distributed:
+            distributed.average_gradients(
+                p for group in self.optimizer.param_groups
+                for p in group['params']
+            )
+            has_loss = distributed.all_reduce_sum([has_loss])[0] > 0
+        if not has_loss:
+            return
+
+        # Clip gradients
+        torch.nn.utils.clip_grad_norm(self.network.parameters(),
+                                      self.args.grad_clipping)
+
+        # Update parameters
+        self.optimizer.step()
+        self.updates += 1
+
     def get_score(self, ex):
         """Forward a batch of examples; step the optimizer to update weights."""
         if not self.optimizer:
@@ -214,7 +326,7 @@ class DocReader(object):
 
         batch_size = ex[0].size(0)
         # Transfer to GPU
-        inputs = [e if e is None else Variable(e.cuda(async=True))
+        inputs = [e if e is None else Variable(self._to_device(e))
                   for e in ex[:5]]
 
         # Run forward
@@ -230,18 +342,45 @@ class DocReader(object):
         # Train mode
         self.network.train()
 
+        batch_size = ex[0].size(0)
+        # The loss is averaged over the examples with an answer.
+        num_items1 = sum(1 for i in range(batch_size) if HasAnswer_list[i][0])
+
+        self.optimizer.zero_grad()
+        total_loss, flag = 0.0, False
+        for start, end in self.micro_batches(batch_size, ex[0].size(1)):
+            with TELEMETRY.phase('forward'):
+                loss, has_loss = self._reader_loss(
+                    self._rows(ex, start, end), target_s[start:end],
+                    target_e[start:end], HasAnswer_list[start:end], num_items1
+                )
+            if has_loss:
+                with TELEMETRY.phase('backward'):
+                    loss.backward()
+                flag = True
+            total_loss += loss.item()
+        with TELEMETRY.phase('optimizer'):
+            self.step(flag)
+
+        # Reset any partially fixed parameters (e.g. rare words)
+        self.reset_parameters()
+
+        return total_loss, batch_size
+
+    def _reader_loss(self, ex, target_s, target_e, HasAnswer_list, num_items1):
+        """Reader loss of a (micro-)batch, normalized by num_items1."""
         batch_size = ex[0].size(0)
         # Transfer to GPU
-        inputs = [e if e is None else Variable(e.cuda(async=True))
+        inputs = [e if e is None else Variable(self._to_device(e))
                   for e in ex[:5]]
 
         # Run forward
         score_s, score_e, _, _ = self.network(*inputs)
 
         # Compute loss and accuracies
-        loss = Variable(torch.FloatTensor([0.0]).cuda())
+        loss = Variable(self._to_device(torch.FloatTensor([0.0])))
         flag = False
-        num_items1, num_items2 = 0, 0
+        num_items2 = 0
         loss1, loss2 = 0, 0
         for i in range(0, batch_size):
             if HasAnswer_list[i][0]: 
@@ -255,7 +394,6 @@ class DocReader(object):
                         else:
                             tmp1 += score_s[i][target_s[i][j][0]]*score_e[i][target_s[i][j][1]]
                     loss1 = loss1 - (tmp1+1e-16).log()
-                    num_items1 +=1
                 except:
                     logger.info(score_s[i].size(0))
                     logger.info(score_e[i].size(0))
@@ -269,28 +407,12 @@ class DocReader(object):
                     tmp2 = tmp2 + score_s[i][target_s[i][j][0]]*score_e[i][target_s[i][j][1]]
                 loss2 = loss2 - (1-tmp2+1e-16).log()
             
-        # Clear gradients and run backward
-        if num_items1>0:
+        if flag:
             loss += loss1/num_items1
 
         #if num_items2>0:
         #    loss += 0.5*loss2/num_items2
-        self.optimizer.zero_grad()
-        if flag:
-            loss.backward()
-
-            # Clip gradients
-            torch.nn.utils.clip_grad_norm(self.network.parameters(),
-                                          self.args.grad_clipping)
-
-            # Update parameters
-            self.optimizer.step()
-            self.updates += 1
-
-        # Reset any partially fixed parameters (e.g. rare words)
-        self.reset_parameters()
-
-        return loss.data[0], ex[0].size(0)
+        return loss, flag
 
     def get_answer_span(self, score_s, score_e):
         batch_size, s_size = score_s.size()
@@ -302,10 +424,14 @@ class DocReader(object):
         end = max_index % s_size
         return start, end
 
-    def update_with_doc(self, update_step, ex_with_doc, pred_s_list_doc, pred_e_list_doc, \
+    def update_with_doc(self, ex_with_doc, pred_s_list_doc, pred_e_list_doc, \
                         top_n, target_s_list, target_e_list, HasAnswer_list, \
                         evidence_label=None, return_prob=False):
-        """Forward a batch of examples; step the optimizer to update weights."""
+        """Forward a batch of examples; step the optimizer to update weights.
+
+        The batch is run in micro-batches of at most args.micro_batch_tokens
+        paragraph tokens whose gradients are accumulated for one step.
+        """
         if not self.optimizer:
             raise RuntimeError('No optimizer set.')
         # Train mode
@@ -318,97 +444,125 @@ class DocReader(object):
         batch_size = ex_with_doc[0][0].size(0)
         if evidence_label is None:
             evidence_label = [-1] * batch_size
-        num_docs = int(vector.num_docs/3)
-        for idx_doc in range(num_docs):
-            pred_s_list_doc[idx_doc] = pred_s_list_doc[idx_doc].cuda(async=True)
-            pred_e_list_doc[idx_doc] = pred_e_list_doc[idx_doc].cuda(async=True)
-        scores_doc = Variable(torch.zeros(batch_size, vector.num_docs).cuda())
-        scores_doc_norm = Variable(torch.zeros(batch_size, vector.num_docs).cuda())
-        inputs_list = []
+        num_docs = min(getattr(self.args, 'num_train_docs', 0) or
+                       int(vector.num_docs/3),
+                       len(ex_with_doc))
         for idx_doc in range(num_docs):
-        # Transfer to GPU
-            ex = ex_with_doc[idx_doc]
-            inputs = [e if e is None else
-                      Variable(e.cuda(async=True))
-                      for e in ex[:5]]
-            inputs_list.append(inputs)
-            scores_doc[:, idx_doc] = self.selector(*inputs)
+            pred_s_list_doc[idx_doc] = self._to_device(pred_s_list_doc[idx_doc])
+            pred_e_list_doc[idx_doc] = self._to_device(pred_e_list_doc[idx_doc])
+
+        # The loss is averaged over the examples with an answer in any of
+        # their paragraphs (of the whole batch, not of each micro-batch).
+        num_items1 = 0
+        for i in range(batch_size):
+            if any(HasAnswer_list[idx_doc][i][0] for idx_doc in range(num_docs)):
+                num_items1 += 1
+        tokens = sum(ex_with_doc[idx_doc][0].size(1) for idx_doc in range(num_docs))
+
+        self.optimizer.zero_grad()
+        total_loss, tot_flag = 0.0, False
+        loss_by_batch, max_value, max_index = [], [], []
+        for start, end in self.micro_batches(batch_size, tokens):
+            with TELEMETRY.phase('forward'):
+                loss, has_loss, probs, attentions = self._joint_loss(
+                    [self._rows(ex_with_doc[idx_doc], start, end)
+                     for idx_doc in range(num_docs)],
+                    [targets[start:end] for targets in target_s_list[:num_docs]],
+                    [has[start:end] for has in HasAnswer_list[:num_docs]],
+                    evidence_label[start:end], num_items1
+                )
+            if return_prob:
+                loss_by_batch.extend(probs)
+                max_value.extend(attentions[0])
+                max_index.extend(attentions[1])
+                continue
+            if has_loss:
+                with TELEMETRY.phase('backward'):
+                    loss.backward()
+                tot_flag = True
+            total_loss += loss.item()
+
+        if return_prob:
+            loss_by_batch = [x.cpu().data.numpy() if type(x) != float else x for x in loss_by_batch]
+            return loss_by_batch, (max_value, max_index)
+
+        with TELEMETRY.phase('optimizer'):
+            self.step(tot_flag)
+
+        # Reset any partially fixed parameters (e.g. rare words)
+        self.reset_parameters()
+
+        return total_loss, batch_size
+
+    def _joint_loss(self, ex_with_doc, target_s_list, HasAnswer_list,
+                    evidence_label, num_items1):
+        """Selector + reader loss of a (micro-)batch, see update_with_doc.
+
+        Returns the loss, whether any example had an answer, the per example
+        answer probability and (max_value, max_index) of the best paragraph.
+        """
+        batch_size = ex_with_doc[0][0].size(0)
+        num_docs = len(ex_with_doc)
+        # Repeated paragraphs are run and counted once, absent ones not at all
+        first = vector.unique_paragraphs(ex_with_doc)
+        scores_doc, inputs_list, rows_list = self._selector_scores(ex_with_doc, first)
+        scores_doc_norm = Variable(self._to_device(torch.zeros(batch_size, num_docs)))
         for i in range(batch_size):
             scores_doc_norm[i] = F.softmax(scores_doc[i])
-        loss = Variable(torch.FloatTensor([0.0]).cuda())
+        loss = Variable(self._to_device(torch.FloatTensor([0.0])))
         loss_by_batch = [0.0 for i in range(batch_size)]
-        loss1 = Variable(torch.FloatTensor([0.0]).cuda())
-        num1 = 0
         flag = [False for i in range(batch_size)]
-        tot_flag = False
         num_answer  = [1e-15 for i in range(batch_size)]
-        for i in range(batch_size):
-            for idx_doc in range(num_docs):
+        for idx_doc in range(num_docs):
+            for i in rows_list[idx_doc]:
                 num_answer[i] += float(HasAnswer_list[idx_doc][i][0])
         max_value, max_index = [-1] * batch_size, [-1] * batch_size
         for idx_doc in range(num_docs):    
+            if not rows_list[idx_doc]:
+                continue
             # Run forward
             inputs = inputs_list[idx_doc]
             score_s, score_e,_,_ = self.network(*inputs)
             start, end = self.get_answer_span(score_s, score_e)
-            for i in range(batch_size):
+            for r, i in enumerate(rows_list[idx_doc]):
                 if (HasAnswer_list[idx_doc][i][0]):
-                    loss += 0.5*Variable(torch.FloatTensor([1.0/num_answer[i]]).cuda()) * (-(scores_doc_norm[i][idx_doc]+1e-16).log() + Variable(torch.FloatTensor([1.0/num_answer[i]]).cuda().log()))
+                    loss += 0.5*Variable(self._to_device(torch.FloatTensor([1.0/num_answer[i]]))) * (-(scores_doc_norm[i][idx_doc]+1e-16).log() + Variable(self._to_device(torch.FloatTensor([1.0/num_answer[i]])).log()))
                     #if evidence_label[i] == -1:
-                    #    loss += 0.5*Variable(torch.FloatTensor([1.0/num_answer[i]]).cuda()) * (-(scores_doc_norm[i][idx_doc]+1e-16).log() + Variable(torch.FloatTensor([1.0/num_answer[i]]).cuda().log()))
-                    tmp1 = score_s[i][target_s_list[idx_doc][i][0][0]]*score_e[i][target_s_list[idx_doc][i][0][1]]
+                    #    loss += 0.5*Variable(self._to_device(torch.FloatTensor([1.0/num_answer[i]]))) * (-(scores_doc_norm[i][idx_doc]+1e-16).log() + Variable(self._to_device(torch.FloatTensor([1.0/num_answer[i]])).log()))
+                    tmp1 = score_s[r][target_s_list[idx_doc][i][0][0]]*score_e[r][target_s_list[idx_doc][i][0][1]]
                     for j in range(1, len(target_s_list[idx_doc][i])):
                         if (type_max):
-                            if (tmp1.data.cpu().numpy()<( score_s[i][target_s_list[idx_doc][i][j][0]]*score_e[i][target_s_list[idx_doc][i][j][1]]).data.cpu().numpy()):
-                                tmp1 =  score_s[i][target_s_list[idx_doc][i][j][0]]*score_e[i][target_s_list[idx_doc][i][j][1]]
+                            if (tmp1.data.cpu().numpy()<( score_s[r][target_s_list[idx_doc][i][j][0]]*score_e[r][target_s_list[idx_doc][i][j][1]]).data.cpu().numpy()):
+                                tmp1 =  score_s[r][target_s_list[idx_doc][i][j][0]]*score_e[r][target_s_list[idx_doc][i][j][1]]
                         else:
-                            tmp1 +=  score_s[i][target_s_list[idx_doc][i][j][0]]*score_e[i][target_s_list[idx_doc][i][j][1]]
+                            tmp1 +=  score_s[r][target_s_list[idx_doc][i][j][0]]*score_e[r][target_s_list[idx_doc][i][j][1]]
                     loss_by_batch[i] += tmp1*scores_doc_norm[i][idx_doc]
                     flag[i] = True
 
                     tmp2 = tmp1#*scores_doc_norm[i][idx_doc]
                     if tmp2.data.cpu().numpy() > max_value[i]:
                         for _start, _end in target_s_list[idx_doc][i]:
-                            if _start == start[i] and _end == end[i]:   
+                            if _start == start[r] and _end == end[r]:   
                                 max_value[i] = tmp2.data.cpu().numpy()
                                 max_index[i] = idx_doc
 
-        if return_prob:
-            loss_by_batch = [x.cpu().data.numpy() if type(x) != float else x for x in loss_by_batch]
-            return loss_by_batch, (max_value, max_index)
-
         evidence_loss_by_batch = [0. for i in range(batch_size)]
         for i in range(batch_size):
             if evidence_label[i] == -1:
                 continue
-            evidence_loss_by_batch[i] = .8 * (scores_doc_norm[i][evidence_label[i]]+1e-16).log()
+            # The evidence may be outside of the slots trained on
+            evidence = evidence_label[i]
+            if evidence >= num_docs or first[i, evidence] < 0:
+                continue
+            evidence = int(first[i, evidence])
+            evidence_loss_by_batch[i] = .8 * (scores_doc_norm[i][evidence]+1e-16).log()
                     
-        num_items1 = 0
-        for i in range(batch_size):
-            if (flag[i]):
-                num_items1+=1
         for i in range(batch_size):
             if (flag[i]):
                 loss-=1.0/num_items1*((loss_by_batch[i]+1e-16).log())
                 loss-=1.0/num_items1*evidence_loss_by_batch[i]
-                tot_flag = True
-        if (num1>0):
-            tot_flag = True
-            loss-=1.0/num1*loss1
-        self.optimizer.zero_grad()
-        if tot_flag:
-            loss.backward()
-            # Clip gradients
-            torch.nn.utils.clip_grad_norm(self.network.parameters(),
-                                          self.args.grad_clipping)
-            # Update parameters
-            self.optimizer.step()
-            self.updates += 1
-
-        # Reset any partially fixed parameters (e.g. rare words)
-        self.reset_parameters()
+        return loss, any(flag), loss_by_batch, (max_value, max_index)
 
-        return loss.data[0], batch_size
     def pretrain_selector(self, ex_with_doc, HasAnswer_list):
         """Forward a batch of examples; step the optimizer to update weights."""
         if not self.optimizer:
@@ -417,63 +571,56 @@ class DocReader(object):
         self.network.train()
         self.selector.train()
         batch_size = ex_with_doc[0][0].size(0)
-        scores_doc = Variable(torch.zeros(batch_size, vector.num_docs).cuda())
-        scores_doc_norm = Variable(torch.zeros(batch_size, vector.num_docs).cuda())
-        scores_doc_norm1 = Variable(torch.zeros(batch_size, vector.num_docs).cuda())
-        num_docs = int(vector.num_docs)
-        for idx_doc in range(num_docs):
-        # Transfer to GPU
-            ex = ex_with_doc[idx_doc]
-            inputs = [e if e is None else
-                      Variable(e.cuda(async=True))
-                      for e in ex[:5]]
-            scores_doc[:, idx_doc] = self.selector(*inputs)#.pow(2)
+        num_docs = len(ex_with_doc)
+        tokens = sum(ex_with_doc[idx_doc][0].size(1) for idx_doc in range(num_docs))
+
+        self.optimizer.zero_grad()
+        total_loss, flag = 0.0, False
+        for start, end in self.micro_batches(batch_size, tokens):
+            with TELEMETRY.phase('forward'):
+                loss, has_loss = self._selector_loss(
+                    [self._rows(ex_with_doc[idx_doc], start, end)
+                     for idx_doc in range(num_docs)],
+                    HasAnswer_list[:, start:end]
+                )
+            if has_loss:
+                with TELEMETRY.phase('backward'):
+                    loss.backward()
+                flag = True
+            total_loss += loss.item()
+        with TELEMETRY.phase('optimizer'):
+            self.step(flag)
+
+        # Reset any partially fixed parameters (e.g. rare words)
+        self.reset_parameters()
+
+        return total_loss, batch_size
+
+    def _selector_loss(self, ex_with_doc, HasAnswer_list):
+        """Selector loss of a (micro-)batch, see pretrain_selector."""
+        batch_size = ex_with_doc[0][0].size(0)
+        num_docs = len(ex_with_doc)
+        # Repeated paragraphs are run and counted once, absent ones not at all
+        first = vector.unique_paragraphs(ex_with_doc)
+        scores_doc, _, _ = self._selector_scores(ex_with_doc, first)
+        scores_doc_norm = Variable(self._to_device(torch.zeros(batch_size, num_docs)))
         for i in range(batch_size):
             scores_doc_norm[i] = F.softmax(scores_doc[i])
-        loss = Variable(torch.FloatTensor([0.0]).cuda())
-        loss1 = 0
-        loss2 = 0
-        num_items1 = 0
-        num_items2 = 0
+        loss = Variable(self._to_device(torch.FloatTensor([0.0])))
         flag = False
         for i in range(batch_size):
-            s = ''
+            unique = [idx_doc for idx_doc in range(num_docs)
+                      if first[i, idx_doc] == idx_doc]
             num_answer = 1e-15
-            for idx_doc in range(num_docs):
+            for idx_doc in unique:
                 num_answer += float(HasAnswer_list[idx_doc][i])
-            flag1 = False
-            tmp1 = 0
-            for idx_doc in range(num_docs):
+            for idx_doc in unique:
                 if (HasAnswer_list[idx_doc][i]==1):
                     flag = True
                     if (scores_doc_norm[i][idx_doc].data.cpu().numpy()>1e-16):
                         
-                        loss += Variable(torch.FloatTensor([1.0/num_answer]).cuda()) * (-(scores_doc_norm[i][idx_doc]+1e-16).log() + Variable(torch.FloatTensor([1.0/num_answer]).cuda().log()))
-                   
-                    tmp1 += scores_doc_norm[i][idx_doc]
-            if (flag1):
-                loss1 -= (tmp1+1e-16).log()
-                num_items1+=1
-            
-        if (num_items1>0):
-            loss+= loss1/num_items1
-        
-        self.optimizer.zero_grad()
-        if flag:
-            loss.backward()
-
-            # Clip gradients
-            torch.nn.utils.clip_grad_norm(self.network.parameters(),
-                                          self.args.grad_clipping)
-
-            # Update parameters
-            self.optimizer.step()
-            self.updates += 1
-
-        # Reset any partially fixed parameters (e.g. rare words)
-        self.reset_parameters()
-
-        return loss.data[0], batch_size
+                        loss += Variable(self._to_device(torch.FloatTensor([1.0/num_answer]))) * (-(scores_doc_norm[i][idx_doc]+1e-16).log() + Variable(self._to_device(torch.FloatTensor([1.0/num_answer])).log()))
+        return loss, flag
 
     def reset_parameters(self):
         """Reset any partially fixed parameters to original states."""
@@ -495,22 +642,75 @@ class DocReader(object):
     # Prediction
     # --------------------------------------------------------------------------
     def predict_with_doc(self, ex_with_doc):
+        """Selector probabilities (batch x slots) of the paragraphs.
+
+        Each paragraph is scored once; slots repeating an earlier paragraph
+        and absent slots get probability 0.
+        """
         self.selector.eval()
         self.network.eval()
         batch_size = ex_with_doc[0][0].size(0)
 
-        scores_doc = Variable(torch.zeros(batch_size, vector.num_docs).cuda())
-        scores_doc_norm = Variable(torch.zeros(batch_size, vector.num_docs).cuda())
-        for idx_doc in range(vector.num_docs):
-            ex = ex_with_doc[idx_doc]
+        scores_doc_norm = Variable(torch.zeros(batch_size, len(ex_with_doc)))
+        with TELEMETRY.phase('select'):
+            first = vector.unique_paragraphs(ex_with_doc)
+            scores_doc, _, _ = self._selector_scores(ex_with_doc, first,
+                                                     volatile=True)
+            scores_doc = scores_doc.cpu()
+            for i in range(batch_size):
+                scores_doc_norm[i] = F.softmax(scores_doc[i])
+
+        return scores_doc_norm.data.cpu() 
+
+    def predict_docs(self, ex_with_doc, top_n=1):
+        """Reader predictions for every slot, reading each paragraph once.
+
+        Output:
+            a list over the slots of (pred_s, pred_e, pred_score) as returned
+            by predict; slots repeating an earlier slot's paragraph share
+            its predictions, absent slots have none (empty arrays).
+        """
+        first = vector.unique_paragraphs(ex_with_doc)
+        batch_size = first.shape[0]
+        preds = []
+        for idx_doc, ex in enumerate(ex_with_doc):
+            pred = ([None] * batch_size, [None] * batch_size,
+                    [None] * batch_size)
+            rows = np.flatnonzero(first[:, idx_doc] == idx_doc).tolist()
+            if rows:
+                unique = self.predict(vector.select_rows(ex, rows),
+                                      top_n=top_n)
+                for r, i in enumerate(rows):
+                    for p, u in zip(pred, unique):
+                        p[i] = u[r]
+            for i in np.flatnonzero(first[:, idx_doc] != idx_doc):
+                if first[i, idx_doc] < 0:
+                    pred[0][i] = pred[1][i] = np.zeros(0, dtype=np.int64)
+                    pred[2][i] = np.zeros(0)
+                    continue
+                for p, source in zip(pred, preds[first[i, idx_doc]]):
+                    p[i] = source[i]
+            preds.append(pred)
+        return preds
+
+    def predict_selector(self, ex):
+        """Score a flat batch of paragraphs with the selector.
+
+        Unlike predict_with_doc, every row of ex is its own paragraph (and
+        question), so any number of paragraphs is scored in one forward.
+        Output:
+            scores: batch unnormalized selector scores
+        """
+        self.selector.eval()
+        if self.use_cuda:
             inputs = [e if e is None else
-                      Variable(e.cuda(async=True), volatile=True)
+                      Variable(e.cuda(non_blocking=True), volatile=True)
                       for e in ex[:5]]
-            scores_doc[:, idx_doc] = self.selector(*inputs)
-        for i in range(batch_size):
-            scores_doc_norm[i] = F.softmax(scores_doc[i])
+        else:
+            inputs = [e if e is None else Variable(e, volatile=True)
+                      for e in ex[:5]]
+        return self.selector(*inputs).data.cpu()
 
-        return scores_doc_norm.data.cpu() 
     def predict(self, ex, candidates=None, top_n=1, async_pool=None):
         """Forward a batch of examples only to get predictions.
 
@@ -534,30 +734,33 @@ class DocReader(object):
         # Transfer to GPU
         if self.use_cuda:
             inputs = [e if e is None else
-                      Variable(e.cuda(async=True), volatile=True)
+                      Variable(e.cuda(non_blocking=True), volatile=True)
                       for e in ex[:5]]
         else:
             inputs = [e if e is None else Variable(e, volatile=True)
                       for e in ex[:5]]
 
         # Run forward
-        score_s, score_e, _, _ = self.network(*inputs)
+        with TELEMETRY.phase('predict'):
+            score_s, score_e, _, _ = self.network(*inputs)
+            score_s = score_s.data.cpu()
+            score_e = score_e.data.cpu()
 
         # Decode predictions
-        score_s = score_s.data.cpu()
-        score_e = score_e.data.cpu()
         if candidates:
             args = (score_s, score_e, candidates, top_n, self.args.max_len)
             if async_pool:
                 return async_pool.apply_async(self.decode_candidates, args)
             else:
-                return self.decode_candidates(*args)
+                with TELEMETRY.phase('decode'):
+                    return self.decode_candidates(*args)
         else:
             args = (score_s, score_e, top_n, self.args.max_len)
             if async_pool:
                 return async_pool.apply_async(self.decode, args)
             else:
-                return self.decode(*args)
+                with TELEMETRY.phase('decode'):
+                    return self.decode(*args)
 
     @staticmethod
     def decode(score_s, score_e, top_n=1, max_len=None):
@@ -611,7 +814,7 @@ class DocReader(object):
 
             if not cands:
                 # try getting from globals? (multiprocessing in pipeline mode)
-                from ..pipeline.drqa import PROCESS_CANDS
+                from ..pipeline.openqa import PROCESS_CANDS
                 cands = PROCESS_CANDS
             if not cands:
                 raise RuntimeError('No candidates given.')
@@ -650,7 +853,8 @@ class DocReader(object):
     # --------------------------------------------------------------------------
 
     def save(self, filename):
-        state_dict = copy.copy(self.network.state_dict())
+        network = self.network.module if self.parallel else self.network
+        state_dict = copy.copy(network.state_dict())
         state_dict_selector = copy.copy(self.selector.state_dict())
         if 'fixed_embedding' in state_dict:
             state_dict.pop('fixed_embedding')
@@ -662,21 +866,33 @@ class DocReader(object):
             'args': self.args,
         }
         try:
-            torch.save(params, filename)
+            atomic_save(params, filename)
         except BaseException:
             logger.warning('WARN: Saving failed... continuing anyway.')
 
-    def checkpoint(self, filename, epoch):
+    def checkpoint(self, filename, epoch, train_state=None):
+        """Save everything needed to resume training.
+
+        Args:
+            filename: checkpoint file (replaced atomically).
+            epoch: epoch to resume at.
+            train_state: extra picklable training state (data position,
+              labels, RNG state, ...) returned again by load_checkpoint.
+        """
+        network = self.network.module if self.parallel else self.network
         params = {
-            'state_dict': self.network.state_dict(),
+            'state_dict': network.state_dict(),
+            'state_dict_selector': self.selector.state_dict(),
             'word_dict': self.word_dict,
             'feature_dict': self.feature_dict,
             'args': self.args,
             'epoch': epoch,
+            'updates': self.updates,
             'optimizer': self.optimizer.state_dict(),
+            'train_state': train_state,
         }
         try:
-            torch.save(params, filename)
+            atomic_save(params, filename)
         except BaseException:
             logger.warning('WARN: Saving failed... continuing anyway.')
 
@@ -701,6 +917,7 @@ class DocReader(object):
 
     @staticmethod
     def load_checkpoint(filename, normalize=True):
+        """Load a checkpoint; returns (model, epoch, train_state)."""
         logger.info('Loading model %s' % filename)
         saved_params = torch.load(
             filename, map_location=lambda storage, loc: storage
@@ -708,12 +925,15 @@ class DocReader(object):
         word_dict = saved_params['word_dict']
         feature_dict = saved_params['feature_dict']
         state_dict = saved_params['state_dict']
+        state_dict_selector = saved_params.get('state_dict_selector')
         epoch = saved_params['epoch']
         optimizer = saved_params['optimizer']
         args = saved_params['args']
-        model = DocReader(args, word_dict, feature_dict, state_dict, normalize)
+        model = DocReader(args, word_dict, feature_dict, state_dict, normalize,
+                          state_dict_selector)
+        model.updates = saved_params.get('updates', 0)
         model.init_optimizer(optimizer)
-        return model, epoch
+        return model, epoch, saved_params.get('train_state')
 
     # --------------------------------------------------------------------------
     # Runtime
@@ -723,6 +943,12 @@ class DocReader(object):
         self.use_cuda = True
         self.network = self.network.cuda()
         self.selector = self.selector.cuda()
+        # Optimizer state loaded from a checkpoint lives on the CPU.
+        if getattr(self, 'optimizer', None) is not None:
+            for state in self.optimizer.state.values():
+                for k, v in state.items():
+                    if torch.is_tensor(v):
+                        state[k] = v.cuda()
 
     def cpu(self):
         self.use_cuda = False
@@ -735,3 +961,16 @@ class DocReader(object):
         """
         self.parallel = True
         self.network = torch.nn.DataParallel(self.network)
+
+    def distribute(self):
+        """Train as one replica of a torch.distributed process group.
+
+        Reader and selector start from rank 0's weights; step then averages
+        their gradients over all processes. Each process feeds its own shard
+        of the data (see data.ResumableSampler).
+        """
+        if self.parallel:
+            raise RuntimeError('Cannot combine parallelize and distribute')
+        self.distributed = True
+        distributed.broadcast_parameters(self.network)
+        distributed.broadcast_parameters(self.selector)
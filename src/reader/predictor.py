@@ -6,29 +6,34 @@
 # LICENSE file in the root directory of this source tree.
 """DrQA Document Reader predictor"""
 
+import argparse
 import logging
 
-from multiprocessing import Pool as ProcessPool
+from multiprocessing import cpu_count
 from multiprocessing.util import Finalize
 
-from .vector import vectorize, batchify
-from .model import DocReader
-from . import DEFAULTS, utils
+from .aggregator import SpanAggregator
+from . import DEFAULTS
 from .. import tokenizers
 
+# torch, the model and the vectorizer are imported where they are used, so
+# that importing the predictor does not wait for torch.
+
 logger = logging.getLogger(__name__)
 
 
 # ------------------------------------------------------------------------------
-# Tokenize + annotate
+# Tokenize + annotate + vectorize
 # ------------------------------------------------------------------------------
 
 PROCESS_TOK = None
+PROCESS_VEC = None
 
 
-def init(tokenizer_class, annotators):
-    global PROCESS_TOK
+def init(tokenizer_class, annotators, vectorizer=None):
+    global PROCESS_TOK, PROCESS_VEC
     PROCESS_TOK = tokenizer_class(annotators=annotators)
+    PROCESS_VEC = vectorizer
     Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
 
 
@@ -37,6 +42,70 @@ def tokenize(text):
     return PROCESS_TOK.tokenize(text)
 
 
+def vectorize_chunk(items):
+    global PROCESS_TOK, PROCESS_VEC
+    return _vectorize_chunk(PROCESS_TOK, PROCESS_VEC, items)
+
+
+def _vectorize_chunk(tokenizer, vectorizer, items):
+    """Tokenize and torchify a chunk of (id, document, question, keep_tokens).
+
+    The chunk is packed into a handful of flat tensors (see unpack_chunk) so
+    that a torch.multiprocessing worker hands it back through a few shared
+    memory segments instead of pickling Tokens. Document Tokens are only
+    returned when keep_tokens is set (they are needed to decode candidates).
+    """
+    import torch
+    from .vector import vectorize
+
+    examples, offsets, tokens = [], [], []
+    for idx, document, question, keep_tokens in items:
+        q_tokens = tokenizer.tokenize(question)
+        d_tokens = tokenizer.tokenize(document)
+        examples.append(vectorize({
+            'id': idx,
+            'question': q_tokens.words(),
+            'qlemma': q_tokens.lemmas(),
+            'document': d_tokens.words(),
+            'lemma': d_tokens.lemmas(),
+            'pos': d_tokens.pos(),
+            'ner': d_tokens.entities(),
+        }, vectorizer))
+        offsets.extend(d_tokens.offsets())
+        tokens.append(d_tokens if keep_tokens else None)
+
+    ids = [ex[-1] for ex in examples]
+    d_lengths = torch.LongTensor([ex[0].size(0) for ex in examples])
+    q_lengths = torch.LongTensor([ex[2].size(0) for ex in examples])
+    documents = torch.cat([ex[0] for ex in examples])
+    questions = torch.cat([ex[2] for ex in examples])
+    features = None
+    if examples[0][1] is not None:
+        features = torch.cat([ex[1] for ex in examples])
+    offsets = torch.IntTensor(offsets).view(-1, 2)
+    return (ids, d_lengths, q_lengths, documents, features, questions,
+            offsets, tokens)
+
+
+def unpack_chunk(chunk):
+    """Split a packed chunk into per example (example, offsets, tokens)."""
+    ids, d_lengths, q_lengths, documents, features, questions, offsets, \
+        tokens = chunk
+    d_starts = [0] + d_lengths.cumsum(0).tolist()
+    q_starts = [0] + q_lengths.cumsum(0).tolist()
+    unpacked = []
+    for i in range(len(ids)):
+        d_start, d_len = d_starts[i], d_lengths[i].item()
+        q_start, q_len = q_starts[i], q_lengths[i].item()
+        ex = (documents.narrow(0, d_start, d_len),
+              None if features is None else
+              features.narrow(0, d_start, d_len),
+              questions.narrow(0, q_start, q_len),
+              ids[i])
+        unpacked.append((ex, offsets.narrow(0, d_start, d_len), tokens[i]))
+    return unpacked
+
+
 # ------------------------------------------------------------------------------
 # Predictor class.
 # ------------------------------------------------------------------------------
@@ -45,6 +114,12 @@ def tokenize(text):
 class Predictor(object):
     """Load a pretrained DocReader model and predict inputs on the fly."""
 
+    # Number of reader forward passes per predict_open question.
+    NUM_BUCKETS = 2
+
+    # Spans decoded per paragraph before aggregating over paragraphs.
+    READ_TOP_N = 10
+
     def __init__(self, model=None, tokenizer=None, normalize=True,
                  embedding_file=None, num_workers=None):
         """
@@ -56,6 +131,10 @@ class Predictor(object):
               available pretrained vectors in this file.
             num_workers: number of CPU processes to use to preprocess batches.
         """
+        from torch.multiprocessing import Pool as ProcessPool
+        from .model import DocReader
+        from . import utils
+
         logger.info('Initializing model...')
         self.model = DocReader.load(model or DEFAULTS['model'],
                                     normalize=normalize)
@@ -65,6 +144,7 @@ class Predictor(object):
             words = utils.index_embedding_words(embedding_file)
             added = self.model.expand_dictionary(words)
             self.model.load_embeddings(added, embedding_file)
+        self.model.word_dict.freeze()
 
         logger.info('Initializing tokenizer...')
         annotators = tokenizers.get_annotators_for_model(self.model)
@@ -73,12 +153,19 @@ class Predictor(object):
         else:
             tokenizer_class = tokenizers.get_class(tokenizer)
 
+        # What vectorize needs from the model, shipped once to every worker.
+        self.vectorizer = argparse.Namespace(
+            args=self.model.args,
+            word_dict=self.model.word_dict,
+            feature_dict=self.model.feature_dict,
+        )
         if num_workers is None or num_workers > 0:
             self.workers = ProcessPool(
                 num_workers,
                 initializer=init,
-                initargs=(tokenizer_class, annotators),
+                initargs=(tokenizer_class, annotators, self.vectorizer),
             )
+            self.num_workers = num_workers or cpu_count()
         else:
             self.workers = None
             self.tokenizer = tokenizer_class(annotators=annotators)
@@ -90,6 +177,8 @@ class Predictor(object):
 
     def predict_batch(self, batch, top_n=1):
         """Predict a batch of document - question pairs."""
+        from .vector import batchify
+
         documents, questions, candidates = [], [], []
         for b in batch:
             documents.append(b[0])
@@ -97,27 +186,10 @@ class Predictor(object):
             candidates.append(b[2] if len(b) == 3 else None)
         candidates = candidates if any(candidates) else None
 
-        # Tokenize the inputs, perhaps multi-processed.
-        if self.workers:
-            q_tokens = self.workers.map_async(tokenize, questions)
-            d_tokens = self.workers.map_async(tokenize, documents)
-            q_tokens = list(q_tokens.get())
-            d_tokens = list(d_tokens.get())
-        else:
-            q_tokens = list(map(self.tokenizer.tokenize, questions))
-            d_tokens = list(map(self.tokenizer.tokenize, documents))
-
-        examples = []
-        for i in range(len(questions)):
-            examples.append({
-                'id': i,
-                'question': q_tokens[i].words(),
-                'qlemma': q_tokens[i].lemmas(),
-                'document': d_tokens[i].words(),
-                'lemma': d_tokens[i].lemmas(),
-                'pos': d_tokens[i].pos(),
-                'ner': d_tokens[i].entities(),
-            })
+        # Tokenize and vectorize the inputs, perhaps multi-processed.
+        examples, offsets, d_tokens = self._vectorize(
+            documents, questions, bool(candidates)
+        )
 
         # Stick document tokens in candidates for decoding
         if candidates:
@@ -125,7 +197,7 @@ class Predictor(object):
                           for i in range(len(candidates))]
 
         # Build the batch and run it through the model
-        batch_exs = batchify([vectorize(e, self.model) for e in examples])
+        batch_exs = batchify(examples)
         s, e, score = self.model.predict(batch_exs, candidates, top_n)
 
         # Retrieve the predicted spans
@@ -133,11 +205,92 @@ class Predictor(object):
         for i in range(len(s)):
             predictions = []
             for j in range(len(s[i])):
-                span = d_tokens[i].slice(s[i][j], e[i][j] + 1).untokenize()
-                predictions.append((span, score[i][j]))
+                start = offsets[i][s[i][j]][0].item()
+                end = offsets[i][e[i][j]][1].item()
+                predictions.append((documents[i][start:end], score[i][j]))
             results.append(predictions)
         return results
 
+    def predict_open(self, question, paragraphs, candidates=None, top_n=1,
+                     n_read=None, aggregation='sum'):
+        """Predict the answer to one question over many paragraphs.
+
+        All paragraphs are scored by the selector in one forward pass, the
+        n_read best (all if None) are read in NUM_BUCKETS batches of similar
+        length, and span scores weighted by the selector probabilities are
+        combined over paragraphs (see aggregator.py for the modes).
+
+        Returns:
+            top_n (span, score, paragraph index) tuples.
+        """
+        import torch.nn.functional as F
+        from .vector import batchify
+
+        if n_read is not None and n_read < 0:
+            raise RuntimeError('Invalid n_read: %d' % n_read)
+        if len(paragraphs) == 0 or n_read == 0:
+            return []
+        examples, offsets, d_tokens = self._vectorize(
+            paragraphs, [question] * len(paragraphs), bool(candidates)
+        )
+
+        # Score every paragraph with the selector in one batch.
+        doc_scores = self.model.predict_selector(batchify(examples))
+        doc_probs = F.softmax(doc_scores, 0).tolist()
+        selected = sorted(range(len(paragraphs)),
+                          key=lambda i: -doc_probs[i])[:n_read]
+
+        # Read the selected paragraphs in a fixed number of length buckets.
+        selected.sort(key=lambda i: examples[i][0].size(0))
+        bucket_size = max(1, -(-len(selected) // self.NUM_BUCKETS))
+        aggregator = SpanAggregator(aggregation)
+        spans = []
+        for start in range(0, len(selected), bucket_size):
+            bucket = selected[start:start + bucket_size]
+            bucket_cands = None
+            if candidates:
+                bucket_cands = [{'input': d_tokens[i], 'cands': candidates}
+                                for i in bucket]
+            s, e, score = self.model.predict(
+                batchify([examples[i] for i in bucket]), bucket_cands,
+                max(self.READ_TOP_N, top_n)
+            )
+            for row, i in enumerate(bucket):
+                text, token_spans = paragraphs[i], offsets[i].tolist()
+                words = [text[a:b] for a, b in token_spans]
+                aggregator.add(0, words, s[row], e[row], score[row],
+                               doc_probs[i])
+                # Invalid spans (e.g. in the padding of shorter paragraphs of
+                # the bucket) are skipped by the aggregator but keep an index.
+                spans.extend((text[token_spans[s_][0]:token_spans[e_][1]]
+                              if s_ <= e_ < len(words) else None, i)
+                             for s_, e_ in zip(s[row], e[row]))
+
+        best = aggregator.best(top_n).get(0, [])
+        return [spans[index][:1] + (score,) + spans[index][1:]
+                for score, index in best]
+
+    def _vectorize(self, documents, questions, keep_tokens=False):
+        """Tokenize and vectorize pairs, perhaps multi-processed.
+
+        Returns per pair the vectorized example, the document token offsets
+        and (if keep_tokens) the document Tokens.
+        """
+        items = [(i, documents[i], questions[i], keep_tokens)
+                 for i in range(len(questions))]
+        if self.workers:
+            chunksize = max(1, -(-len(items) // (4 * self.num_workers)))
+            chunks = self.workers.map(vectorize_chunk, [
+                items[i:i + chunksize]
+                for i in range(0, len(items), chunksize)
+            ])
+        else:
+            chunks = [_vectorize_chunk(self.tokenizer, self.vectorizer, items)]
+        examples, offsets, d_tokens = zip(*[
+            ex for chunk in chunks for ex in unpack_chunk(chunk)
+        ])
+        return examples, offsets, d_tokens
+
     def cuda(self):
         self.model.cuda()
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Profile selected iterations of the training and validation loops.
+
+Usage:
+    PROFILER.configure(model_dir, steps='100:110', loops=['train'],
+                       tools=['autograd', 'cprofile'])
+    for idx, ex in enumerate(PROFILER.wrap(loader, model_name, 'train',
+                                           epoch, model)):
+        ...
+
+Iterations [start, end) of every epoch of the configured loops are run
+under the chosen tools. Results go to model_dir as
+<model_name>.<loop>.e<epoch>.s<start>-<end>.*:
+    trace.json    autograd profiler Chrome trace (chrome://tracing)
+    ops.txt       autograd profiler table of ops by total time
+    pstats        cProfile stats (python -m pstats, snakeviz)
+    modules.json  forward time and calls of every reader/selector module
+"""
+
+import os
+import json
+import time
+import cProfile
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+LOOPS = {'train', 'pretrain_reader', 'pretrain_selector', 'validate'}
+TOOLS = {'autograd', 'cprofile', 'modules'}
+
+
+def parse_steps(steps):
+    """'start:end' (end exclusive) or 'step' -> (start, end)."""
+    if ':' in steps:
+        start, end = steps.split(':')
+        return int(start), int(end)
+    return int(steps), int(steps) + 1
+
+
+class ModuleTimer(object):
+    """Forward-time breakdown of modules, gathered with forward hooks.
+
+    Times are inclusive (a module's time contains its children's), on the
+    host; with cuda=True every hook synchronizes so GPU time is included.
+    """
+
+    def __init__(self, cuda=False):
+        self.cuda = cuda
+        self.seconds = {}
+        self.calls = {}
+        self._starts = {}
+        self._handles = []
+
+    def attach(self, prefix, module):
+        for name, submodule in module.named_modules():
+            name = '.'.join(n for n in (prefix, name) if n)
+            self._handles.append(
+                submodule.register_forward_pre_hook(self._pre_hook(name))
+            )
+            self._handles.append(
+                submodule.register_forward_hook(self._hook(name))
+            )
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self._sync()
+            self._starts.setdefault(name, []).append(time.perf_counter())
+        return hook
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            self._sync()
+            start = self._starts[name].pop()
+            self.seconds[name] = (self.seconds.get(name, 0.0) +
+                                  time.perf_counter() - start)
+            self.calls[name] = self.calls.get(name, 0) + 1
+        return hook
+
+    def summary(self):
+        return [{'module': name, 'seconds': s, 'calls': self.calls[name]}
+                for name, s in sorted(self.seconds.items(),
+                                      key=lambda item: -item[1])]
+
+
+class StepProfiler(object):
+    """Run chosen iterations of chosen loops under the profilers."""
+
+    def __init__(self):
+        self.enabled = False
+        self.active = None
+
+    def configure(self, model_dir, steps, loops=('train',),
+                  tools=('autograd', 'cprofile', 'modules'), cuda=False):
+        for loop in loops:
+            if loop not in LOOPS:
+                raise RuntimeError('Unsupported profile loop: %s' % loop)
+        for tool in tools:
+            if tool not in TOOLS:
+                raise RuntimeError('Unsupported profiler: %s' % tool)
+        self.model_dir = model_dir
+        self.start, self.end = parse_steps(steps)
+        self.loops = set(loops)
+        self.tools = set(tools)
+        self.cuda = cuda
+        self.enabled = True
+        return self
+
+    def wrap(self, iterable, model_name, loop, epoch, model, tag=None):
+        """Iterate over iterable, profiling iterations [start, end).
+
+        Output files are prefixed with model_name; tag (e.g. the validation
+        mode) is added to the loop name.
+        """
+        if not self.enabled or loop not in self.loops:
+            for item in iterable:
+                yield item
+            return
+        if tag:
+            loop = '%s_%s' % (loop, tag)
+        name = os.path.join(self.model_dir, '%s.%s.e%d.s%d-%d' % (
+            model_name, loop, epoch, self.start, self.end
+        ))
+        try:
+            for idx, item in enumerate(iterable):
+                if idx == self.start:
+                    self._start(name, model)
+                elif idx == self.end:
+                    self._stop(name)
+                yield item
+        finally:
+            self._stop(name)
+
+    # --------------------------------------------------------------------------
+    # Profilers
+    # --------------------------------------------------------------------------
+
+    def _start(self, name, model):
+        if self.active is not None:
+            logger.warning('Already profiling %s; not profiling %s' %
+                           (self.active['name'], name))
+            return
+        logger.info('Profiling %s' % name)
+        active = {'name': name}
+        if 'modules' in self.tools:
+            active['modules'] = ModuleTimer(self.cuda)
+            for prefix, module in (('reader', model.network),
+                                   ('selector', model.selector)):
+                active['modules'].attach(prefix, getattr(module, 'module',
+                                                         module))
+        if 'cprofile' in self.tools:
+            active['cprofile'] = cProfile.Profile()
+            active['cprofile'].enable()
+        if 'autograd' in self.tools:
+            kwargs = {'use_cuda': True} if self.cuda else {}
+            active['autograd'] = torch.autograd.profiler.profile(**kwargs)
+            active['autograd'].__enter__()
+        self.active = active
+
+    def _stop(self, name):
+        """Stop profiling name; a loop nested in it must not stop it."""
+        active = self.active
+        if active is None or active['name'] != name:
+            return
+        self.active = None
+        # Stop every tool before writing, so no tool profiles the export
+        if 'autograd' in active:
+            active['autograd'].__exit__(None, None, None)
+        if 'cprofile' in active:
+            active['cprofile'].disable()
+        if 'modules' in active:
+            active['modules'].detach()
+
+        if 'autograd' in active:
+            active['autograd'].export_chrome_trace(name + '.trace.json')
+            with open(name + '.ops.txt', 'w') as f:
+                f.write(active['autograd'].key_averages().table(
+                    sort_by='cpu_time_total'
+                ))
+        if 'cprofile' in active:
+            active['cprofile'].dump_stats(name + '.pstats')
+        if 'modules' in active:
+            with open(name + '.modules.json', 'w') as f:
+                json.dump(active['modules'].summary(), f, indent=2)
+        logger.info('Wrote profiles to %s.*' % name)
+
+
+# Shared by the training script; disabled until configured.
+PROFILER = StepProfiler()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Micro-batching asyncio front end for the DocReader Predictor.
+
+Concurrent requests are queued and merged into batches bounded by a maximum
+batch size and a latency deadline, so that callers share forward passes.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingServer(object):
+    """Queue (document, question) requests and run them with predict_batch."""
+
+    def __init__(self, predictor, max_batch_size=32, max_latency=0.01,
+                 history=10000, loop=None):
+        """
+        Args:
+            predictor: a Predictor (or anything with predict_batch).
+            max_batch_size: maximum number of requests per forward pass.
+            max_latency: seconds the first request of a batch may wait for
+              others to join it.
+            history: number of recent requests/batches kept for metrics.
+            loop: asyncio event loop (default: the current one).
+        """
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        # The model is not thread safe: run one batch at a time.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def check_request(document, question, candidates=None, top_n=1):
+        """Raise ValueError if a request is malformed.
+
+        Requests are checked before they are queued, so a bad one fails on
+        its own instead of failing the batch it would have joined.
+        """
+        if not isinstance(document, str):
+            raise ValueError('document must be a string')
+        if not isinstance(question, str):
+            raise ValueError('question must be a string')
+        if candidates is not None and (
+                not isinstance(candidates, list) or
+                not all(isinstance(c, str) for c in candidates)):
+            raise ValueError('candidates must be a list of strings')
+        if isinstance(top_n, bool) or not isinstance(top_n, int) or top_n < 1:
+            raise ValueError('top_n must be a positive integer')
+
+    async def predict(self, document, question, candidates=None, top_n=1):
+        """Queue one request and wait for its predictions."""
+        self.check_request(document, question, candidates, top_n)
+        future = self.loop.create_future()
+        self.queue.put_nowait(
+            (document, question, candidates, top_n, future, time.time())
+        )
+        return await future
+
+    # --------------------------------------------------------------------------
+    # Batching loop
+    # --------------------------------------------------------------------------
+
+    async def _next_batch(self):
+        """Wait for a request, then collect more until full or deadline."""
+        batch = [await self.queue.get()]
+        deadline = self.loop.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(),
+                                                    remaining))
+            except asyncio.TimeoutError:
+                break
+        # Take whatever is already waiting without yielding again.
+        while len(batch) < self.max_batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            batch = [b for b in batch if not b[4].cancelled()]
+            if batch:
+                await self._run_batch(batch)
+
+    async def _run_batch(self, batch):
+        """Run a batch and resolve the futures of its requests.
+
+        If the batch fails, its requests are run again one by one so that
+        only the request(s) causing the failure receive the error.
+        """
+        top_n = max(b[3] for b in batch)
+        inputs = [(b[0], b[1], b[2]) for b in batch]
+        try:
+            results = await self.loop.run_in_executor(
+                self.executor, self.predictor.predict_batch, inputs, top_n
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                logger.warning('Batch of %d failed (%s); running its requests '
+                               'one by one' % (len(batch), e))
+                for b in batch:
+                    await self._run_batch([b])
+                return
+            logger.exception('Request failed')
+            self.num_errors += 1
+            if not batch[0][4].done():
+                batch[0][4].set_exception(e)
+            return
+
+        end = time.time()
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        self.batch_sizes.append(len(batch))
+        for b, result in zip(batch, results):
+            self.latencies.append(end - b[5])
+            if not b[4].done():
+                b[4].set_result(result[:b[3]])
+
+    # --------------------------------------------------------------------------
+    # Metrics
+    # --------------------------------------------------------------------------
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        batch_sizes = np.array(self.batch_sizes)
+        metrics = {
+            'queue_depth': self.queue.qsize(),
+            'requests': self.num_requests,
+            'batches': self.num_batches,
+            'errors': self.num_errors,
+            'max_batch_size': self.max_batch_size,
+            'max_latency_ms': self.max_latency * 1000,
+        }
+        if len(batch_sizes) > 0:
+            metrics['batch_size_mean'] = float(batch_sizes.mean())
+            metrics['batch_size_p50'] = float(np.percentile(batch_sizes, 50))
+            metrics['batch_size_max'] = int(batch_sizes.max())
+        if len(latencies) > 0:
+            metrics['latency_p50_ms'] = float(np.percentile(latencies, 50))
+            metrics['latency_p99_ms'] = float(np.percentile(latencies, 99))
+        return metrics
+
+    # --------------------------------------------------------------------------
+    # Minimal HTTP endpoint
+    # --------------------------------------------------------------------------
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """Serve POST /predict and GET /metrics over HTTP on host:port.
+
+        /predict takes a JSON object with document, question and optionally
+        candidates and top_n, and returns a list of [span, score] pairs.
+        """
+        self.start()
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.info('Serving on http://%s:%d' % (host, port))
+        return server
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                writer.close()
+                return
+            method, path = request_line.decode('latin-1').split()[:2]
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value.strip())
+            body = await reader.readexactly(length) if length else b''
+
+            if method == 'GET' and path == '/metrics':
+                status, payload = 200, self.metrics()
+            elif method == 'POST' and path == '/predict':
+                status, payload = await self._predict_request(body)
+            else:
+                status, payload = 404, {'error': 'not found'}
+        except Exception as e:
+            status, payload = 400, {'error': str(e)}
+
+        data = json.dumps(payload).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' %
+                      (status, _REASONS.get(status, ''), len(data)))
+                     .encode('latin-1') + data)
+        await writer.drain()
+        writer.close()
+
+    async def _predict_request(self, body):
+        # Client errors (bad JSON, missing or invalid fields) are 400s;
+        # anything raised while predicting is a 500.
+        try:
+            request = json.loads(body.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+            args = (request['document'], request['question'],
+                    request.get('candidates'), request.get('top_n', 1))
+            self.check_request(*args)
+        except KeyError as e:
+            return 400, {'error': 'missing field %s' % e}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        try:
+            predictions = await self.predict(*args)
+        except Exception as e:
+            return 500, {'error': str(e)}
+        return 200, [[span, float(score)] for span, score in predictions]
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            500: 'Internal Server Error'}
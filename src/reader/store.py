@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Compact in-memory storage of the paragraphs of every question.
+
+A list of 50 paragraph dicts per question keeps every token as a Python
+string in a Python list, repeats the question in each paragraph and the
+paragraphs padded up to num_docs. ParagraphStore interns the tokens once
+and keeps:
+
+    vocab, vocab_offsets    every distinct token, UTF-8 encoded into one
+                            bytes object; token t is
+                            vocab[vocab_offsets[t]:vocab_offsets[t + 1]]
+    arrays[field]           (int32 token ids, int64 offsets) of the field
+                            of every paragraph (document, lemma, pos, ner)
+                            or question (question, qlemma); item i is
+                            ids[offsets[i]:offsets[i + 1]]
+    paragraph_ids, offsets  the (deduplicated) paragraphs of each question
+
+There is no Python object per token: reading tokens only updates the
+reference counts of a few objects (the vocab bytes object keeps its data
+inline after its header). Forked DataLoader workers thus share the store
+instead of copying the pages that reference counting would dirty.
+store[i] returns the paragraphs of question i as Paragraph records, which
+are read like the dicts they replace (paragraph['document'] etc.).
+"""
+
+import array
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PARAGRAPH_FIELDS = ('document', 'lemma', 'pos', 'ner')
+QUESTION_FIELDS = ('question', 'qlemma')
+
+
+def _to_numpy(values, dtype):
+    """Copy an array.array into a numpy array of the same item size."""
+    if len(values) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype=dtype).copy()
+
+
+class Paragraph(object):
+    """One paragraph of a ParagraphStore, with the question it is used for."""
+
+    __slots__ = ('store', 'pid', 'qid')
+
+    def __init__(self, store, pid, qid):
+        self.store = store
+        self.pid = pid
+        self.qid = qid
+
+    def __getitem__(self, key):
+        if key in QUESTION_FIELDS:
+            return self.store.tokens(key, self.qid)
+        if key in PARAGRAPH_FIELDS:
+            return self.store.tokens(key, self.pid)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in QUESTION_FIELDS or key in PARAGRAPH_FIELDS
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __repr__(self):
+        return 'Paragraph(%d of question %d)' % (self.pid, self.qid)
+
+
+class ParagraphStore(object):
+    """Paragraphs of every question as token id arrays (see module doc)."""
+
+    def __init__(self):
+        self.vocab = b''
+        self.vocab_offsets = np.zeros(1, dtype=np.int64)
+        self.arrays = {}
+        self.paragraph_ids = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def from_docs(cls, docs):
+        """Build a store from an iterable of lists of paragraph dicts.
+
+        docs is consumed one question at a time, so it can be a generator
+        over a file that does not fit in memory as dicts. Paragraphs that
+        are the same object within a question (the padding up to num_docs)
+        are stored once. The question is taken from the first paragraph.
+        """
+        vocab = {}
+        tokens = {f: array.array('i') for f in
+                  PARAGRAPH_FIELDS + QUESTION_FIELDS}
+        lengths = {f: array.array('q') for f in tokens}
+        paragraph_ids = array.array('i')
+        offsets = array.array('q', [0])
+
+        def add(field, words):
+            ids = [vocab.setdefault(w, len(vocab)) for w in words]
+            tokens[field].extend(ids)
+            lengths[field].append(len(ids))
+
+        num_paragraphs = 0
+        for paragraphs in docs:
+            first = paragraphs[0]
+            for field in QUESTION_FIELDS:
+                add(field, first.get(field, ()))
+            seen = {}
+            for paragraph in paragraphs:
+                if id(paragraph) not in seen:
+                    seen[id(paragraph)] = num_paragraphs
+                    num_paragraphs += 1
+                    for field in PARAGRAPH_FIELDS:
+                        add(field, paragraph.get(field, ()))
+                paragraph_ids.append(seen[id(paragraph)])
+            offsets.append(len(paragraph_ids))
+
+        store = cls()
+        words = [None] * len(vocab)
+        for w, i in vocab.items():
+            words[i] = w
+        encoded = [w.encode('utf-8') for w in words]
+        store.vocab = b''.join(encoded)
+        store.vocab_offsets = np.cumsum([0] + [len(w) for w in encoded],
+                                        dtype=np.int64)
+        for field in tokens:
+            ends = np.cumsum(_to_numpy(lengths[field], np.int64))
+            store.arrays[field] = (
+                _to_numpy(tokens[field], np.int32),
+                np.concatenate([[0], ends]).astype(np.int64),
+            )
+        store.paragraph_ids = _to_numpy(paragraph_ids, np.int32)
+        store.offsets = _to_numpy(offsets, np.int64)
+        logger.info('Stored %d questions, %d paragraphs, %d tokens '
+                    '(%d distinct) in %.1f MB' %
+                    (len(store), num_paragraphs,
+                     len(store.arrays['document'][0]), len(encoded),
+                     store.nbytes() / 1e6))
+        return store
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, qid):
+        if qid < 0:
+            qid += len(self)
+        if not 0 <= qid < len(self):
+            raise IndexError('Question %d out of range' % qid)
+        pids = self.paragraph_ids[self.offsets[qid]:self.offsets[qid + 1]]
+        return [Paragraph(self, pid, qid) for pid in pids.tolist()]
+
+    def __iter__(self):
+        for qid in range(len(self)):
+            yield self[qid]
+
+    def tokens(self, field, index):
+        """Tokens of field of paragraph (or question) index."""
+        ids, offsets = self.arrays[field]
+        ids = ids[offsets[index]:offsets[index + 1]]
+        starts = self.vocab_offsets[ids].tolist()
+        ends = self.vocab_offsets[ids + 1].tolist()
+        vocab = self.vocab
+        return [vocab[s:e].decode('utf-8') for s, e in zip(starts, ends)]
+
+    def lengths(self, field='document'):
+        """Number of tokens of field of every paragraph (or question)."""
+        return np.diff(self.arrays[field][1])
+
+    def nbytes(self):
+        """Bytes used by the token arrays and the vocabulary."""
+        total = self.paragraph_ids.nbytes + self.offsets.nbytes
+        total += len(self.vocab) + self.vocab_offsets.nbytes
+        for ids, offsets in self.arrays.values():
+            total += ids.nbytes + offsets.nbytes
+        return total
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Phase timers and throughput counters for the training loops.
+
+Usage:
+    TELEMETRY.open('train.jsonl')           # or fmt='prometheus'
+    TELEMETRY.loop('train', restart=True)
+    for ex in TELEMETRY.timed(data_loader):  # 'data' phase
+        TELEMETRY.count_batch(ex)
+        with TELEMETRY.phase('forward'):
+            ...
+        TELEMETRY.flush(epoch=epoch, step=idx)
+
+Until open is called every method is a cheap no-op. Timings are wall clock
+on the host; CUDA work is attributed to the phase that waits for it.
+"""
+
+import os
+import json
+import time
+from collections import defaultdict
+
+FORMATS = {'jsonl', 'prometheus'}
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    __slots__ = ('telemetry', 'key', 'start')
+
+    def __init__(self, telemetry, key):
+        self.telemetry = telemetry
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.telemetry.seconds[self.key] += time.perf_counter() - self.start
+        return False
+
+
+class Telemetry(object):
+    """Seconds per (loop, phase) and counts per (loop, counter).
+
+    Totals are cumulative over the run. JSON lines also report the rates of
+    the interval since the previous flush of the same loop; the Prometheus
+    textfile is rewritten (atomically) with the totals at every flush.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.filename = None
+        self.format = 'jsonl'
+        self.current = 'train'
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._last = {}
+
+    def open(self, filename, fmt='jsonl'):
+        if fmt not in FORMATS:
+            raise RuntimeError('Unsupported telemetry format: %s' % fmt)
+        self.filename = filename
+        self.format = fmt
+        self.enabled = True
+        return self
+
+    def loop(self, name, restart=False):
+        """Attribute the following phases and counts to loop name.
+
+        restart starts its next reporting interval now (e.g. at the start of
+        an epoch), instead of at its previous flush.
+        """
+        self.current = name
+        if restart or name not in self._last:
+            self._last[name] = (time.perf_counter(),) + self._totals(name)
+
+    # --------------------------------------------------------------------------
+    # Recording
+    # --------------------------------------------------------------------------
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return _Phase(self, (self.current, name))
+
+    def timed(self, iterable, name='data'):
+        """Iterate over iterable, timing each next() as phase name."""
+        if not self.enabled:
+            for item in iterable:
+                yield item
+            return
+        key = (self.current, name)
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.seconds[key] += time.perf_counter() - start
+            yield item
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[(self.current, name)] += n
+
+    def count_batch(self, ex_with_doc):
+        """Count examples, paragraphs and (padded) paragraph tokens."""
+        if not self.enabled:
+            return
+        examples = ex_with_doc[0][2].size(0)
+        tokens = padded = 0
+        for ex in ex_with_doc:
+            mask = ex[2]
+            padded += mask.numel()
+            tokens += mask.numel() - int(mask.sum())
+        self.count('examples', examples)
+        self.count('paragraphs', examples * len(ex_with_doc))
+        self.count('tokens', tokens)
+        self.count('padded_tokens', padded)
+
+    # --------------------------------------------------------------------------
+    # Export
+    # --------------------------------------------------------------------------
+
+    def _totals(self, loop):
+        seconds = {p: s for (l, p), s in self.seconds.items() if l == loop}
+        counts = {c: n for (l, c), n in self.counts.items() if l == loop}
+        return seconds, counts
+
+    def summary(self, loop=None):
+        """Rates and phase times of loop since its previous summary."""
+        loop = loop or self.current
+        now = time.perf_counter()
+        seconds, counts = self._totals(loop)
+        last_time, last_seconds, last_counts = self._last.get(
+            loop, (now, {}, {})
+        )
+        self._last[loop] = (now, seconds, counts)
+        elapsed = max(now - last_time, 1e-9)
+        phases = {p: s - last_seconds.get(p, 0.0) for p, s in seconds.items()}
+        delta = {c: n - last_counts.get(c, 0) for c, n in counts.items()}
+        stats = {
+            'loop': loop,
+            'elapsed_s': elapsed,
+            'phase_s': phases,
+            'phase_frac': {p: s / elapsed for p, s in phases.items()},
+            'counts': delta,
+        }
+        for name in ('examples', 'paragraphs', 'tokens'):
+            stats['%s_per_s' % name] = delta.get(name, 0) / elapsed
+        if delta.get('padded_tokens'):
+            stats['padding_ratio'] = 1 - (delta.get('tokens', 0) /
+                                          delta['padded_tokens'])
+        return stats
+
+    def flush(self, **fields):
+        """Export the current loop's telemetry, with extra fields
+        (e.g. epoch, step, loss) added to JSON lines."""
+        if not self.enabled:
+            return
+        if self.format == 'jsonl':
+            record = {'time': time.time()}
+            # Tensor and numpy scalars (e.g. a summed loss) as python numbers
+            record.update((k, v.item() if hasattr(v, 'item') else v)
+                          for k, v in fields.items())
+            record.update(self.summary())
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        else:
+            self.write_prometheus(self.filename)
+
+    def write_prometheus(self, filename):
+        """Write cumulative totals in the Prometheus textfile format."""
+        lines = [
+            '# HELP openqa_phase_seconds_total Wall clock seconds per phase.',
+            '# TYPE openqa_phase_seconds_total counter',
+        ]
+        for (loop, phase), s in sorted(self.seconds.items()):
+            lines.append('openqa_phase_seconds_total{loop="%s",phase="%s"} %f'
+                         % (loop, phase, s))
+        lines += [
+            '# HELP openqa_items_total Examples, paragraphs and tokens seen.',
+            '# TYPE openqa_items_total counter',
+        ]
+        for (loop, name), n in sorted(self.counts.items()):
+            lines.append('openqa_items_total{loop="%s",item="%s"} %d'
+                         % (loop, name, n))
+        tmp = '%s.tmp.%d' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, filename)
+
+
+# Shared by the model and the training script; disabled until opened.
+TELEMETRY = Telemetry()
@@ -10,11 +10,13 @@ import json
 import time
 import logging
 import string
+import functools
 import regex as re
 
 from collections import Counter
-from .data import Dictionary
-from .vector import num_docs
+from .data import Dictionary, JsonlDataset
+from .store import ParagraphStore
+from . import vector
 
 logger = logging.getLogger(__name__)
 
@@ -24,19 +26,63 @@ logger = logging.getLogger(__name__)
 # ------------------------------------------------------------------------------
 
 
+def prepare_docs(args, ex):
+    """Paragraphs of one question, as used for training: optionally
+    lower-cased, without paragraphs of 5 tokens or less, at most num_docs
+    (repeated up to num_docs with args.pad_docs) and sorted by length.
+    """
+    num_docs = vector.num_docs
+    if args.uncased_question or args.uncased_doc:
+        for i in range(len(ex)):
+            if args.uncased_question:
+                ex[i]['question'] = [w.lower() for w in ex[i]['question']]
+            if args.uncased_doc:
+                ex[i]['document'] = [w.lower() for w in ex[i]['document']]
+    tmp_res = []
+    for i in range(len(ex)):
+        if (len(ex[i]['document'])>5):# and len(ex[i]['document'])<200):
+            tmp_res.append(ex[i])
+        if (len(tmp_res)>=num_docs):
+            break
+    if (len(tmp_res)<num_docs and args.pad_docs):
+        len_tmp_res = len(tmp_res)
+        for i in range(len_tmp_res, num_docs):
+            tmp_res.append(tmp_res[i-len_tmp_res])
+    tmp_res = sorted(tmp_res, key=lambda x:len(x['document']))
+    assert(len(tmp_res)!=0)
+    return tmp_res
+
+
 def load_data_with_doc(args, filename):
     """Load examples from preprocessed file.
     One example per line, JSON encoded.
+
+    With args.stream_data the file is not read: a JsonlDataset parses the
+    paragraphs of a question when it is accessed, and no question keys are
+    returned. With args.compact_data the paragraphs are kept in a
+    ParagraphStore instead of lists of dicts.
     """
-    # Load JSON lines
-    res = []
+    if args.stream_data:
+        docs = JsonlDataset(filename, functools.partial(prepare_docs, args),
+                            args.stream_cache_size)
+        logger.info('Indexed %d questions in %s' % (len(docs), filename))
+        return docs, None
+
     keys = set()
+    if args.compact_data:
+        return ParagraphStore.from_docs(iter_data_with_doc(args, filename,
+                                                           keys)), keys
+    return list(iter_data_with_doc(args, filename, keys)), keys
+
+
+def iter_data_with_doc(args, filename, keys):
+    """Prepared paragraphs of every question of filename, adding the
+    questions to keys."""
+    # Load JSON lines
     step =0
     with open(filename) as f:
         for line in f:
             ex = json.loads(line) 
-            #logger.info(ex)
-            #print (ex)
             step+=1
             try:
                 question = " ".join(ex[0]['question'])
@@ -44,31 +90,8 @@ def load_data_with_doc(args, filename):
                 logger.info(step)
                 logger.info(ex)
                 continue
-            #print (question)
-            if args.uncased_question or args.uncased_doc:
-                for i in range(len(ex)):
-                    if args.uncased_question:
-                        ex[i]['question'] = [w.lower() for w in ex[i]['question']]
-                    if args.uncased_doc:
-                        ex[i]['document'] = [w.lower() for w in ex[i]['document']]
-            #logger.info (question)
-            tmp_res = []
-            for i in range(len(ex)):
-                if (len(ex[i]['document'])>5):# and len(ex[i]['document'])<200):
-                    tmp_res.append(ex[i])
-                if (len(tmp_res)>=num_docs):
-                    break
-            if (len(tmp_res)<num_docs):
-                len_tmp_res = len(tmp_res)
-                for i in range(len_tmp_res, num_docs):
-                    tmp_res.append(tmp_res[i-len_tmp_res])
-            tmp_res = sorted(tmp_res, key=lambda x:len(x['document']))
-            assert(len(tmp_res)!=0)
-            #if (len(tmp_res)!=num_docs):
-            #    logger.info("%s\t%d\t%d", question, len(tmp_res),num_docs)
-            res.append(tmp_res)
             keys.add(question)
-    return res, keys
+            yield prepare_docs(args, ex)
 
 def load_data(args, filename, skip_no_answer=False):
     """Load examples from preprocessed file.
@@ -6,7 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 """Edit from DrQA"""
 
-from collections import Counter
+import numpy as np
 import torch
 import linecache
 import json
@@ -15,59 +15,105 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Paragraph slots per question (main.py sets it from --num-docs).
 num_docs = 50
 
 
 
-def vectorize(ex, model, single_answer=False):
-    """Torchify a single example."""
-    args = model.args
-    word_dict = model.word_dict
-    feature_dict = model.feature_dict
+def _intern(tokens, vocab):
+    """Ids of tokens (strings) in vocab, a dict grown as needed."""
+    return np.fromiter((vocab.setdefault(t, len(vocab)) for t in tokens),
+                       dtype=np.int64, count=len(tokens))
 
-    # Index words
-    document = torch.LongTensor([word_dict[w] for w in ex['document']])
-    question = torch.LongTensor([word_dict[w] for w in ex['question']])
 
-    # Create extra features vector
-    if len(feature_dict) > 0:
-        features = torch.zeros(len(ex['document']), len(feature_dict))
-    else:
-        features = None
+def _in_question(segment, doc_tokens, questions, vocab):
+    """Whether each token of the paragraphs is in its paragraph's question.
+
+    doc_tokens are the tokens of all paragraphs, concatenated, segment the
+    paragraph of each; questions the question tokens of every paragraph.
+    """
+    doc_ids = _intern(doc_tokens, vocab)
+    q_ids = _intern([w for q in questions for w in q], vocab)
+    q_segment = np.repeat(np.arange(len(questions)), [len(q) for q in questions])
+    # (paragraph, token) pairs as single ints
+    return np.isin(segment * len(vocab) + doc_ids, q_segment * len(vocab) + q_ids)
+
+
+def extract_features(model, docs, questions, lemmas=None, qlemmas=None,
+                     pos=None, ner=None):
+    """Extra features of paragraphs (token lists) for their questions.
+
+    The paragraphs are handled together on token id arrays: in_question*
+    by np.isin of (paragraph, token id) pairs, tf from np.unique counts and
+    pos/ner by scattering ones into the tag columns. lemmas, qlemmas, pos
+    and ner are only needed for the features model.args enables.
+    Returns one (len(doc) x len(feature_dict)) tensor per paragraph, or
+    Nones without features.
+    """
+    args = model.args
+    feature_dict = model.feature_dict
+    if len(feature_dict) == 0:
+        return [None] * len(docs)
+    lengths = np.array([len(d) for d in docs], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    segment = np.repeat(np.arange(len(docs)), lengths)
+    features = np.zeros((offsets[-1], len(feature_dict)), dtype=np.float32)
+    words = [w for d in docs for w in d]
+    vocab = {}
 
     # f_{exact_match}
     if args.use_in_question:
-        q_words_cased = {w for w in ex['question']}
-        q_words_uncased = {w.lower() for w in ex['question']}
-        q_lemma = {w for w in ex['qlemma']} if args.use_lemma else None
-        for i in range(len(ex['document'])):
-            if ex['document'][i] in q_words_cased:
-                features[i][feature_dict['in_question']] = 1.0
-            if ex['document'][i].lower() in q_words_uncased:
-                features[i][feature_dict['in_question_uncased']] = 1.0
-            if q_lemma and ex['lemma'][i] in q_lemma:
-                features[i][feature_dict['in_question_lemma']] = 1.0
-
-    # f_{token} (POS)
-    if args.use_pos:
-        for i, w in enumerate(ex['pos']):
-            f = 'pos=%s' % w
-            if f in feature_dict:
-                features[i][feature_dict[f]] = 1.0
-
-    # f_{token} (NER)
-    if args.use_ner:
-        for i, w in enumerate(ex['ner']):
-            f = 'ner=%s' % w
-            if f in feature_dict:
-                features[i][feature_dict[f]] = 1.0
+        features[:, feature_dict['in_question']] = _in_question(
+            segment, words, questions, vocab)
+        features[:, feature_dict['in_question_uncased']] = _in_question(
+            segment, [w.lower() for w in words],
+            [[w.lower() for w in q] for q in questions], vocab)
+        if args.use_lemma:
+            features[:, feature_dict['in_question_lemma']] = _in_question(
+                segment, [w for l in lemmas for w in l], qlemmas, vocab)
+
+    # f_{token} (POS, NER)
+    for name, tags, use in (('pos', pos, args.use_pos),
+                            ('ner', ner, args.use_ner)):
+        if not use:
+            continue
+        tag_vocab = {}
+        tag_ids = _intern([t for ts in tags for t in ts], tag_vocab)
+        columns = np.array([feature_dict.get('%s=%s' % (name, t), -1)
+                            for t in tag_vocab], dtype=np.int64)[tag_ids]
+        rows = np.flatnonzero(columns >= 0)
+        features[rows, columns[rows]] = 1.0
 
     # f_{token} (TF)
     if args.use_tf:
-        counter = Counter([w.lower() for w in ex['document']])
-        l = len(ex['document'])
-        for i, w in enumerate(ex['document']):
-            features[i][feature_dict['tf']] = counter[w.lower()] * 1.0 / l
+        ids = _intern([w.lower() for w in words], vocab)
+        _, inverse, counts = np.unique(segment * len(vocab) + ids,
+                                       return_inverse=True, return_counts=True)
+        features[:, feature_dict['tf']] = (counts[inverse.reshape(-1)] /
+                                           lengths[segment])
+
+    return [torch.from_numpy(features[offsets[k]:offsets[k + 1]])
+            for k in range(len(docs))]
+
+
+def vectorize(ex, model, single_answer=False):
+    """Torchify a single example."""
+    args = model.args
+    word_dict = model.word_dict
+
+    # Index words
+    document = torch.from_numpy(word_dict.encode(ex['document']))
+    question = torch.from_numpy(word_dict.encode(ex['question']))
+
+    # Create extra features vector
+    use_lemma = args.use_in_question and args.use_lemma
+    features = extract_features(
+        model, [ex['document']], [ex['question']],
+        [ex['lemma']] if use_lemma else None,
+        [ex['qlemma']] if use_lemma else None,
+        [ex['pos']] if args.use_pos else None,
+        [ex['ner']] if args.use_ner else None,
+    )[0]
     
     # Maybe return without target
     if 'answers' not in ex:
@@ -85,74 +131,77 @@ def vectorize(ex, model, single_answer=False):
     return document, features, question, start, end, ex['id']
     
 
-def vectorize1(ex, model, single_answer=False):
-    """Torchify a single example."""
-    args = model.args
-    word_dict = model.word_dict
-    feature_dict = model.feature_dict
+def vectorize1(ex, model, single_answer=False, ex_id=None):
+    """Torchify a single example.
 
-    # Index words
-    document = torch.LongTensor([word_dict[w] for w in ex['document']])
-    question = torch.LongTensor([word_dict[w] for w in ex['question']])
+    ex is a paragraph dict (or store.Paragraph); ex_id defaults to ex['id'].
+    """
+    return vectorize_docs([ex], model, single_answer,
+                          None if ex_id is None else [ex_id])[0]
 
-    # Create extra features vector
-    if len(feature_dict) > 0:
-        features = torch.zeros(len(ex['document']), len(feature_dict))
-    else:
-        features = None
 
-    # f_{exact_match}
-    if args.use_in_question:
-        q_words_cased = {w for w in ex['question']}
-        q_words_uncased = {w.lower() for w in ex['question']}
-        q_lemma = {w for w in ex['qlemma']} if args.use_lemma else None
-        for i in range(len(ex['document'])):
-            if ex['document'][i] in q_words_cased:
-                features[i][feature_dict['in_question']] = 1.0
-            if ex['document'][i].lower() in q_words_uncased:
-                features[i][feature_dict['in_question_uncased']] = 1.0
-            if q_lemma and ex['lemma'][i] in q_lemma:
-                features[i][feature_dict['in_question_lemma']] = 1.0
-
-    # f_{token} (POS)
-    if args.use_pos:
-        for i, w in enumerate(ex['pos']):
-            f = 'pos=%s' % w
-            if f in feature_dict:
-                features[i][feature_dict[f]] = 1.0
-
-    # f_{token} (NER)
-    if args.use_ner:
-        for i, w in enumerate(ex['ner']):
-            f = 'ner=%s' % w
-            if f in feature_dict:
-                features[i][feature_dict[f]] = 1.0
-
-    # f_{token} (TF)
-    if args.use_tf:
-        counter = Counter([w.lower() for w in ex['document']])
-        l = len(ex['document'])
-        for i, w in enumerate(ex['document']):
-            features[i][feature_dict['tf']] = counter[w.lower()] * 1.0 / l
-
-    return document, features, question, ex['id']
+def vectorize_docs(exs, model, single_answer=False, ex_ids=None):
+    """Torchify paragraphs together, e.g. those of a question or a slot.
 
-
-def vectorize_with_doc(ex, index, model, single_answer=False, docs_tmp = None):
+    Same as vectorize1 on each paragraph of exs, but the features of all
+    of them are extracted at once (see extract_features). ex_ids default
+    to the paragraphs' ex['id'].
+    """
+    args = model.args
+    word_dict = model.word_dict
+    use_lemma = args.use_in_question and args.use_lemma
+    # Read each field once (a Paragraph decodes it on every access)
+    fields = {'document': [], 'question': [], 'lemma': [], 'qlemma': [],
+              'pos': [], 'ner': []}
+    needed = ['document', 'question']
+    needed += ['lemma', 'qlemma'] if use_lemma else []
+    needed += ['pos'] if args.use_pos else []
+    needed += ['ner'] if args.use_ner else []
+    for ex in exs:
+        for field in needed:
+            fields[field].append(ex[field])
+
+    features = extract_features(
+        model, fields['document'], fields['question'],
+        fields['lemma'], fields['qlemma'], fields['pos'], fields['ner'],
+    )
+    if ex_ids is None:
+        ex_ids = [ex['id'] for ex in exs]
+    return [(torch.from_numpy(word_dict.encode(words)), f,
+             torch.from_numpy(word_dict.encode(q_words)), ex_id)
+            for words, f, q_words, ex_id in zip(
+                fields['document'], features, fields['question'], ex_ids)]
+
+
+def paragraph_key(doc):
+    """Identity of a paragraph of a question: padding repeats the same
+    dicts, or store records with the same pid."""
+    return getattr(doc, 'pid', id(doc))
+
+
+def vectorize_with_doc(ex, index, model, single_answer=False, docs_tmp = None,
+                       pad=True):
     #res = vectorize(ex, model, single_answer)
     #qid = query2id[" ".join(ex['question'])]
     #logger.info("qid=%d", qid)
     #docs_tmp = linecache.getline(filename, qid)
     #docs_tmp = json.loads(docs_tmp)
-    docs = []
-    for i in range(0, num_docs):
-        j = i % len(docs_tmp)
-        docs_tmp[j]['answer'] = ex['answer'][0]
-        docs_tmp[j]['id'] = index
-        #logger.info(ex['answer'][0])
-        #logger.info(docs_tmp[j])
-        docs.append(vectorize1(docs_tmp[j], model, single_answer))
-    return {"qa": ex, "docs":docs}
+    # Short paragraph lists are padded (unless pad is False) by repeating
+    # paragraphs (the same dicts, or store records with the same pid); each
+    # is vectorized once and sources[i] is the first slot holding the
+    # paragraph of slot i.
+    unique, sources, first = [], [], {}
+    for i in range(0, num_docs if pad else min(len(docs_tmp), num_docs)):
+        doc = docs_tmp[i % len(docs_tmp)]
+        key = paragraph_key(doc)
+        if key not in first:
+            first[key] = i
+            unique.append(doc)
+        sources.append(first[key])
+    vectors = dict(zip(sorted(first.values()), vectorize_docs(
+        unique, model, single_answer, [index] * len(unique))))
+    docs = [vectors[source] for source in sources]
+    return {"qa": ex, "docs": docs, "sources": sources}
 
 def batchify(batch):
     """Gather a batch of individual examples into one batch."""
@@ -238,11 +287,66 @@ def batchify1(batch):
 
 
 def batchify_with_docs(batch_list):
+    """Batch each slot of the examples: (x1, x1_f, x1_mask, x2, x2_mask,
+    sources, ids), where sources[i] is the slot of the first occurrence of
+    the paragraph of example i (see vectorize_with_doc).
+
+    There are as many slots as the example with the most paragraphs has;
+    the slots past the end of the others are absent (sources[i] == -1, and
+    their first paragraph stands in for the inputs).
+    """
     res = []
-    for i in range(num_docs):
+    for i in range(max(len(ex['docs']) for ex in batch_list)):
         batch = []
         for ex in batch_list:
-            batch.append(ex['docs'][i])
-        res.append(batchify1(batch))
+            batch.append(ex['docs'][i if i < len(ex['docs']) else 0])
+        x1, x1_f, x1_mask, x2, x2_mask, ids = batchify1(batch)
+        sources = torch.LongTensor([ex['sources'][i] if i < len(ex['docs'])
+                                    else -1 for ex in batch_list])
+        res.append((x1, x1_f, x1_mask, x2, x2_mask, sources, ids))
     #logger.info("batchify_with_docs%d", len(res))
     return res
+
+
+def paragraph_sources(ex):
+    """The sources of a slot batch (or of its rows), None if not recorded."""
+    if len(ex) > 5 and torch.is_tensor(ex[5]):
+        return ex[5]
+    return None
+
+
+def unique_paragraphs(ex_with_doc):
+    """Find the slots of a batch that repeat an earlier slot's paragraph.
+
+    ex_with_doc may be a shuffled list of slot batches. Returns first, a
+    (batch x slots) numpy array where first[i, k] is the position in
+    ex_with_doc of the first slot holding the paragraph of slot k of
+    example i (-1 for absent slots); slot k of example i is unique iff
+    first[i, k] == k. Without recorded sources every slot is unique.
+    """
+    batch_size = ex_with_doc[0][0].size(0)
+    first = np.tile(np.arange(len(ex_with_doc)), (batch_size, 1))
+    sources = [paragraph_sources(ex) for ex in ex_with_doc]
+    if any(s is None for s in sources):
+        return first
+    sources = torch.stack([s.cpu() for s in sources], 1).numpy()
+    for i in range(batch_size):
+        seen = {}
+        for k, source in enumerate(sources[i].tolist()):
+            first[i, k] = -1 if source < 0 else seen.setdefault(source, k)
+    return first
+
+
+def select_rows(ex, rows):
+    """Inputs of rows of a slot batch, trimmed to their longest paragraph
+    and question."""
+    inputs = list(ex[:5])
+    if len(rows) == inputs[0].size(0):
+        return inputs
+    index = torch.LongTensor(rows)
+    inputs = [e if e is None else e.index_select(0, index) for e in inputs]
+    doc_len = int((inputs[2] == 0).sum(1).max())
+    question_len = int((inputs[4] == 0).sum(1).max())
+    return [e if e is None else e[:, :length].contiguous()
+            for e, length in zip(inputs, (doc_len, doc_len, doc_len,
+                                          question_len, question_len))]
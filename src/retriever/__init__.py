@@ -6,7 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
-from .. import DATA_DIR
+from .. import DATA_DIR, lazy_getattr
 
 DEFAULTS = {
     'db_path': os.path.join(DATA_DIR, 'wikipedia/docs.db'),
@@ -24,11 +24,14 @@ def set_default(key, value):
 
 def get_class(name):
     if name == 'tfidf':
-        return TfidfDocRanker
+        return __getattr__('TfidfDocRanker')
     if name == 'sqlite':
-        return DocDB
+        return __getattr__('DocDB')
     raise RuntimeError('Invalid retriever class: %s' % name)
 
 
-from .doc_db import DocDB
-from .tfidf_doc_ranker import TfidfDocRanker
+# Imported on first use (TfidfDocRanker needs scipy)
+__getattr__ = lazy_getattr(__name__, {
+    'DocDB': ('.doc_db', 'DocDB'),
+    'TfidfDocRanker': ('.tfidf_doc_ranker', 'TfidfDocRanker'),
+})
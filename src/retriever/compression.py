@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Document compression codecs for DocDB.
+
+Compressed databases keep their codec (and zlib preset dictionary) in a
+`doc_meta` table next to `documents`:
+
+    CREATE TABLE doc_meta (key TEXT PRIMARY KEY, value)
+      ('compression', 'zlib' | 'lzma')
+      ('zdict', <preset dictionary bytes>)     zlib only
+"""
+
+import lzma
+import zlib
+
+from collections import Counter
+
+CODECS = {'none', 'zlib', 'lzma'}
+
+# Documents are compressed one by one, so high levels buy little: lzma's
+# larger presets mostly pay for a dictionary far bigger than a document.
+DEFAULT_LEVELS = {'zlib': 6, 'lzma': 0}
+
+
+def train_zlib_dict(texts, size=32768, max_ngram=3):
+    """Build a zlib preset dictionary from sample documents.
+
+    Collects the word n-grams that save the most bytes (frequency * length)
+    and packs them into `size` bytes, most valuable last, as deflate finds
+    matches closer to the end of its window more cheaply. The standard
+    library has no preset dictionaries for lzma.
+    """
+    counts = Counter()
+    for text in texts:
+        words = text.split()
+        for n in range(1, max_ngram + 1):
+            for i in range(len(words) - n + 1):
+                counts[' '.join(words[i:i + n])] += 1
+
+    candidates = sorted(
+        ((c * len(g.encode('utf-8')), g) for g, c in counts.items() if c > 1),
+        reverse=True
+    )
+    chosen, total = [], 0
+    for _, gram in candidates:
+        piece = (gram + ' ').encode('utf-8')
+        if total + len(piece) > size:
+            continue
+        chosen.append(piece)
+        total += len(piece)
+    return b''.join(reversed(chosen))
+
+
+class Codec(object):
+    """Compress/decompress document texts."""
+
+    def __init__(self, name='none', zdict=None, level=None):
+        if name not in CODECS:
+            raise RuntimeError('Invalid compression: %s' % name)
+        if zdict and name != 'zlib':
+            raise RuntimeError('Preset dictionaries are only supported by zlib')
+        self.name = name
+        self.zdict = zdict
+        self.level = level if level is not None else DEFAULT_LEVELS.get(name)
+
+    @classmethod
+    def from_connection(cls, connection):
+        """Read the codec stored in a DocDB sqlite database."""
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master "
+                       "WHERE type = 'table' AND name = 'doc_meta'")
+        if cursor.fetchone() is None:
+            cursor.close()
+            return cls()
+        cursor.execute("SELECT key, value FROM doc_meta")
+        meta = dict(cursor.fetchall())
+        cursor.close()
+        return cls(meta.get('compression', 'none'), meta.get('zdict'))
+
+    def save(self, connection):
+        """Store this codec in a DocDB sqlite database."""
+        connection.execute("CREATE TABLE IF NOT EXISTS doc_meta "
+                           "(key TEXT PRIMARY KEY, value)")
+        connection.execute("INSERT OR REPLACE INTO doc_meta VALUES (?, ?)",
+                           ('compression', self.name))
+        if self.zdict:
+            connection.execute("INSERT OR REPLACE INTO doc_meta VALUES (?, ?)",
+                               ('zdict', self.zdict))
+
+    def compress(self, text):
+        if self.name == 'none':
+            return text
+        data = text.encode('utf-8')
+        if self.name == 'zlib':
+            if self.zdict:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15,
+                                              zdict=self.zdict)
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            return compressor.compress(data) + compressor.flush()
+        return lzma.compress(data, format=lzma.FORMAT_RAW,
+                             filters=[{'id': lzma.FILTER_LZMA2,
+                                       'preset': self.level}])
+
+    def decompress(self, blob):
+        if blob is None or self.name == 'none':
+            return blob
+        if self.name == 'zlib':
+            if self.zdict:
+                decompressor = zlib.decompressobj(-15, zdict=self.zdict)
+            else:
+                decompressor = zlib.decompressobj(-15)
+            data = decompressor.decompress(blob) + decompressor.flush()
+        else:
+            data = lzma.decompress(blob, format=lzma.FORMAT_RAW,
+                                   filters=[{'id': lzma.FILTER_LZMA2}])
+        return data.decode('utf-8')
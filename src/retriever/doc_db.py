@@ -6,20 +6,47 @@
 # LICENSE file in the root directory of this source tree.
 """Documents, in a sqlite database."""
 
+import pathlib
 import sqlite3
+import threading
+
+from collections import OrderedDict
+
 from . import utils
 from . import DEFAULTS
+from .compression import Codec
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds.
+MAX_QUERY_PARAMS = 900
 
 
 class DocDB(object):
     """Sqlite backed document storage.
 
-    Implements get_doc_text(doc_id).
+    Implements get_doc_text(doc_id) and get_doc_texts(doc_ids).
+
+    Every thread reads through its own read-only connection. Recently
+    fetched documents can be kept in a bounded LRU cache (cache_size > 0).
+    Databases written with a compression codec (see compression.py) are
+    decompressed transparently.
     """
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, cache_size=0, mmap_size=2 ** 30):
+        """
+        Args:
+            db_path: path to the sqlite file
+            cache_size: number of documents kept in the LRU cache (0 = off)
+            mmap_size: bytes of the db file sqlite may memory map per
+              connection
+        """
         self.path = db_path or DEFAULTS['db_path']
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self.codec = Codec.from_connection(self.connection)
 
     def __enter__(self):
         return self
@@ -31,25 +58,86 @@ class DocDB(object):
         """Return the path to the file that backs this database."""
         return self.path
 
+    @property
+    def connection(self):
+        """Read-only connection owned by the calling thread."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # as_uri() percent-encodes '?', '#', '%' etc. in the path
+            uri = pathlib.Path(self.path).absolute().as_uri() + '?mode=ro'
+            connection = sqlite3.connect(uri, uri=True,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+            connection.execute('PRAGMA query_only = 1')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
     def close(self):
-        """Close the connection to the database."""
-        self.connection.close()
+        """Close the connections to the database."""
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._cache.clear()
+        self._local = threading.local()
 
     def get_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
+        return list(self.iter_doc_ids())
+
+    def iter_doc_ids(self, chunk_size=10000):
+        """Stream the ids of docs stored in the db."""
         cursor = self.connection.cursor()
-        cursor.execute("SELECT id FROM documents")
-        results = [r[0] for r in cursor.fetchall()]
-        cursor.close()
-        return results
+        try:
+            cursor.execute("SELECT id FROM documents")
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield r[0]
+        finally:
+            cursor.close()
 
     def get_doc_text(self, doc_id):
         """Fetch the raw text of the doc for 'doc_id'."""
+        return self.get_doc_texts([doc_id])[0]
+
+    def get_doc_texts(self, doc_ids):
+        """Fetch the raw texts of the docs for 'doc_ids' (None if missing).
+
+        Uncached ids are fetched with as few IN (...) queries as possible.
+        """
+        doc_ids = [utils.normalize(doc_id) for doc_id in doc_ids]
+        texts = {}
+        if self.cache_size > 0:
+            with self._lock:
+                for doc_id in doc_ids:
+                    if doc_id in self._cache:
+                        self._cache.move_to_end(doc_id)
+                        texts[doc_id] = self._cache[doc_id]
+
+        missing = list({doc_id for doc_id in doc_ids if doc_id not in texts})
         cursor = self.connection.cursor()
-        cursor.execute(
-            "SELECT text FROM documents WHERE id = ?",
-            (utils.normalize(doc_id),)
-        )
-        result = cursor.fetchone()
+        for i in range(0, len(missing), MAX_QUERY_PARAMS):
+            chunk = missing[i:i + MAX_QUERY_PARAMS]
+            cursor.execute(
+                "SELECT id, text FROM documents WHERE id IN (%s)" %
+                ', '.join('?' * len(chunk)),
+                chunk
+            )
+            for doc_id, text in cursor.fetchall():
+                texts[doc_id] = self.codec.decompress(text)
         cursor.close()
-        return result if result is None else result[0]
+
+        if self.cache_size > 0 and missing:
+            with self._lock:
+                for doc_id in missing:
+                    if doc_id in texts:
+                        self._cache[doc_id] = texts[doc_id]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return [texts.get(doc_id) for doc_id in doc_ids]
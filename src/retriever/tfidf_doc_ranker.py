@@ -6,7 +6,9 @@
 # LICENSE file in the root directory of this source tree.
 """Rank documents with TF-IDF scores"""
 
+import os
 import logging
+import threading
 import numpy as np
 import scipy.sparse as sp
 
@@ -25,16 +27,27 @@ class TfidfDocRanker(object):
     Scores new queries by taking sparse dot products.
     """
 
-    def __init__(self, tfidf_path=None, strict=False):
+    SCORERS = {'dot', 'maxscore'}
+
+    def __init__(self, tfidf_path=None, strict=False, scorer='dot'):
         """
         Args:
-            tfidf_path: path to saved model file
+            tfidf_path: path to saved model file, either an .npz archive or a
+              directory in the memory-mapped format (see utils)
             strict: fail on empty queries or continue (and return empty result)
+            scorer: 'dot' scores every document with a full sparse product;
+              'maxscore' walks the term postings and stops early once no
+              unseen document can enter the top k (same results)
         """
+        if scorer not in self.SCORERS:
+            raise RuntimeError('Invalid scorer: %s' % scorer)
         # Load from disk
         tfidf_path = tfidf_path or DEFAULTS['tfidf_path']
         logger.info('Loading %s' % tfidf_path)
-        matrix, metadata = utils.load_sparse_csr(tfidf_path)
+        if os.path.isdir(tfidf_path):
+            matrix, metadata = utils.load_sparse_csr_mmap(tfidf_path)
+        else:
+            matrix, metadata = utils.load_sparse_csr(tfidf_path)
         self.doc_mat = matrix
         logger.info("doc_mat")
         logger.info(type(self.doc_mat))
@@ -47,6 +60,15 @@ class TfidfDocRanker(object):
         self.doc_dict = metadata['doc_dict']
         self.num_docs = len(self.doc_dict[0])
         self.strict = strict
+        self.scorer = scorer
+        self.term_max = metadata.get('term_max')
+        self._buffers = threading.local()
+        if scorer == 'maxscore':
+            if self.term_max is None:
+                logger.info('Computing per-term max scores')
+                self.term_max = utils.csr_row_max(self.doc_mat)
+            if not self.doc_mat.has_sorted_indices:
+                self.doc_mat.sort_indices()
 
     def get_doc_index(self, doc_id):
         """Convert doc_id --> doc_index"""
@@ -61,6 +83,8 @@ class TfidfDocRanker(object):
         in tfidf weighted word vector space.
         """
         spvec = self.text2spvec(query)
+        if self.scorer == 'maxscore':
+            return self.closest_docs_maxscore(spvec, k)
         res = spvec * self.doc_mat
 
         if len(res.data) <= k:
@@ -73,6 +97,135 @@ class TfidfDocRanker(object):
         doc_ids = [self.get_doc_id(i) for i in res.indices[o_sort]]
         return doc_ids, doc_scores
 
+    def closest_docs_maxscore(self, spvec, k=1):
+        """Exact top k by term-at-a-time MaxScore over the postings (rows).
+
+        Terms are visited in decreasing order of their max contribution
+        (query weight * max document weight). Once the contributions left
+        cannot lift an unseen document above the current k-th best score,
+        only already seen candidates are scored, and candidates that cannot
+        reach the k-th score anymore are dropped along the way.
+        """
+        nonzero = spvec.data > 0
+        terms, weights = spvec.indices[nonzero], spvec.data[nonzero]
+        bounds = weights * self.term_max[terms]
+        order = np.argsort(-bounds)
+        terms, weights, bounds = terms[order], weights[order], bounds[order]
+        # remaining[i] = max score obtainable from terms i, i + 1, ...
+        remaining = np.append(np.cumsum(bounds[::-1])[::-1], 0)
+
+        indptr, indices, data = (self.doc_mat.indptr, self.doc_mat.indices,
+                                 self.doc_mat.data)
+        # Dense per-document accumulated scores and candidate flags
+        acc, alive = self._score_buffers()
+        top = np.zeros(0, dtype=indices.dtype)
+        threshold = 0
+        seen = None
+        # New documents of each term, while cheaper than scanning the flags
+        new_docs, num_read = [], 0
+        i = 0
+        try:
+            # Phase 1: any document may still enter the top k.
+            while i < len(terms) and remaining[i] >= threshold:
+                start, end = indptr[terms[i]], indptr[terms[i] + 1]
+                postings = indices[start:end]
+                acc[postings] += weights[i] * data[start:end]
+                num_read += len(postings)
+                if new_docs is not None:
+                    if num_read * 16 < len(alive):
+                        new_docs.append(postings[~alive[postings]])
+                    else:
+                        new_docs = None
+                alive[postings] = True
+                top, threshold = self._update_top(acc, top, postings,
+                                                  threshold, k)
+                i += 1
+            if new_docs is None:
+                seen = np.flatnonzero(alive).astype(indices.dtype, copy=False)
+            elif new_docs:
+                seen = np.sort(np.concatenate(new_docs))
+            else:
+                seen = top
+            cand_docs = seen
+
+            # Phase 2: only seen candidates can still make it.
+            while i < len(terms) and len(cand_docs) > 0:
+                keep = acc[cand_docs] + remaining[i] >= threshold
+                alive[cand_docs[~keep]] = False
+                cand_docs = cand_docs[keep]
+                start, end = indptr[terms[i]], indptr[terms[i] + 1]
+                postings = indices[start:end]
+                if len(cand_docs) * 8 < len(postings):
+                    # Few candidates: look them up in the postings
+                    hit, pos = self._in_postings(postings, cand_docs)
+                    docs, pos = cand_docs[hit], pos[hit]
+                else:
+                    # Many: filter the postings by candidate
+                    pos = np.flatnonzero(alive[postings])
+                    docs = postings[pos]
+                acc[docs] += weights[i] * data[start:end][pos]
+                top, threshold = self._update_top(acc, top, docs, threshold,
+                                                  k)
+                i += 1
+            cand_scores = acc[cand_docs]
+        finally:
+            # Only documents seen in phase 1 were written to; past a few
+            # percent of them, clearing everything sequentially is faster.
+            if seen is None:
+                self._buffers.arrays = None
+            elif len(seen) * 32 > len(acc):
+                acc.fill(0)
+                alive.fill(False)
+            else:
+                acc[seen] = 0
+                alive[seen] = False
+
+        if len(cand_scores) <= k:
+            o_sort = np.argsort(-cand_scores)
+        else:
+            o = np.argpartition(-cand_scores, k)[0:k]
+            o_sort = o[np.argsort(-cand_scores[o])]
+
+        doc_scores = cand_scores[o_sort]
+        doc_ids = [self.get_doc_id(i) for i in cand_docs[o_sort]]
+        return doc_ids, doc_scores
+
+    def _score_buffers(self):
+        """Zeroed (scores, candidate flags) arrays over the documents.
+
+        Allocated once per thread; closest_docs_maxscore clears what it
+        wrote, so a query costs its postings, not the number of documents.
+        """
+        arrays = getattr(self._buffers, 'arrays', None)
+        if arrays is None:
+            num_docs = self.doc_mat.shape[1]
+            arrays = (np.zeros(num_docs, dtype=np.float64),
+                      np.zeros(num_docs, dtype=bool))
+            self._buffers.arrays = arrays
+        return arrays
+
+    @staticmethod
+    def _in_postings(postings, docs):
+        """Which docs are in the sorted postings, and their positions."""
+        pos = np.searchsorted(postings, docs)
+        pos[pos == len(postings)] = 0
+        hit = postings[pos] == docs if len(postings) else pos < 0
+        return hit, pos
+
+    @classmethod
+    def _update_top(cls, acc, top, docs, threshold, k):
+        """Top k documents and k-th score (0 if fewer) once docs were scored.
+
+        Scores only grow, so the new top k is among the previous top k and
+        the docs (sorted) now scoring above the previous k-th score.
+        """
+        if len(top) >= k:
+            docs = docs[acc[docs] > threshold]
+        pool = np.concatenate([docs, top[~cls._in_postings(docs, top)[0]]])
+        if len(pool) > k:
+            pool = pool[np.argpartition(-acc[pool], k - 1)[:k]]
+        return pool, (acc[pool].min() if len(pool) >= k else 0)
+
     def batch_closest_docs(self, queries, k=1, num_workers=None):
         """Process a batch of closest_docs requests multithreaded.
         Note: we can use plain threads here as scipy is outside of the GIL.
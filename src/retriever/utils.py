@@ -6,11 +6,15 @@
 # LICENSE file in the root directory of this source tree.
 """Various retriever utilities."""
 
+import os
+import json
 import regex
 import unicodedata
 import numpy as np
-import scipy.sparse as sp
-from sklearn.utils import murmurhash3_32
+
+# scipy and sklearn are slow to import and only needed to load an index or
+# hash tokens, so they are imported on first use.
+murmurhash3_32 = None
 
 
 # ------------------------------------------------------------------------------
@@ -30,12 +34,167 @@ def save_sparse_csr(filename, matrix, metadata=None):
 
 
 def load_sparse_csr(filename):
-    loader = np.load(filename)
+    import scipy.sparse as sp
+    loader = np.load(filename, allow_pickle=True)
     matrix = sp.csr_matrix((loader['data'], loader['indices'],
                             loader['indptr']), shape=loader['shape'])
     return matrix, loader['metadata'].item(0) if 'metadata' in loader else None
 
 
+# ------------------------------------------------------------------------------
+# Memory-mapped sparse matrix format.
+#
+# A directory holding raw .npy arrays that are opened with mmap_mode='r', so
+# that every process using the same index shares one page-cached copy:
+#   data.npy, indices.npy, indptr.npy   CSR arrays
+#   doc_freqs.npy                       (optional) document frequencies
+#   term_max.npy                        max weight of each row (term)
+#   doc_ids.bin, doc_id_offsets.npy     utf-8 doc ids + [start, end) offsets
+#   doc_id_order.npy                    doc indices sorted by doc id
+#   metadata.json                       shape and remaining scalar metadata
+# ------------------------------------------------------------------------------
+
+
+MMAP_ARRAYS = ('data', 'indices', 'indptr')
+
+
+def save_sparse_csr_mmap(dirname, matrix, metadata=None):
+    """Save a CSR matrix (+ DrQA tfidf metadata) in the memory-mapped format."""
+    os.makedirs(dirname, exist_ok=True)
+    matrix = matrix.sorted_indices()
+    for name in MMAP_ARRAYS:
+        np.save(os.path.join(dirname, name + '.npy'), getattr(matrix, name))
+
+    np.save(os.path.join(dirname, 'term_max.npy'), csr_row_max(matrix))
+
+    metadata = dict(metadata or {})
+    if 'doc_freqs' in metadata:
+        doc_freqs = np.asarray(metadata.pop('doc_freqs')).squeeze()
+        np.save(os.path.join(dirname, 'doc_freqs.npy'), doc_freqs)
+    if 'doc_dict' in metadata:
+        save_doc_ids(dirname, metadata.pop('doc_dict')[1])
+    metadata['shape'] = [int(d) for d in matrix.shape]
+    with open(os.path.join(dirname, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+
+def load_sparse_csr_mmap(dirname):
+    """Open a matrix saved with save_sparse_csr_mmap without copying it."""
+    import scipy.sparse as sp
+    with open(os.path.join(dirname, 'metadata.json')) as f:
+        metadata = json.load(f)
+    arrays = [np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+              for name in MMAP_ARRAYS]
+    matrix = sp.csr_matrix(tuple(arrays), shape=tuple(metadata.pop('shape')))
+    # Sorted on save; avoids scanning all indices to find out.
+    matrix.has_sorted_indices = True
+
+    for name in ('doc_freqs', 'term_max'):
+        filename = os.path.join(dirname, name + '.npy')
+        if os.path.isfile(filename):
+            metadata[name] = np.load(filename, mmap_mode='r')
+    if os.path.isfile(os.path.join(dirname, 'doc_ids.bin')):
+        metadata['doc_dict'] = DocIdTable(dirname).as_doc_dict()
+    return matrix, metadata
+
+
+def csr_row_max(matrix):
+    """Max stored value of each row of a CSR matrix (0 for empty rows)."""
+    row_max = np.zeros(matrix.shape[0], dtype=matrix.dtype)
+    nonempty = np.diff(matrix.indptr) > 0
+    if nonempty.any():
+        row_max[nonempty] = np.maximum.reduceat(
+            matrix.data, matrix.indptr[:-1][nonempty]
+        )
+    return row_max
+
+
+def save_doc_ids(dirname, doc_ids):
+    """Write the doc_index --> doc_id list as a compact doc id table."""
+    encoded = [str(doc_id).encode('utf-8') for doc_id in doc_ids]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__),
+                     dtype=np.int64)
+    with open(os.path.join(dirname, 'doc_ids.bin'), 'wb') as f:
+        for b in encoded:
+            f.write(b)
+    np.save(os.path.join(dirname, 'doc_id_offsets.npy'), offsets)
+    np.save(os.path.join(dirname, 'doc_id_order.npy'), order)
+
+
+class DocIdTable(object):
+    """Memory-mapped doc_index <--> doc_id table.
+
+    Index --> id is a slice of the utf-8 blob; id --> index is a binary search
+    over the sorted order, so nothing is materialized at load time.
+    """
+
+    def __init__(self, dirname):
+        self.offsets = np.load(os.path.join(dirname, 'doc_id_offsets.npy'),
+                               mmap_mode='r')
+        self.order = np.load(os.path.join(dirname, 'doc_id_order.npy'),
+                             mmap_mode='r')
+        blob = os.path.join(dirname, 'doc_ids.bin')
+        if os.path.getsize(blob) > 0:
+            self.blob = np.memmap(blob, dtype=np.uint8, mode='r')
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _bytes(self, doc_index):
+        start, end = self.offsets[doc_index], self.offsets[doc_index + 1]
+        return self.blob[start:end].tobytes()
+
+    def __getitem__(self, doc_index):
+        """Convert doc_index --> doc_id (negative indices count from the end,
+        as in the list this table replaces)"""
+        index = doc_index + len(self) if doc_index < 0 else doc_index
+        if not 0 <= index < len(self):
+            raise IndexError(doc_index)
+        return self._bytes(index).decode('utf-8')
+
+    def index(self, doc_id):
+        """Convert doc_id --> doc_index"""
+        key = str(doc_id).encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._bytes(self.order[lo]) == key:
+            return int(self.order[lo])
+        raise KeyError(doc_id)
+
+    def as_doc_dict(self):
+        """Views matching the (doc_id --> index, index --> doc_id) tuple."""
+        return _DocIndexMap(self), self
+
+
+class _DocIndexMap(object):
+    """Read-only doc_id --> doc_index mapping backed by a DocIdTable."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, doc_id):
+        return self.table.index(doc_id)
+
+    def __contains__(self, doc_id):
+        try:
+            self.table.index(doc_id)
+        except KeyError:
+            return False
+        return True
+
+
 # ------------------------------------------------------------------------------
 # Token hashing.
 # ------------------------------------------------------------------------------
@@ -43,6 +202,9 @@ def load_sparse_csr(filename):
 
 def hash(token, num_buckets):
     """Unsigned 32 bit murmurhash for feature hashing."""
+    global murmurhash3_32
+    if murmurhash3_32 is None:
+        from sklearn.utils import murmurhash3_32
     return murmurhash3_32(token, positive=True) % num_buckets
 
 
@@ -6,6 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+from .. import lazy_getattr
 
 DEFAULTS = {
     'corenlp_classpath': os.getenv('CLASSPATH')
@@ -17,26 +18,24 @@ def set_default(key, value):
     DEFAULTS[key] = value
 
 
-from .corenlp_tokenizer import CoreNLPTokenizer
-from .regexp_tokenizer import RegexpTokenizer
-from .simple_tokenizer import SimpleTokenizer
-
-# Spacy is optional
-try:
-    from .spacy_tokenizer import SpacyTokenizer
-except ImportError:
-    pass
+# Imported on first use (pexpect, regex; spacy is optional)
+__getattr__ = lazy_getattr(__name__, {
+    'CoreNLPTokenizer': ('.corenlp_tokenizer', 'CoreNLPTokenizer'),
+    'RegexpTokenizer': ('.regexp_tokenizer', 'RegexpTokenizer'),
+    'SimpleTokenizer': ('.simple_tokenizer', 'SimpleTokenizer'),
+    'SpacyTokenizer': ('.spacy_tokenizer', 'SpacyTokenizer'),
+})
 
 
 def get_class(name):
     if name == 'spacy':
-        return SpacyTokenizer
+        return __getattr__('SpacyTokenizer')
     if name == 'corenlp':
-        return CoreNLPTokenizer
+        return __getattr__('CoreNLPTokenizer')
     if name == 'regexp':
-        return RegexpTokenizer
+        return __getattr__('RegexpTokenizer')
     if name == 'simple':
-        return SimpleTokenizer
+        return __getattr__('SimpleTokenizer')
 
     raise RuntimeError('Invalid tokenizer: %s' % name)
 
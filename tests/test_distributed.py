@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Data-parallel training helpers, run in two local gloo processes."""
+
+import os
+import socket
+import sys
+
+import torch
+import torch.multiprocessing as mp
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.reader import distributed
+from src.reader.data import ResumableSampler, ShardedSampler
+from src.reader.utils import AverageMeter
+
+WORLD_SIZE = 2
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_model(seed):
+    torch.manual_seed(seed)
+    return torch.nn.Linear(3, 1)
+
+
+def gradients(model, x, y):
+    model.zero_grad()
+    torch.nn.functional.mse_loss(model(x).view(-1), y).backward()
+
+
+def check_samplers(rank):
+    """Training shards are disjoint, padded to the same length and cover
+    every example; evaluation shards count every example exactly once."""
+    train = list(ResumableSampler(range(10), True, 3, WORLD_SIZE, rank))
+    shards = distributed.all_gather_object(train)
+    assert len({len(shard) for shard in shards}) == 1
+    assert sorted(sum(shards, [])) == list(range(10))
+
+    train = list(ResumableSampler(range(7), True, 3, WORLD_SIZE, rank))
+    shards = distributed.all_gather_object(train)
+    assert [len(shard) for shard in shards] == [4, 4]
+    assert set(sum(shards, [])) == set(range(7))
+
+    evaluate = list(ShardedSampler(range(7), WORLD_SIZE, rank))
+    shards = distributed.all_gather_object(evaluate)
+    assert sorted(sum(shards, [])) == list(range(7))
+
+
+def check_gradients(rank):
+    """Averaged gradients of the shards equal the full batch gradients."""
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(8, 3, generator=generator)
+    y = torch.randn(8, generator=generator)
+
+    reference = make_model(0)
+    gradients(reference, x, y)
+
+    # Ranks start from different weights; rank 0's are broadcast.
+    model = make_model(rank)
+    distributed.broadcast_parameters(model)
+    for p, q in zip(model.parameters(), reference.parameters()):
+        assert torch.equal(p.data, q.data)
+
+    shard = list(ResumableSampler(range(8), False, 0, WORLD_SIZE, rank))
+    gradients(model, x[shard], y[shard])
+    distributed.average_gradients(model.parameters())
+    for p, q in zip(model.parameters(), reference.parameters()):
+        assert torch.allclose(p.grad, q.grad, atol=1e-6)
+
+
+def check_reduce_meter(rank):
+    """reduce_meter weighs every process by its number of updates."""
+    from main import reduce_meter
+    meter = AverageMeter()
+    if rank == 0:
+        meter.update(1.0, 2)
+    else:
+        meter.update(4.0)
+    assert reduce_meter(meter) == 2.0
+
+
+def worker(rank, port):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                      WORLD_SIZE=str(WORLD_SIZE), RANK=str(rank))
+    assert distributed.init('gloo') == (rank, WORLD_SIZE)
+    try:
+        check_samplers(rank)
+        check_gradients(rank)
+        check_reduce_meter(rank)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def test_two_processes():
+    mp.spawn(worker, args=(free_port(),), nprocs=WORLD_SIZE)
+
+
+def test_single_process_is_a_no_op():
+    assert not distributed.is_initialized()
+    assert distributed.all_reduce_sum([1, 2]).tolist() == [1.0, 2.0]
+    assert distributed.all_gather_object('x') == ['x']
+    model = make_model(0)
+    gradients(model, torch.ones(2, 3), torch.zeros(2))
+    grads = [p.grad.clone() for p in model.parameters()]
+    distributed.average_gradients(model.parameters())
+    assert all(torch.equal(p.grad, g)
+               for p, g in zip(model.parameters(), grads))
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""Memory-mapped doc id table."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.retriever.utils import DocIdTable, save_doc_ids
+
+
+def test_doc_id_table_indexing(tmp_path):
+    doc_ids = ['b', 'Zürich', 'a', '']
+    save_doc_ids(str(tmp_path), doc_ids)
+    table = DocIdTable(str(tmp_path))
+    assert len(table) == 4
+    assert [table[i] for i in range(4)] == doc_ids
+    assert [table[i] for i in range(-4, 0)] == doc_ids
+    for i in (4, -5):
+        with pytest.raises(IndexError):
+            table[i]
+    assert [table.index(d) for d in doc_ids] == [0, 1, 2, 3]
+    with pytest.raises(KeyError):
+        table.index('c')
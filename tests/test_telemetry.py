@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""Telemetry export."""
+
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.reader.telemetry import Telemetry
+
+
+def test_jsonl_flush_tensor_fields(tmp_path):
+    filename = str(tmp_path / 'train.jsonl')
+    telemetry = Telemetry().open(filename)
+    telemetry.loop('train', restart=True)
+    with telemetry.phase('forward'):
+        pass
+    telemetry.count('examples', 4)
+    telemetry.flush(epoch=0, step=1, loss=torch.tensor(1.0),
+                    exact_match=np.float32(0.5))
+    with open(filename) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1
+    assert records[0]['loss'] == 1.0
+    assert records[0]['exact_match'] == 0.5
+    assert records[0]['step'] == 1
+    assert records[0]['counts'] == {'examples': 4}